@@ -1,50 +1,453 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify
 from flask_cors import CORS
 import os
+import io
 import base64
+import functools
+import json
+import logging
+import time
+
+from services.pipeline import FusionPipeline, PIPELINE_STAGES
+from services.job_manager import JobManager, JobQueueFullError
+from services.admission import AdmissionController, AdmissionRejectedError, RequestCost
+from services.image_io import CopyMeter, ImageTooLargeError, InvalidImageError, probe_image
+from services.frame import metering
+from services.session_manager import get_session_manager, rembg_available
+from services.result_store import ResultStore
+from services.result_cache import ResultCache
+from services.output_encoder import OutputEncoder, UnsupportedFormatError
+from services import metrics
+
+class InMemoryRequest(Request):
+    """上传文件始终保存在内存中（Werkzeug默认会把大于500KB的上传写入临时文件）"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+# 上传大小上限（内存中保存上传文件，必须有界）
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-# 一个1x1像素的透明PNG图片（base64编码）
-TINY_IMAGE = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='
+# 日志配置
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+# 融合流水线与后台任务（工作线程数、队列上限、结果保留时间可通过环境变量配置）
+# 任务状态、结果存储与准入预算都在进程内存中：只支持单进程多线程部署（见 gunicorn.conf.py）
+pipeline = FusionPipeline()
+jobs = JobManager.from_env(PIPELINE_STAGES)
+# 准入控制：按请求成本（上传大小与文件头尺寸）限制并发处理的像素量与内存，超出预算时排队或快速返回503
+admission = AdmissionController.from_env()
+# 编码后的结果图片（通过 /api/results/<id> 以二进制返回）
+results = ResultStore.from_env()
+# 处理结果缓存（键为上传字节与流水线参数的哈希，重复提交不再执行流水线）
+result_cache = ResultCache.from_env()
+# 结果编码（格式按 format 参数或Accept头协商，默认 OUTPUT_FORMAT）
+encoder = OutputEncoder.from_env()
+# 结果返回方式：url（默认，JSON中只含结果地址）/ inline（旧客户端兼容，JSON中内嵌base64 data URL）
+RESULT_DELIVERY = os.getenv('RESULT_DELIVERY', 'url').lower()
+# SSE连接空闲时发送保活注释的间隔（秒）
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', 15))
+
+# 抠图模型默认在首次请求时加载；预加载时在主进程fork唯一的工作进程之前加载（gunicorn.conf.py 开启了 preload_app），
+# 工作进程重启时直接继承已加载的模型（只支持单工作进程部署，见 gunicorn.conf.py）
+if os.getenv('REMBG_PRELOAD', '').lower() in ('1', 'true', 'yes') and rembg_available():
+    get_session_manager().preload(warm_up=os.getenv('REMBG_WARMUP', '').lower() in ('1', 'true', 'yes'))
+
+def cache_sizes(key):
+    """各缓存的统计值（/api/metrics 输出时读取）"""
+    caches = {
+        'result_cache': result_cache.stats(),
+        'result_store': results.stats(),
+        'background': pipeline.generator.cache.stats(),
+    }
+    return {(name,): stats[key] for name, stats in caches.items()}
+
+metrics.CACHE_BYTES.set_function(functools.partial(cache_sizes, 'bytes'))
+metrics.CACHE_ENTRIES.set_function(functools.partial(cache_sizes, 'entries'))
+metrics.ADMISSION_LOAD.set_function(lambda: {(resource,): admission.stats()[resource]
+                                             for resource in ('in_flight', 'pixels', 'memory', 'waiting',
+                                                              'background_waiting')})
+metrics.JOBS.set_function(lambda: {(state,): count for state, count in jobs.stats().items()
+                                   if state in ('queued', 'running')})
+
+def result_key(file_data, output_format=None, preview=False):
+    """结果缓存键：上传内容、流水线参数与编码参数的哈希（预览优先模式的全分辨率结果单独缓存）"""
+    output_format = output_format or encoder.default_format
+    params = {**pipeline.cache_params(), 'output': encoder.cache_params(output_format)}
+    if preview:
+        params['preview_size'] = pipeline.preview_size
+    return result_cache.make_key(file_data, params)
+
+def encode_result(result, output_format, meter, start):
+    """编码流水线结果（帧在这里才转换为PIL），返回结果缓存条目"""
+    image = result['image']
+    with metering(meter), metrics.STAGE_SECONDS.time(stage='encode'):
+        data = encoder.encode(image, output_format)
+    meter.add('encode', len(data))
+
+    timings = result['timings']
+    logger.info(f"请求数据拷贝: {meter.copies}，整帧拷贝 {meter.frame_copies} 次，关键路径: {' → '.join(timings['critical_path'])} "
+                f"{timings['critical_path_ms']:.0f}ms / 总耗时 {timings['total_ms']:.0f}ms")
+    return {
+        'data': data,
+        'mimetype': encoder.mimetype(output_format),
+        'character': result['character'],
+        'width': image.width,
+        'height': image.height,
+        'timings': timings,
+        'compute_seconds': time.perf_counter() - start,
+    }
+
+def deliver(entry, meter, inline, result_id=None):
+    """结果图片的返回字段：inline时内嵌base64 data URL，否则存入结果存储并返回地址"""
+    response = {
+        'resultType': entry['mimetype'],
+        'resultSize': len(entry['data']),
+        'width': entry['width'],
+        'height': entry['height'],
+    }
+    if inline:
+        result_base64 = base64.b64encode(entry['data']).decode()
+        meter.add('base64', len(result_base64))
+        response['resultImage'] = f"data:{entry['mimetype']};base64,{result_base64}"
+    else:
+        result_id = results.put(entry['data'], entry['mimetype'],
+                                {'width': entry['width'], 'height': entry['height']}, result_id=result_id)
+        response['resultId'] = result_id
+        response['resultUrl'] = f'/api/results/{result_id}'
+    return response
+
+def final_response(entry, cache_key, cache_status, meter, inline):
+    """全分辨率结果的响应"""
+    character = entry['character']
+    # 结果ID即内容哈希：重复提交得到同一地址，浏览器缓存也能命中
+    response = {
+        'character': character,
+        'message': f'已识别角色：{character}',
+        **deliver(entry, meter, inline, result_id=cache_key),
+        'cache': cache_status,
+    }
+    response['metrics'] = meter.to_dict()
+    if cache_status == 'miss':
+        response['metrics']['timings'] = entry['timings']
+    return response
+
+def request_cost(file_data, info, preview=False):
+    """
+    请求成本估计（准入控制用）
+
+    Args:
+        file_data (bytes): 上传数据
+        info (Dict): probe_image 的结果
+        preview (bool): 预览优先模式的预览请求（只在 PREVIEW_SIZE 上处理，另需常驻全尺寸解码图）
+    """
+    cost = admission.estimate(len(file_data), info['width'], info['height'], pipeline.max_image_size)
+    if not preview:
+        return cost
+    small = admission.estimate(len(file_data), info['width'], info['height'], pipeline.preview_size)
+    return RequestCost(small.pixels, small.memory + cost.pixels * 3)
+
+def admitted(cost, background=False):
+    """在准入预算内执行（后台任务已由任务队列限界，不设截止时间）"""
+    if background:
+        return admission.admit(cost, timeout=None)
+    return admission.admit(cost)
+
+def run_pipeline(file_data, on_stage=None, inline=False, output_format=None, cost=None, background=False):
+    """
+    执行融合流水线并编码结果（全程在内存中完成；相同上传、参数与输出格式直接复用缓存结果）
+
+    缓存未命中时在准入预算内执行，cost 默认按文件头估计；同步请求等待超时抛出 AdmissionRejectedError
+    """
+    output_format = output_format or encoder.default_format
+    cost = cost or request_cost(file_data, probe_image(file_data))
+    meter = CopyMeter()
+    meter.add('upload', len(file_data))
+
+    def compute():
+        with admitted(cost, background):
+            return compute_admitted()
+
+    def compute_admitted():
+        start = time.perf_counter()
+        with metrics.REQUEST_MEMORY.track():
+            result = pipeline.process(file_data, on_stage=on_stage, meter=meter)
+            entry = encode_result(result, output_format, meter, start)
+        metrics.REQUEST_FRAME_COPIES.observe(meter.frame_copies)
+        return entry
+
+    start = time.perf_counter()
+    cache_key = result_key(file_data, output_format)
+    with metrics.IN_FLIGHT.track_inprogress():
+        entry, cache_status = result_cache.get_or_compute(cache_key, compute)
+    if cache_status != 'miss' and on_stage is not None:
+        for stage in PIPELINE_STAGES:
+            on_stage(stage, 'done')
+
+    response = final_response(entry, cache_key, cache_status, meter, inline)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, cache=cache_status)
+    return response
+
+def run_preview(file_data, inline=False, output_format=None, info=None):
+    """
+    预览优先模式：先在 PREVIEW_SIZE 工作尺寸上完整执行流水线并立即返回预览，
+    全分辨率结果作为后台任务计算（沿用预览的角色与粗遮罩），通过任务查询或SSE获取
+
+    Returns:
+        Tuple[Dict, int]: (响应, 状态码)；全分辨率结果已缓存时直接返回最终结果（200）
+
+    Raises:
+        JobQueueFullError: 后台任务队列已满
+        AdmissionRejectedError: 预览等待准入预算超时
+    """
+    output_format = output_format or encoder.default_format
+    info = info or probe_image(file_data)
+    meter = CopyMeter()
+    meter.add('upload', len(file_data))
+
+    cache_key = result_key(file_data, output_format, preview=True)
+    entry = result_cache.get(cache_key)
+    if entry is not None:
+        return final_response(entry, cache_key, 'hit', meter, inline), 200
+
+    with admitted(request_cost(file_data, info, preview=True)), metrics.IN_FLIGHT.track_inprogress():
+        start = time.perf_counter()
+        preview = pipeline.preview(file_data, meter=meter)
+        preview_entry = encode_result(preview, output_format, meter, start)
+
+    job_id = jobs.submit(functools.partial(run_refine, preview, cache_key, inline, output_format,
+                                           request_cost(file_data, info)))
+    character = preview['character']
+    return {
+        'character': character,
+        'message': f'已识别角色：{character}',
+        'preview': deliver(preview_entry, meter, inline),
+        'jobId': job_id,
+        'statusUrl': f'/api/jobs/{job_id}',
+        'eventsUrl': f'/api/jobs/{job_id}/events',
+        'jobs': jobs.stats(),
+        'metrics': {**meter.to_dict(), 'timings': preview_entry['timings']},
+    }, 202
+
+def run_refine(preview, cache_key, inline, output_format, cost, on_stage=None):
+    """预览优先模式的后台任务：在准入预算内计算并编码全分辨率结果"""
+    if on_stage is not None:
+        # 角色识别沿用预览的结果
+        on_stage('recognize', 'done')
+    meter = preview['meter']
+
+    def compute():
+        with admitted(cost, background=True):
+            return compute_admitted()
+
+    def compute_admitted():
+        start = time.perf_counter()
+        with metrics.REQUEST_MEMORY.track():
+            result = pipeline.refine(preview, on_stage=on_stage, meter=meter)
+            entry = encode_result(result, output_format, meter, start)
+        metrics.REQUEST_FRAME_COPIES.observe(meter.frame_copies)
+        return entry
+
+    with metrics.IN_FLIGHT.track_inprogress():
+        entry, cache_status = result_cache.get_or_compute(cache_key, compute)
+    if cache_status != 'miss' and on_stage is not None:
+        for stage in PIPELINE_STAGES:
+            on_stage(stage, 'done')
+    return final_response(entry, cache_key, cache_status, meter, inline)
+
+def request_flag(name):
+    """读取布尔请求参数（查询参数或表单字段，1/true/yes 为真）"""
+    value = request.args.get(name) or request.form.get(name) or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def wants_async():
+    """请求是否使用任务提交模式（?async=1 或表单字段 async=1）"""
+    return request_flag('async')
+
+def output_format():
+    """结果格式：format 参数（webp/jpeg/png）优先，否则按Accept头协商"""
+    requested = request.args.get('format') or request.form.get('format')
+    return encoder.negotiate(requested, request.headers.get('Accept'))
+
+def wants_preview():
+    """是否使用预览优先模式（?preview=1 或表单字段 preview=1）"""
+    return request_flag('preview')
+
+def wants_inline():
+    """结果是否内嵌为base64 data URL（?inline=1、表单字段 inline=1 或 RESULT_DELIVERY=inline）"""
+    return RESULT_DELIVERY == 'inline' or request_flag('inline')
+
+def busy_response(message, retry_after, **extra):
+    """503响应：带 Retry-After 头与当前负载，客户端与负载均衡据此退避"""
+    response = jsonify({'error': f'服务繁忙: {message}', 'retryAfter': retry_after,
+                        'load': admission.stats(), **extra})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'message': 'Backend is running'})
+    """
+    服务状态与当前负载（load）：预算已满或有请求排队时 status 为 saturated，
+    ?strict=1 时饱和返回503，供只看状态码的负载均衡摘除实例
+    """
+    load = admission.stats()
+    response = jsonify({
+        'status': 'saturated' if load['saturated'] else 'ok',
+        'message': 'Backend is running',
+        'load': load,
+        'jobs': jobs.stats(),
+        'results': results.stats(),
+        'resultCache': result_cache.stats(),
+        'cpuPool': pipeline.frame_pool.stats() if pipeline.frame_pool is not None else None,
+        'models': get_session_manager().stats()
+    })
+    if load['saturated'] and request_flag('strict'):
+        response.status_code = 503
+        response.headers['Retry-After'] = str(load['retry_after'])
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus文本格式的指标（阶段耗时直方图、进行中请求数、缓存占用、请求内存峰值）"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/api/process-image', methods=['POST'])
 def process():
     try:
         if 'image' not in request.files:
             return jsonify({'error': '没有上传图片'}), 400
-        
+
         file = request.files['image']
         if file.filename == '':
             return jsonify({'error': '没有选择文件'}), 400
-        
-        # 读取文件（只是验证文件存在，不处理）
+
         file_data = file.read()
-        
+
         if len(file_data) == 0:
             return jsonify({'error': '文件为空'}), 400
-        
-        # 模拟角色识别
-        characters = ['皮卡丘', '鸣人', '蜘蛛侠', '蝙蝠侠', '超人', '钢铁侠', '美国队长']
-        import random
-        character = random.choice(characters)
-        
-        # 返回一个简单的演示图片
-        # 在实际应用中，这里会进行AI处理
-        return jsonify({
-            'success': True,
-            'character': character,
-            'resultImage': f'data:image/png;base64,{TINY_IMAGE}',
-            'message': f'已识别角色：{character}（演示模式）'
-        })
-        
+
+        # 只读取文件头：非图片或像素数超限的上传在解码前拒绝
+        try:
+            info = probe_image(file_data)
+        except ImageTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        except InvalidImageError as e:
+            return jsonify({'error': str(e)}), 400
+
+        inline = wants_inline()
+        try:
+            result_format = output_format()
+        except UnsupportedFormatError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # 预览优先模式：先返回小尺寸预览，全分辨率结果由后台任务计算
+        if wants_preview():
+            try:
+                response, status = run_preview(file_data, inline=inline, output_format=result_format, info=info)
+            except JobQueueFullError as e:
+                return busy_response(str(e), admission.retry_after(), jobs=jobs.stats())
+            return jsonify({'success': True, **response}), status
+
+        # 任务提交模式：立即返回任务ID，由工作线程池执行流水线
+        if wants_async():
+            try:
+                job_id = jobs.submit(functools.partial(run_pipeline, inline=inline, output_format=result_format,
+                                                       cost=request_cost(file_data, info), background=True),
+                                     file_data)
+            except JobQueueFullError as e:
+                return busy_response(str(e), admission.retry_after(), jobs=jobs.stats())
+
+            return jsonify({
+                'success': True,
+                'jobId': job_id,
+                'statusUrl': f'/api/jobs/{job_id}',
+                'jobs': jobs.stats()
+            }), 202
+
+        result = run_pipeline(file_data, inline=inline, output_format=result_format,
+                              cost=request_cost(file_data, info))
+        return jsonify({'success': True, **result})
+
+    except AdmissionRejectedError as e:
+        logger.warning(f"准入控制拒绝请求（{e.reason}）: {str(e)}")
+        return busy_response(str(e), e.retry_after)
+    except InvalidImageError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
+        logger.error(f"处理图片时出错: {str(e)}")
         return jsonify({'error': f'处理失败: {str(e)}'}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询任务状态与结果"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+
+    return jsonify(job_payload(job_id, job))
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """以服务器推送事件（SSE）推送任务进度：progress 事件报告阶段变化，done / failed 事件携带最终结果后结束"""
+    if jobs.get(job_id) is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+
+    def stream():
+        version = None
+        while True:
+            job = jobs.wait(job_id, version, timeout=SSE_KEEPALIVE_SECONDS)
+            if job is None:
+                yield f"event: failed\ndata: {json.dumps({'error': '任务不存在或已过期'}, ensure_ascii=False)}\n\n"
+                return
+            if job['version'] == version:
+                # 保活注释行，避免代理因空闲断开连接
+                yield ': keep-alive\n\n'
+                continue
+            version = job['version']
+            event = job['status'] if job['status'] in ('done', 'failed') else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(job_payload(job_id, job), ensure_ascii=False)}\n\n"
+            if event != 'progress':
+                return
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def job_payload(job_id, job):
+    """任务状态的响应内容（查询接口与SSE事件共用）"""
+    response = {
+        'jobId': job_id,
+        'status': job['status'],
+        'stages': job['stages'],
+        'progress': job['progress'],
+        'queue': jobs.stats()
+    }
+    if job['status'] == 'done':
+        response.update({'success': True, **job['result']})
+    elif job['status'] == 'failed':
+        response['error'] = f"处理失败: {job['error']}"
+    return response
+
+@app.route('/api/results/<result_id>', methods=['GET'])
+def get_result(result_id):
+    """以二进制返回结果图片（支持ETag条件请求与Range分段请求）"""
+    entry = results.get(result_id)
+    if entry is None:
+        return jsonify({'error': '结果不存在或已过期'}), 404
+
+    response = Response(entry['data'], mimetype=entry['mimetype'])
+    response.set_etag(entry['etag'])
+    # 结果ID唯一对应一份内容，在保留期内不会变化
+    response.cache_control.private = True
+    response.cache_control.max_age = entry['expires_in']
+    response.cache_control.immutable = True
+    response.accept_ranges = 'bytes'
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(entry['data']))
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=False)
+    # 单进程多线程（任务与结果保存在进程内存中）
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=False, threaded=True)
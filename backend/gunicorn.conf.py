@@ -0,0 +1,24 @@
+"""
+Gunicorn配置：单个工作进程 + 多线程（gunicorn -c gunicorn.conf.py app:app）
+
+任务状态（JobManager）、结果存储（ResultStore）与准入控制预算都保存在进程内存中：
+多个工作进程时，/api/jobs/<id>、/api/results/<id> 落到其他进程会返回404，准入预算也变成每个进程各一份。
+因此只允许1个工作进程，请求并发由线程提供；CPU密集的融合阶段用 CPU_POOL_WORKERS 进程池扩展，
+需要更多实例时水平扩容，由负载均衡按 /api/health 的负载路由（同一任务的请求需保持会话粘性）。
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+# 在fork工作进程前导入应用（配合 REMBG_PRELOAD 提前加载模型，重启工作进程时不必重新加载）
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+
+def on_starting(server):
+    """拒绝多工作进程启动（命令行 -w / WEB_CONCURRENCY 会覆盖本文件的设置）"""
+    if server.cfg.workers != 1:
+        raise RuntimeError(f"任务、结果与准入预算保存在进程内存中，只支持1个工作进程（当前 {server.cfg.workers}），"
+                           "请用 GUNICORN_THREADS 调整并发")
@@ -0,0 +1,237 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from services.metrics import ADMISSION_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 流水线每个工作像素的内存估计（字节）：解码RGB、抠图RGBA、背景、融合画布与增强中间结果、编码缓冲区。
+# 不含抠图模型时实测请求内存峰值约 10~21 B/px（小图的固定开销占比更高），抠图模型的中间张量另计，取32留出余量
+DEFAULT_BYTES_PER_PIXEL = 32
+
+class RequestCost(NamedTuple):
+    """一次请求的估计成本"""
+    pixels: int
+    memory: int
+
+class AdmissionRejectedError(Exception):
+    """负载预算已满，请求被拒绝（等待队列已满或等待超过截止时间）"""
+
+    def __init__(self, message: str, retry_after: int, reason: str):
+        super().__init__(message)
+        # 建议客户端重试前等待的秒数（Retry-After）
+        self.retry_after = retry_after
+        # queue_full / timeout
+        self.reason = reason
+
+    def __reduce__(self):
+        # 默认按 args 重建只会传入message，复制（合并请求各自抛出副本）与跨进程传递需要全部参数
+        return type(self), (str(self), self.retry_after, self.reason)
+
+class AdmissionController:
+    """
+    按请求成本的准入控制：并发处理的像素量与内存各有全局预算
+
+    预算不足时请求进入有界的先进先出等待队列，超过截止时间仍未轮到则拒绝；队列已满时立即拒绝。
+    后台任务（不设截止时间）在单独的队列中等待，只在没有同步请求排队时获得预算，
+    不会让有截止时间的同步请求排在它们后面超时。
+    预算空闲时单个超出预算的请求仍会放行（否则永远无法处理）。
+    """
+
+    def __init__(self, max_pixels: int = 32_000_000, max_memory: int = 1024 * 1024 * 1024,
+                 max_waiting: int = 8, wait_timeout: float = 5.0,
+                 bytes_per_pixel: int = DEFAULT_BYTES_PER_PIXEL):
+        """
+        初始化准入控制
+
+        Args:
+            max_pixels (int): 同时处理的像素总量上限，0表示不限制
+            max_memory (int): 同时处理的请求估计内存总量上限（字节），0表示不限制
+            max_waiting (int): 等待队列长度上限，0表示预算不足时立即拒绝
+            wait_timeout (float): 同步请求在队列中等待的最长秒数
+            bytes_per_pixel (int): 估计内存时每个工作像素的字节数
+        """
+        self.max_pixels = max_pixels
+        self.max_memory = max_memory
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.bytes_per_pixel = bytes_per_pixel
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # 等待中的同步请求（先进先出，只有队首可以获得预算）
+        self._waiters: deque = deque()
+        # 等待中的后台任务（先进先出，同步队列为空时队首才可以获得预算）
+        self._background: deque = deque()
+        self._pixels = 0
+        self._memory = 0
+        self._in_flight = 0
+        # 请求占用预算时长的指数滑动平均（秒），用于估计Retry-After
+        self._hold_seconds = 1.0
+        self._stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0}
+
+        logger.info(f"准入控制初始化完成，像素预算 {max_pixels or '不限'}，内存预算 {max_memory or '不限'}，"
+                    f"等待队列 {max_waiting}，截止时间 {wait_timeout}s")
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionController':
+        """根据环境变量创建准入控制"""
+        return cls(
+            max_pixels=int(float(os.getenv('ADMISSION_MAX_MEGAPIXELS', 32)) * 1_000_000),
+            max_memory=int(os.getenv('ADMISSION_MAX_MEMORY_BYTES', 1024 * 1024 * 1024)),
+            max_waiting=int(os.getenv('ADMISSION_QUEUE_SIZE', 8)),
+            wait_timeout=float(os.getenv('ADMISSION_WAIT_SECONDS', 5)),
+            bytes_per_pixel=int(os.getenv('ADMISSION_BYTES_PER_PIXEL', DEFAULT_BYTES_PER_PIXEL)),
+        )
+
+    def estimate(self, upload_bytes: int, width: int, height: int, max_size: int = 0) -> RequestCost:
+        """
+        估计请求成本
+
+        Args:
+            upload_bytes (int): 上传数据大小（整个处理期间常驻内存）
+            width (int): 文件头中的图片宽度
+            height (int): 文件头中的图片高度
+            max_size (int): 解码时的最长边上限（MAX_IMAGE_SIZE），0表示保持原尺寸
+
+        Returns:
+            RequestCost: (工作像素数, 估计内存字节数)
+        """
+        if max_size and max(width, height) > max_size:
+            scale = max_size / max(width, height)
+            width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        pixels = width * height
+        return RequestCost(pixels, upload_bytes + pixels * self.bytes_per_pixel)
+
+    @contextmanager
+    def admit(self, cost: RequestCost, timeout: Optional[float] = -1) -> Iterator[None]:
+        """
+        在代码块执行期间占用预算
+
+        Args:
+            cost (RequestCost): 请求成本
+            timeout (float): 最长等待秒数，默认 wait_timeout；None表示后台任务：不设截止时间、
+                不受等待队列长度限制（已由任务队列限界），在后台队列中等待，优先级低于同步请求
+
+        Raises:
+            AdmissionRejectedError: 等待队列已满或等待超时
+        """
+        self.acquire(cost, timeout)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(cost, time.perf_counter() - start)
+
+    def acquire(self, cost: RequestCost, timeout: Optional[float] = -1) -> float:
+        """
+        获取预算（参数见 admit）
+
+        Returns:
+            float: 排队等待的秒数
+        """
+        if timeout is not None and timeout < 0:
+            timeout = self.wait_timeout
+        background = timeout is None
+        queue = self._background if background else self._waiters
+        start = time.monotonic()
+        with self._changed:
+            if not self._waiters and not (background and self._background) and self._fits(cost):
+                self._take(cost)
+                ADMISSION_WAIT_SECONDS.observe(0.0, outcome='admitted')
+                return 0.0
+
+            if not background and len(self._waiters) >= self.max_waiting:
+                self._stats['rejected'] += 1
+                ADMISSION_WAIT_SECONDS.observe(0.0, outcome='queue_full')
+                raise AdmissionRejectedError(
+                    f"处理预算已满且等待队列已满（{self.max_waiting}）", self._retry_after(), 'queue_full')
+
+            ticket = object()
+            queue.append(ticket)
+            self._stats['queued'] += 1
+            deadline = None if background else start + timeout
+            try:
+                while not (queue[0] is ticket and not (background and self._waiters) and self._fits(cost)):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._stats['rejected'] += 1
+                        self._stats['timeouts'] += 1
+                        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start, outcome='timeout')
+                        raise AdmissionRejectedError(
+                            f"等待处理预算超过 {timeout:g}s", self._retry_after(), 'timeout')
+                    self._changed.wait(remaining)
+                self._take(cost)
+            finally:
+                queue.remove(ticket)
+                # 队首变化后唤醒其余等待者
+                self._changed.notify_all()
+        waited = time.monotonic() - start
+        ADMISSION_WAIT_SECONDS.observe(waited, outcome='admitted')
+        return waited
+
+    def release(self, cost: RequestCost, held_seconds: Optional[float] = None):
+        """归还预算（held_seconds 为占用时长，用于估计Retry-After）"""
+        with self._changed:
+            self._pixels -= cost.pixels
+            self._memory -= cost.memory
+            self._in_flight -= 1
+            if held_seconds is not None:
+                self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held_seconds
+            self._changed.notify_all()
+
+    def retry_after(self) -> int:
+        """建议客户端重试前等待的秒数"""
+        with self._lock:
+            return self._retry_after()
+
+    def stats(self) -> Dict:
+        """当前负载（/api/health 输出，负载均衡据此避开饱和的实例）"""
+        with self._lock:
+            utilization = max(
+                self._pixels / self.max_pixels if self.max_pixels else 0.0,
+                self._memory / self.max_memory if self.max_memory else 0.0,
+            )
+            return {
+                'in_flight': self._in_flight,
+                'pixels': self._pixels,
+                'max_pixels': self.max_pixels,
+                'memory': self._memory,
+                'max_memory': self.max_memory,
+                'waiting': len(self._waiters),
+                'max_waiting': self.max_waiting,
+                'background_waiting': len(self._background),
+                'utilization': round(utilization, 4),
+                # 有同步请求在排队即为饱和：新的同步请求需要等待或被拒绝（排队的后台任务不影响同步请求）
+                'saturated': bool(self._waiters) or utilization >= 1.0,
+                'retry_after': self._retry_after(),
+                **self._stats,
+            }
+
+    def _fits(self, cost: RequestCost) -> bool:
+        """预算是否足够（调用方需持有锁）；没有进行中的请求时总是放行"""
+        if self._in_flight == 0:
+            return True
+        if self.max_pixels and self._pixels + cost.pixels > self.max_pixels:
+            return False
+        if self.max_memory and self._memory + cost.memory > self.max_memory:
+            return False
+        return True
+
+    def _take(self, cost: RequestCost):
+        """占用预算（调用方需持有锁）"""
+        self._pixels += cost.pixels
+        self._memory += cost.memory
+        self._in_flight += 1
+        self._stats['admitted'] += 1
+
+    def _retry_after(self) -> int:
+        """按平均占用时长与排队长度估计（调用方需持有锁），1~60秒"""
+        rounds = (len(self._waiters) + 1) / max(1, self._in_flight)
+        return max(1, min(60, math.ceil(self._hold_seconds * rounds)))
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, str, int, int, str]
+
+class BackgroundCache:
+    """背景图片两级缓存：进程内LRU（按字节预算）+ 磁盘内容寻址存储"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, cache_dir: Optional[str] = None):
+        """
+        初始化背景缓存
+
+        Args:
+            max_bytes (int): 内存层字节预算，0表示禁用内存层
+            cache_dir (str): 磁盘层目录，None表示禁用磁盘层
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._entries: "OrderedDict[CacheKey, Image.Image]" = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+        logger.info(f"背景缓存初始化完成，内存预算 {max_bytes} 字节，磁盘目录 {cache_dir or '未启用'}")
+
+    @classmethod
+    def from_env(cls) -> 'BackgroundCache':
+        """根据环境变量创建缓存"""
+        max_bytes = int(os.getenv('BACKGROUND_CACHE_BYTES', 64 * 1024 * 1024))
+        cache_dir = os.getenv('BACKGROUND_CACHE_DIR', os.path.join('cache', 'backgrounds')) or None
+        return cls(max_bytes=max_bytes, cache_dir=cache_dir)
+
+    @staticmethod
+    def make_key(character_name: str, prompt: str, width: int, height: int, mode: str) -> CacheKey:
+        """构建缓存键"""
+        return (character_name, prompt, int(width), int(height), mode)
+
+    def get(self, key: CacheKey) -> Optional[Image.Image]:
+        """
+        查询缓存
+
+        Args:
+            key (CacheKey): 缓存键
+
+        Returns:
+            PIL.Image: 缓存图片的副本，未命中返回None
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return self._private_copy(image)
+
+        image = self._load_from_disk(key)
+        with self._lock:
+            if image is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+            self._store_in_memory(key, image)
+        return self._private_copy(image)
+
+    def put(self, key: CacheKey, image: Image.Image) -> Image.Image:
+        """
+        写入缓存
+
+        Args:
+            key (CacheKey): 缓存键
+            image (PIL.Image): 要缓存的图片，写入后调用方不应再修改
+
+        Returns:
+            PIL.Image: 缓存图片的副本
+        """
+        image.load()
+        with self._lock:
+            self._store_in_memory(key, image)
+        self._save_to_disk(key, image)
+        return self._private_copy(image)
+
+    def get_or_create(self, key: CacheKey, factory: Callable[[], Optional[Image.Image]]) -> Optional[Image.Image]:
+        """
+        查询缓存，未命中时调用factory生成并写入（factory返回None时不缓存）
+        """
+        image = self.get(key)
+        if image is not None:
+            return image
+
+        image = factory()
+        if image is None:
+            return None
+        return self.put(key, image)
+
+    def stats(self) -> Dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._current_bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def clear(self):
+        """清空内存层（磁盘层保留）"""
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def _store_in_memory(self, key: CacheKey, image: Image.Image):
+        """写入内存层并按字节预算淘汰（调用方需持有锁）"""
+        size = self._image_bytes(image)
+        if size > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._current_bytes -= self._image_bytes(previous)
+
+        self._entries[key] = image
+        self._current_bytes += size
+
+        while self._current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= self._image_bytes(evicted)
+            self._stats['evictions'] += 1
+
+    def _disk_path(self, key: CacheKey) -> str:
+        """根据缓存键的内容哈希计算磁盘路径"""
+        digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.png")
+
+    def _load_from_disk(self, key: CacheKey) -> Optional[Image.Image]:
+        """从磁盘层读取"""
+        if not self.cache_dir:
+            return None
+
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with Image.open(path) as image:
+                image.load()
+                return image.copy()
+        except Exception as e:
+            logger.warning(f"读取背景缓存失败: {str(e)}")
+            return None
+
+    def _save_to_disk(self, key: CacheKey, image: Image.Image):
+        """写入磁盘层（先写临时文件再原子替换）"""
+        if not self.cache_dir:
+            return
+
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(tmp_path, format='PNG')
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"写入背景缓存失败: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _image_bytes(image: Image.Image) -> int:
+        """估算图片占用的字节数"""
+        return image.width * image.height * len(image.getbands())
+
+    @staticmethod
+    def _private_copy(image: Image.Image) -> Image.Image:
+        """返回调用方独占的副本：调用方的任何原地修改都不会破坏缓存中的共享条目"""
+        return image.copy()
@@ -1,17 +1,53 @@
 import logging
 import os
-import requests
 from PIL import Image
 import io
+import time
 from typing import Optional
 
+from services.background_cache import BackgroundCache
+from services.background_pack import BackgroundAsset, BackgroundPack
+from services.inference_client import InferenceClient, InferenceError
+from services.gradient import gradient_image
+from services.metrics import BACKGROUND_SECONDS
+
 logger = logging.getLogger(__name__)
 
+# 本地回退背景主题表：色标为 (位置0~1, 起始/结束颜色)，起止相同的通道保持不变
+BACKGROUND_THEMES = {
+    # 从浅蓝到深蓝
+    'pokemon': [(0.0, (135, 206, 235)), (1.0, (235, 206, 235))],
+    # 米色，从浅到深
+    'naruto': [(0.0, (255, 248, 220)), (1.0, (205, 248, 220))],
+    # 城市夜景，从深蓝到浅蓝
+    'spiderman': [(0.0, (25, 25, 112)), (1.0, (125, 125, 112))],
+    # 哥特式，从深灰到浅灰
+    'batman': [(0.0, (47, 47, 47)), (1.0, (127, 127, 127))],
+    # 默认浅蓝色，从浅到深
+    'default': [(0.0, (240, 248, 255)), (1.0, (190, 248, 255))],
+}
+
+# 角色名关键字到主题的映射（按顺序匹配）
+CHARACTER_THEMES = [
+    ('皮卡丘', 'pokemon'),
+    ('鸣人', 'naruto'),
+    ('蜘蛛侠', 'spiderman'),
+    ('蝙蝠侠', 'batman'),
+]
+
 class BackgroundGenerator:
     """背景生成服务类"""
     
-    def __init__(self):
-        """初始化背景生成器"""
+    def __init__(self, cache: Optional[BackgroundCache] = None, client: Optional[InferenceClient] = None,
+                 packs: Optional[BackgroundPack] = None):
+        """
+        初始化背景生成器
+        
+        Args:
+            cache (BackgroundCache): 背景缓存，默认根据环境变量创建
+            client (InferenceClient): 推理API客户端，默认根据环境变量创建
+            packs (BackgroundPack): 预构建的背景资源包，默认加载 BACKGROUND_PACK_PATH（不存在时不使用）
+        """
         # 使用Hugging Face的Stable Diffusion API
         self.api_url = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
         self.api_token = os.getenv('HUGGINGFACE_API_TOKEN')
@@ -19,37 +55,84 @@ class BackgroundGenerator:
         # 如果没有API token，使用本地生成的示例背景
         self.use_local_fallback = not self.api_token
         
+        # 推理API客户端（连接池、超时、重试、相同请求合并）
+        self.client = client or InferenceClient.from_env(self.api_url, self.api_token)
+        
+        # 背景缓存（本地模式结果确定，API模式按提示词确定）
+        self.cache = cache if cache is not None else BackgroundCache.from_env()
+        
+        # 背景资源包（内存映射的mipmap金字塔，由融合器按目标尺寸取最近层级）
+        self.packs = packs if packs is not None else BackgroundPack.from_env()
+        
         logger.info(f"背景生成器初始化完成，使用{'本地回退' if self.use_local_fallback else 'Hugging Face API'}")
     
     def generate_background(self, character_name: str, width: int = 1024, height: int = 1024) -> Image.Image:
         """
         根据角色生成背景图片
         
+        资源包中有该角色的背景时从最近的金字塔层级渲染，不请求API。
+        流水线使用 packed_background 直接取资源包背景，由融合器按实际尺寸取像素。
+        
         Args:
             character_name (str): 角色名称
             width (int): 图片宽度
             height (int): 图片高度
             
         Returns:
-            PIL.Image: 生成的背景图片
+            PIL.Image: 生成的背景图片（命中缓存时为缓存条目的副本）
         """
+        # 实际执行的生成路径（都命中缓存时为空），用于按来源记录耗时
+        sources = []
+        start = time.perf_counter()
+        
+        def request_api():
+            sources.append('api')
+            return self._request_api_background(prompt, width, height)
+        
+        def generate_local():
+            sources.append('local')
+            return self._generate_local_background(character_name, width, height)
+        
         try:
-            if self.use_local_fallback:
-                return self._generate_local_background(character_name, width, height)
-            else:
-                return self._generate_api_background(character_name, width, height)
+            asset = self._packed_background(character_name)
+            if asset is not None:
+                sources.append('pack')
+                return Image.fromarray(asset.render((width, height)))
+            
+            prompt = self._build_prompt(character_name)
+            
+            if not self.use_local_fallback:
+                key = self.cache.make_key(character_name, prompt, width, height, 'api')
+                image = self.cache.get_or_create(key, request_api)
+                if image is not None:
+                    return image
+            
+            # API失败时的回退结果与本地模式一致，按本地模式缓存
+            key = self.cache.make_key(character_name, prompt, width, height, 'local')
+            return self.cache.get_or_create(key, generate_local)
                 
         except Exception as e:
             logger.error(f"背景生成失败: {str(e)}")
+            sources.append('error')
             # 返回默认背景
-            return self._generate_default_background(width, height)
+            return self._create_default_background(width, height)
+        finally:
+            source = 'fallback' if len(sources) > 1 else (sources[0] if sources else 'cache')
+            BACKGROUND_SECONDS.observe(time.perf_counter() - start, source=source)
     
     def _generate_api_background(self, character_name: str, width: int, height: int) -> Image.Image:
         """使用API生成背景"""
+        # 构建提示词
+        prompt = self._build_prompt(character_name)
+        
+        image = self._request_api_background(prompt, width, height)
+        if image is None:
+            return self._generate_local_background(character_name, width, height)
+        return image
+    
+    def _request_api_background(self, prompt: str, width: int, height: int) -> Optional[Image.Image]:
+        """请求API生成背景，失败时返回None"""
         try:
-            # 构建提示词
-            prompt = self._build_prompt(character_name)
-            
             # API请求参数
             payload = {
                 "inputs": prompt,
@@ -61,47 +144,61 @@ class BackgroundGenerator:
                 }
             }
             
-            headers = {
-                "Authorization": f"Bearer {self.api_token}",
-                "Content-Type": "application/json"
-            }
+            # 发送请求（相同提示词和尺寸的并发请求只调用一次上游）
+            image_data = self.client.post(payload, key=(prompt, width, height))
             
-            # 发送请求
-            response = requests.post(self.api_url, json=payload, headers=headers)
-            
-            if response.status_code == 200:
-                # 将响应转换为图片
-                image_data = response.content
-                image = Image.open(io.BytesIO(image_data))
-                logger.info("API背景生成成功")
-                return image
-            else:
-                logger.warning(f"API请求失败: {response.status_code}")
-                return self._generate_local_background(character_name, width, height)
+            # 将响应转换为图片
+            image = Image.open(io.BytesIO(image_data))
+            image.load()
+            logger.info("API背景生成成功")
+            return image
                 
+        except InferenceError as e:
+            logger.warning(str(e))
+            return None
         except Exception as e:
             logger.error(f"API背景生成失败: {str(e)}")
-            return self._generate_local_background(character_name, width, height)
+            return None
     
     def _generate_local_background(self, character_name: str, width: int, height: int) -> Image.Image:
         """生成本地背景（回退方案）"""
         try:
             # 根据角色生成不同的背景
-            if '皮卡丘' in character_name:
-                return self._create_pokemon_background(width, height)
-            elif '鸣人' in character_name:
-                return self._create_naruto_background(width, height)
-            elif '蜘蛛侠' in character_name:
-                return self._create_spiderman_background(width, height)
-            elif '蝙蝠侠' in character_name:
-                return self._create_batman_background(width, height)
-            else:
-                return self._create_default_background(width, height)
+            return self._render_theme(self._theme_for(character_name), width, height)
                 
         except Exception as e:
             logger.error(f"本地背景生成失败: {str(e)}")
             return self._create_default_background(width, height)
     
+    def _theme_for(self, character_name: str) -> str:
+        """角色对应的本地背景主题"""
+        for keyword, theme_name in CHARACTER_THEMES:
+            if keyword in character_name:
+                return theme_name
+        return 'default'
+    
+    def packed_background(self, character_name: str) -> Optional[BackgroundAsset]:
+        """
+        资源包中该角色的背景（不取像素，由融合器按实际尺寸从最近的金字塔层级渲染）
+
+        Returns:
+            BackgroundAsset: 资源包背景，没有时返回None（调用方改用 generate_background）
+        """
+        start = time.perf_counter()
+        asset = self._packed_background(character_name)
+        if asset is not None:
+            BACKGROUND_SECONDS.observe(time.perf_counter() - start, source='pack')
+        return asset
+    
+    def _packed_background(self, character_name: str) -> Optional[BackgroundAsset]:
+        """资源包中的背景：先按角色名称查找，本地模式下再按主题查找（API模式不用主题渐变代替生成）"""
+        if self.packs is None:
+            return None
+        asset = self.packs.get(character_name)
+        if asset is None and self.use_local_fallback:
+            asset = self.packs.get(self._theme_for(character_name))
+        return asset
+    
     def _build_prompt(self, character_name: str) -> str:
         """构建背景生成提示词"""
         prompts = {
@@ -119,77 +216,10 @@ class BackgroundGenerator:
         
         return prompts.get(character_name, 'Fantasy landscape with magical atmosphere, high quality, detailed')
     
-    def _create_pokemon_background(self, width: int, height: int) -> Image.Image:
-        """创建皮卡丘主题背景"""
-        from PIL import ImageDraw
-        
-        # 创建渐变背景
-        image = Image.new('RGB', (width, height), (135, 206, 235))  # 天蓝色
-        draw = ImageDraw.Draw(image)
-        
-        # 添加渐变效果
-        for y in range(height):
-            color_value = int(135 + (y / height) * 100)  # 从浅蓝到深蓝
-            draw.line([(0, y), (width, y)], fill=(color_value, 206, 235))
-        
-        return image
-    
-    def _create_naruto_background(self, width: int, height: int) -> Image.Image:
-        """创建火影忍者主题背景"""
-        from PIL import ImageDraw
-        
-        # 创建日式风格背景
-        image = Image.new('RGB', (width, height), (255, 248, 220))  # 米色
-        draw = ImageDraw.Draw(image)
-        
-        # 添加渐变效果
-        for y in range(height):
-            color_value = int(255 - (y / height) * 50)  # 从浅到深
-            draw.line([(0, y), (width, y)], fill=(color_value, 248, 220))
-        
-        return image
-    
-    def _create_spiderman_background(self, width: int, height: int) -> Image.Image:
-        """创建蜘蛛侠主题背景"""
-        from PIL import ImageDraw
-        
-        # 创建城市夜景背景
-        image = Image.new('RGB', (width, height), (25, 25, 112))  # 深蓝色
-        draw = ImageDraw.Draw(image)
-        
-        # 添加渐变效果
-        for y in range(height):
-            color_value = int(25 + (y / height) * 100)  # 从深蓝到浅蓝
-            draw.line([(0, y), (width, y)], fill=(color_value, color_value, 112))
-        
-        return image
-    
-    def _create_batman_background(self, width: int, height: int) -> Image.Image:
-        """创建蝙蝠侠主题背景"""
-        from PIL import ImageDraw
-        
-        # 创建哥特式背景
-        image = Image.new('RGB', (width, height), (47, 79, 79))  # 深灰色
-        draw = ImageDraw.Draw(image)
-        
-        # 添加渐变效果
-        for y in range(height):
-            color_value = int(47 + (y / height) * 80)  # 从深灰到浅灰
-            draw.line([(0, y), (width, y)], fill=(color_value, color_value, color_value))
-        
-        return image
+    def _render_theme(self, theme: str, width: int, height: int) -> Image.Image:
+        """按主题表渲染渐变背景"""
+        return gradient_image(BACKGROUND_THEMES[theme], width, height)
     
     def _create_default_background(self, width: int, height: int) -> Image.Image:
         """创建默认背景"""
-        from PIL import ImageDraw
-        
-        # 创建简单的渐变背景
-        image = Image.new('RGB', (width, height), (240, 248, 255))  # 浅蓝色
-        draw = ImageDraw.Draw(image)
-        
-        # 添加渐变效果
-        for y in range(height):
-            color_value = int(240 - (y / height) * 50)  # 从浅到深
-            draw.line([(0, y), (width, y)], fill=(color_value, 248, 255))
-        
-        return image
+        return self._render_theme('default', width, height)
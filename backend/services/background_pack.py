@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from services.enhance import LUMA_WEIGHTS
+from services.frame import count_copy
+
+logger = logging.getLogger(__name__)
+
+# 金字塔最小层级的最长边（更小的层级对任何输出尺寸都用不上）
+MIN_LEVEL_SIZE = 64
+# 请求时统计裁剪区域均值所用层级的最长边下限（约6万像素，耗时可忽略，裁剪取整误差小于1%）
+STATS_LEVEL_SIZE = 256
+# 由主题表构建资源包时层级0的边长（上传默认缩放到 MAX_IMAGE_SIZE=2048 以内，输出不会更大）
+DEFAULT_BUILD_SIZE = 2048
+
+# 层级布局：(在像素数据中的偏移, 宽, 高)
+Level = Tuple[int, int, int]
+
+def build_pyramid(image: Image.Image) -> List[np.ndarray]:
+    """
+    构建多分辨率金字塔（mipmap）
+
+    层级0为原图，之后每级按2×2区域平均缩小一半（奇数边向上取整），直到最长边不超过 MIN_LEVEL_SIZE。
+
+    Returns:
+        List[np.ndarray]: 各层级的RGB像素 (H, W, 3)，从大到小
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    levels = [np.asarray(image)]
+    while max(image.size) > MIN_LEVEL_SIZE:
+        image = image.reduce(2)
+        levels.append(np.asarray(image))
+    return levels
+
+def cover_crop(level_size: Tuple[int, int], size: Tuple[int, int]) -> Tuple[float, Tuple[int, int, int, int]]:
+    """
+    与 ImageBlender._resize_background 相同的几何：等比缩放到完全覆盖目标尺寸后居中裁剪
+
+    Args:
+        level_size (Tuple): 源图 (宽, 高)
+        size (Tuple): 目标 (宽, 高)
+
+    Returns:
+        Tuple: (缩放比例, 源图上的裁剪框 (left, top, right, bottom))
+    """
+    width, height = level_size
+    target_width, target_height = size
+    scale = max(target_width / width, target_height / height)
+    crop_width = min(width, max(1, round(target_width / scale)))
+    crop_height = min(height, max(1, round(target_height / scale)))
+    left = (width - crop_width) // 2
+    top = (height - crop_height) // 2
+    return scale, (left, top, left + crop_width, top + crop_height)
+
+class BackgroundAsset:
+    """资源包中的一张背景：各层级为只读内存映射视图，附带预计算的平均颜色与亮度"""
+
+    def __init__(self, pack: 'BackgroundPack', key: str, levels: List[np.ndarray],
+                 mean_color: Tuple[float, float, float], brightness: float):
+        self.pack = pack
+        self.key = key
+        self.levels = levels
+        self.mean_color = tuple(mean_color)
+        # 平均亮度（0~1），与 ImageBlender._calculate_brightness 一致
+        self.brightness = brightness
+
+    def __reduce__(self):
+        # 跨进程只传递资源包路径与键，工作进程自行映射同一文件（像素经页缓存共享）
+        if self.pack.path is None:
+            raise TypeError("未保存到磁盘的资源包不能跨进程传递")
+        return open_asset, (self.pack.path, self.key)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """层级0的 (宽, 高)"""
+        height, width = self.levels[0].shape[:2]
+        return width, height
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def select_level(self, size: Tuple[int, int]) -> int:
+        """最接近目标尺寸且仍能覆盖目标（不放大）的层级；目标大于层级0时返回0"""
+        for index in range(len(self.levels) - 1, -1, -1):
+            height, width = self.levels[index].shape[:2]
+            if width >= size[0] and height >= size[1]:
+                return index
+        return 0
+
+    def render(self, size: Tuple[int, int]) -> np.ndarray:
+        """
+        按目标尺寸取背景：选最近的层级，只对裁剪区域做一次重采样
+
+        层级已按2×2平均预先滤波，与目标的比例在1~2倍之间，双线性插值即可保证质量（比区域平均更快、
+        与整图LANCZOS缩放的结果也更接近），不再对整图做LANCZOS缩放。
+
+        Args:
+            size (Tuple): 目标 (宽, 高)
+
+        Returns:
+            np.ndarray: (H, W, 3) 新分配的RGB像素（调用方独有，可原地修改）
+        """
+        import cv2
+
+        level = self.levels[self.select_level(size)]
+        _, (left, top, right, bottom) = cover_crop((level.shape[1], level.shape[0]), size)
+        region = np.asarray(level[top:bottom, left:right])
+        count_copy('background_render', size[0] * size[1] * 3)
+        return cv2.resize(region, tuple(size), interpolation=cv2.INTER_LINEAR)
+
+    def crop_means(self, size: Tuple[int, int]) -> Tuple[float, float, float]:
+        """目标尺寸下裁剪区域的各通道均值（在最长边不小于 STATS_LEVEL_SIZE 的最小层级上统计，与输出尺寸无关）"""
+        import cv2
+
+        level = next((level for level in reversed(self.levels) if max(level.shape[:2]) >= STATS_LEVEL_SIZE),
+                     self.levels[0])
+        _, (left, top, right, bottom) = cover_crop((level.shape[1], level.shape[0]), size)
+        return tuple(cv2.mean(np.asarray(level[top:bottom, left:right]))[:3])
+
+    def crop_brightness(self, size: Tuple[int, int]) -> float:
+        """目标尺寸下裁剪区域的平均亮度（0~1）"""
+        return float(np.dot(LUMA_WEIGHTS, self.crop_means(size))) / 255.0
+
+class BackgroundPack:
+    """
+    背景资源包：每张背景预先构建为mipmap金字塔
+
+    所有层级的像素顺序存放在一个 .npy 中（启动时只读内存映射，多个工作进程共享页缓存），
+    层级布局与预计算的平均颜色、亮度保存为 .json。
+    """
+
+    def __init__(self, data: np.ndarray, entries: Dict[str, Dict], path: Optional[str] = None):
+        """
+        Args:
+            data (np.ndarray): 所有层级的像素（一维uint8）
+            entries (Dict): 键 → {'levels': [(偏移, 宽, 高)], 'mean_color': [R, G, B], 'brightness': 0~1}
+            path (str): 资源包路径（不含扩展名）；内存中构建、尚未保存时为None
+        """
+        self.data = data
+        self.entries = entries
+        self.path = path
+        self._assets: Dict[str, BackgroundAsset] = {}
+        for key, entry in entries.items():
+            levels = [data[offset:offset + width * height * 3].reshape(height, width, 3)
+                      for offset, width, height in entry['levels']]
+            self._assets[key] = BackgroundAsset(self, key, levels, entry['mean_color'], entry['brightness'])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    @property
+    def keys(self) -> List[str]:
+        return list(self.entries)
+
+    @classmethod
+    def from_images(cls, images: Dict[str, Image.Image]) -> 'BackgroundPack':
+        """由背景图片构建资源包（键 → 图片）"""
+        import cv2
+
+        chunks, entries, offset = [], {}, 0
+        for key, image in images.items():
+            levels: List[Level] = []
+            pyramid = build_pyramid(image)
+            for pixels in pyramid:
+                levels.append((offset, pixels.shape[1], pixels.shape[0]))
+                chunks.append(pixels.reshape(-1))
+                offset += pixels.size
+
+            # 统计量在层级0上计算一次，请求时不再遍历像素
+            mean_color = np.array(cv2.mean(pyramid[0])[:3])
+            entries[key] = {
+                'levels': levels,
+                'mean_color': [round(float(value), 4) for value in mean_color],
+                'brightness': round(float(np.dot(LUMA_WEIGHTS, mean_color)) / 255.0, 6),
+            }
+
+        data = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+        return cls(data, entries)
+
+    @classmethod
+    def from_image_dir(cls, image_dir: str) -> 'BackgroundPack':
+        """由背景图片目录构建资源包（文件名去掉扩展名作为键，即角色名称或主题名称）"""
+        images = {}
+        for filename in sorted(os.listdir(image_dir)):
+            try:
+                with Image.open(os.path.join(image_dir, filename)) as image:
+                    images[os.path.splitext(filename)[0]] = image.convert('RGB')
+            except Exception as e:
+                logger.warning(f"跳过无法读取的背景图片 {filename}: {str(e)}")
+        return cls.from_images(images)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'BackgroundPack':
+        """
+        加载资源包
+
+        Args:
+            path (str): 资源包路径（不含扩展名）
+            mmap (bool): 以只读内存映射方式加载像素（只有实际用到的层级才会读盘）
+        """
+        with open(f"{path}.json", 'r', encoding='utf-8') as f:
+            entries = json.load(f)['entries']
+        data = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+        return cls(data, entries, path=path)
+
+    @classmethod
+    def from_env(cls) -> Optional['BackgroundPack']:
+        """加载 BACKGROUND_PACK_PATH 指定的资源包，不存在或加载失败时返回None"""
+        path = os.getenv('BACKGROUND_PACK_PATH', os.path.join('data', 'background_packs'))
+        if not path or not os.path.exists(f"{path}.npy"):
+            return None
+        try:
+            pack = cls.load(path)
+        except Exception as e:
+            logger.warning(f"加载背景资源包失败: {str(e)}")
+            return None
+        logger.info(f"背景资源包已映射: {path}（{len(pack)} 张背景）")
+        return pack
+
+    def save(self, path: str):
+        """保存资源包（path不含扩展名）"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.save(f"{path}.npy", np.ascontiguousarray(self.data, dtype=np.uint8))
+        with open(f"{path}.json", 'w', encoding='utf-8') as f:
+            json.dump({'entries': self.entries, 'min_level_size': MIN_LEVEL_SIZE}, f, ensure_ascii=False)
+        self.path = path
+
+    @property
+    def fingerprint(self) -> str:
+        """资源包内容标识（由各背景的层级布局与统计量计算，用于构建结果缓存键）"""
+        text = json.dumps(self.entries, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+    def get(self, key: str) -> Optional[BackgroundAsset]:
+        """按键取背景，不存在时返回None"""
+        return self._assets.get(key)
+
+    def stats(self) -> Dict:
+        """获取资源包统计信息"""
+        return {'path': self.path, 'assets': len(self), 'bytes': int(self.data.nbytes)}
+
+# 每个进程按路径只映射一次（进程池工作进程反序列化背景时使用）
+_open_packs: Dict[str, BackgroundPack] = {}
+_open_lock = threading.Lock()
+
+def open_asset(path: str, key: str) -> BackgroundAsset:
+    """按资源包路径与键取背景（同一路径在本进程内只加载一次）"""
+    with _open_lock:
+        pack = _open_packs.get(path)
+        if pack is None:
+            pack = _open_packs[path] = BackgroundPack.load(path)
+    asset = pack.get(key)
+    if asset is None:
+        raise KeyError(f"资源包 {path} 中没有背景: {key}")
+    return asset
+
+def main(argv: Optional[List[str]] = None):
+    """命令行：构建背景资源包（默认由本地主题表渲染，也可由背景图片目录构建）"""
+    parser = argparse.ArgumentParser(description='构建背景资源包（mipmap金字塔 + 平均颜色与亮度）')
+    parser.add_argument('output', help='资源包输出路径（不含扩展名），如 data/background_packs')
+    parser.add_argument('--images', help='背景图片目录（文件名为角色名称或主题名称），默认渲染本地主题表')
+    parser.add_argument('--size', type=int, default=DEFAULT_BUILD_SIZE, help='由主题表渲染时层级0的边长')
+    args = parser.parse_args(argv)
+
+    if args.images:
+        pack = BackgroundPack.from_image_dir(args.images)
+    else:
+        from services.background_generator import BACKGROUND_THEMES
+        from services.gradient import gradient_image
+
+        pack = BackgroundPack.from_images({
+            theme: gradient_image(stops, args.size, args.size) for theme, stops in BACKGROUND_THEMES.items()
+        })
+    pack.save(args.output)
+    print(f"已写入 {len(pack)} 张背景的资源包（{pack.data.nbytes / 2**20:.1f}MB）: "
+          f"{args.output}.npy / {args.output}.json")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageColor
+
+from services.image_io import ImageSource, load_image
+
+logger = logging.getLogger(__name__)
+
+# 特征提取的采样网格（颜色分布是统计量，稀疏采样即可）
+SAMPLE_SIZE = (128, 128)
+
+# HSV直方图：彩色像素按 色相12 × 饱和度2 × 明度2 分箱，低饱和/低明度像素按明度4级分箱
+HUE_BINS, SAT_BINS, VAL_BINS = 12, 2, 2
+GRAY_BINS = 4
+CHROMA_MIN_SATURATION = 48
+CHROMA_MIN_VALUE = 48
+FEATURE_DIM = HUE_BINS * SAT_BINS * VAL_BINS + GRAY_BINS
+# 灰度像素的统计权重：照片中大面积的白墙、灰色背景不应压过服装颜色
+ACHROMATIC_WEIGHT = 0.25
+
+# 相似度转置信度的softmax温度
+CONFIDENCE_TEMPERATURE = 0.05
+
+# 色相分箱（每30°一个）与灰度分箱对应的颜色名称
+HUE_NAMES = ['red', 'orange', 'yellow', 'yellow-green', 'green', 'spring-green', 'cyan', 'azure',
+             'blue', 'purple', 'magenta', 'pink']
+GRAY_NAMES = ['black', 'dark-gray', 'light-gray', 'white']
+
+def color_histogram(image: ImageSource) -> np.ndarray:
+    """
+    计算图片的HSV颜色直方图（灰度像素降权，归一化为总和1）
+
+    Args:
+        image (ImageSource): 输入图片
+
+    Returns:
+        np.ndarray: 长度为FEATURE_DIM的float32直方图
+    """
+    image = load_image(image)
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA')
+
+    # 最近邻采样只读取网格点上的像素，特征提取耗时与原图尺寸无关
+    thumbnail = image.resize(SAMPLE_SIZE, Image.Resampling.NEAREST)
+    hsv = np.asarray(thumbnail.convert('RGB').convert('HSV')).reshape(-1, 3)
+
+    # 透明像素（抠图后的背景）不参与统计
+    if thumbnail.mode == 'RGBA':
+        hsv = hsv[np.asarray(thumbnail.getchannel('A')).reshape(-1) >= 128]
+
+    hue = hsv[:, 0].astype(np.intp)
+    saturation = hsv[:, 1]
+    value = hsv[:, 2]
+
+    chromatic = (saturation >= CHROMA_MIN_SATURATION) & (value >= CHROMA_MIN_VALUE)
+    # 色相半格偏移，使红色（0°附近）落在同一个分箱
+    hue_bin = ((hue * HUE_BINS + 128) >> 8) % HUE_BINS
+    sat_bin = (saturation.astype(np.intp) * SAT_BINS) >> 8
+    val_bin = (value.astype(np.intp) * VAL_BINS) >> 8
+    chroma_index = (hue_bin * SAT_BINS + sat_bin) * VAL_BINS + val_bin
+    gray_index = HUE_BINS * SAT_BINS * VAL_BINS + ((value.astype(np.intp) * GRAY_BINS) >> 8)
+
+    index = np.where(chromatic, chroma_index, gray_index)
+    weights = np.where(chromatic, 1.0, ACHROMATIC_WEIGHT)
+    histogram = np.bincount(index, weights=weights, minlength=FEATURE_DIM).astype(np.float32)
+    total = histogram.sum()
+    if total > 0:
+        histogram /= total
+    return histogram
+
+def histogram_feature(histogram: np.ndarray) -> np.ndarray:
+    """
+    将直方图转换为检索特征：开方后L2归一化
+
+    两个特征的点积即两个直方图的Bhattacharyya系数。
+    """
+    feature = np.sqrt(np.asarray(histogram, dtype=np.float32))
+    norm = np.linalg.norm(feature, axis=-1, keepdims=True)
+    return feature / np.maximum(norm, 1e-12)
+
+def extract_features(image: ImageSource) -> np.ndarray:
+    """提取图片的检索特征向量"""
+    return histogram_feature(color_histogram(image))
+
+def dominant_colors(histogram: np.ndarray, top: int = 3) -> List[Dict]:
+    """
+    从颜色直方图中取占比最高的颜色簇
+
+    Returns:
+        List[Dict]: [{'color': 颜色名称, 'ratio': 占比}]，按占比降序
+    """
+    # 按颜色名称合并分箱（同一色相的不同饱和度/明度视为一簇）
+    names = [HUE_NAMES[i // (SAT_BINS * VAL_BINS)] for i in range(HUE_BINS * SAT_BINS * VAL_BINS)] + GRAY_NAMES
+    clusters: Dict[str, float] = {}
+    for name, ratio in zip(names, histogram.tolist()):
+        clusters[name] = clusters.get(name, 0.0) + ratio
+
+    ranked = sorted(clusters.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{'color': name, 'ratio': round(ratio, 4)} for name, ratio in ranked if ratio > 0]
+
+def palette_histogram(palette: Sequence[Tuple[str, float]]) -> np.ndarray:
+    """
+    根据代表色及其占比生成参考直方图（没有参考图片时用于构建索引）
+
+    Args:
+        palette (Sequence): [(十六进制颜色, 占比)]
+    """
+    width, height = SAMPLE_SIZE
+    weights = np.array([weight for _, weight in palette], dtype=np.float64)
+    counts = np.floor(weights / weights.sum() * width * height).astype(int)
+    counts[np.argmax(counts)] += width * height - counts.sum()
+
+    colors = np.array([ImageColor.getrgb(color) for color, _ in palette], dtype=np.uint8)
+    pixels = np.repeat(colors, counts, axis=0)
+    return color_histogram(Image.fromarray(pixels.reshape(height, width, 3)))
+
+class CharacterIndex:
+    """角色参考特征索引：特征矩阵保存为 .npy（启动时内存映射），角色键保存为 .json"""
+
+    def __init__(self, keys: List[str], features: np.ndarray):
+        """
+        初始化索引
+
+        Args:
+            keys (List[str]): 角色键，与特征矩阵的行一一对应
+            features (np.ndarray): (N, FEATURE_DIM) 已归一化的float32特征矩阵
+        """
+        if features.ndim != 2 or features.shape[0] != len(keys):
+            raise ValueError(f"特征矩阵形状 {features.shape} 与角色数量 {len(keys)} 不匹配")
+
+        self.keys = list(keys)
+        self.features = features
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_histograms(cls, histograms: Dict[str, np.ndarray]) -> 'CharacterIndex':
+        """由各角色的参考直方图构建索引"""
+        keys = list(histograms)
+        if not keys:
+            return cls([], np.zeros((0, FEATURE_DIM), dtype=np.float32))
+        features = histogram_feature(np.stack([histograms[key] for key in keys]))
+        return cls(keys, np.ascontiguousarray(features, dtype=np.float32))
+
+    @classmethod
+    def from_reference_dir(cls, reference_dir: str) -> 'CharacterIndex':
+        """
+        由参考图片目录构建索引（每个子目录为一个角色，特征取该角色所有图片直方图的平均）
+
+        Args:
+            reference_dir (str): 参考图片根目录
+        """
+        histograms = {}
+        for key in sorted(os.listdir(reference_dir)):
+            directory = os.path.join(reference_dir, key)
+            if not os.path.isdir(directory):
+                continue
+
+            samples = []
+            for filename in sorted(os.listdir(directory)):
+                try:
+                    samples.append(color_histogram(os.path.join(directory, filename)))
+                except Exception as e:
+                    logger.warning(f"跳过无法读取的参考图片 {filename}: {str(e)}")
+            if samples:
+                histograms[key] = np.mean(samples, axis=0)
+
+        return cls.from_histograms(histograms)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'CharacterIndex':
+        """
+        加载索引
+
+        Args:
+            path (str): 索引路径（不含扩展名）
+            mmap (bool): 以只读内存映射方式加载特征矩阵（多进程共享页缓存，启动几乎不读盘）
+        """
+        with open(f"{path}.json", 'r', encoding='utf-8') as f:
+            keys = json.load(f)['keys']
+        features = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+        return cls(keys, features)
+
+    def save(self, path: str):
+        """保存索引（path不含扩展名）"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.save(f"{path}.npy", np.ascontiguousarray(self.features, dtype=np.float32))
+        with open(f"{path}.json", 'w', encoding='utf-8') as f:
+            json.dump({'keys': self.keys, 'feature_dim': FEATURE_DIM}, f, ensure_ascii=False)
+
+    def search(self, feature: np.ndarray, k: int = 5) -> List[Dict]:
+        """
+        一次矩阵运算计算与所有角色的相似度，返回前k个
+
+        Args:
+            feature (np.ndarray): 查询特征
+            k (int): 返回数量
+
+        Returns:
+            List[Dict]: [{'key', 'score': 相似度, 'confidence': 全体softmax概率}]，按相似度降序
+        """
+        if not self.keys:
+            return []
+
+        scores = self.features @ feature
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        weights = np.exp((scores - scores[top[0]]) / CONFIDENCE_TEMPERATURE)
+        confidences = weights[top] / weights.sum()
+
+        return [
+            {'key': self.keys[i], 'score': float(scores[i]), 'confidence': float(confidence)}
+            for i, confidence in zip(top, confidences)
+        ]
+
+def main(argv: Optional[List[str]] = None):
+    """命令行：由参考图片目录构建索引"""
+    parser = argparse.ArgumentParser(description='构建角色参考特征索引')
+    parser.add_argument('reference_dir', help='参考图片根目录（每个子目录为一个角色）')
+    parser.add_argument('output', help='索引输出路径（不含扩展名），如 data/character_index')
+    args = parser.parse_args(argv)
+
+    index = CharacterIndex.from_reference_dir(args.reference_dir)
+    index.save(args.output)
+    print(f"已写入 {len(index)} 个角色的索引: {args.output}.npy / {args.output}.json")
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,128 @@
 import logging
-import random
-from typing import List, Dict
+import os
+from typing import List, Dict, Optional
+
+from services.character_index import CharacterIndex, color_histogram, dominant_colors, histogram_feature, palette_histogram
+from services.image_io import ImageSource
 
 logger = logging.getLogger(__name__)
 
 class CharacterRecognizer:
     """角色识别服务类"""
     
-    def __init__(self):
-        """初始化角色识别器"""
-        # MVP版本使用预设角色列表
+    def __init__(self, index: Optional[CharacterIndex] = None):
+        """
+        初始化角色识别器
+
+        Args:
+            index (CharacterIndex): 角色参考特征索引，默认加载 CHARACTER_INDEX_PATH（内存映射），
+                不存在时由内置角色的代表色构建
+        """
+        # 内置角色信息（名称、背景提示词、代表色）
         self.supported_characters = {
             'pikachu': {
                 'name': '皮卡丘',
                 'keywords': ['pokemon', 'electric', 'yellow', 'cute', 'anime'],
-                'background_prompt': 'A magical Pokemon forest with electric sparks, cherry blossoms, and mystical atmosphere, anime style, high quality'
+                'background_prompt': 'A magical Pokemon forest with electric sparks, cherry blossoms, and mystical atmosphere, anime style, high quality',
+                # 代表色及占比：没有参考图片索引时据此构建内置索引
+                'palette': [('#F8D030', 0.6), ('#202020', 0.15), ('#E03020', 0.1), ('#A06030', 0.15)]
             },
             'naruto': {
                 'name': '鸣人',
                 'keywords': ['naruto', 'ninja', 'orange', 'anime', 'manga'],
-                'background_prompt': 'Hidden Leaf Village with traditional Japanese architecture, cherry blossoms, ninja scrolls, anime style, detailed'
+                'background_prompt': 'Hidden Leaf Village with traditional Japanese architecture, cherry blossoms, ninja scrolls, anime style, detailed',
+                'palette': [('#F08020', 0.55), ('#202020', 0.2), ('#2040A0', 0.1), ('#F8D850', 0.15)]
             },
             'goku': {
                 'name': '孙悟空',
                 'keywords': ['dragon ball', 'saiyan', 'orange', 'anime', 'fighting'],
-                'background_prompt': 'Dragon Ball world with floating islands, energy orbs, mystical mountains, anime style, epic'
+                'background_prompt': 'Dragon Ball world with floating islands, energy orbs, mystical mountains, anime style, epic',
+                'palette': [('#F07820', 0.5), ('#2050B0', 0.2), ('#181818', 0.2), ('#F0C8A0', 0.1)]
             },
             'spiderman': {
                 'name': '蜘蛛侠',
                 'keywords': ['spiderman', 'superhero', 'red', 'blue', 'comic'],
-                'background_prompt': 'New York City skyline at sunset, skyscrapers, web-swinging perspective, comic book style, dynamic'
+                'background_prompt': 'New York City skyline at sunset, skyscrapers, web-swinging perspective, comic book style, dynamic',
+                'palette': [('#C81E28', 0.55), ('#1E3C96', 0.35), ('#141414', 0.1)]
             },
             'batman': {
                 'name': '蝙蝠侠',
                 'keywords': ['batman', 'dark knight', 'black', 'superhero', 'gothic'],
-                'background_prompt': 'Gothic Gotham City at night, dark alleys, bat signal in sky, noir atmosphere, cinematic'
+                'background_prompt': 'Gothic Gotham City at night, dark alleys, bat signal in sky, noir atmosphere, cinematic',
+                'palette': [('#141414', 0.6), ('#505050', 0.25), ('#E8C020', 0.05), ('#F0C8A0', 0.1)]
             },
             'superman': {
                 'name': '超人',
                 'keywords': ['superman', 'superhero', 'blue', 'red', 'flying'],
-                'background_prompt': 'Metropolis cityscape with flying perspective, clouds, heroic atmosphere, comic book style'
+                'background_prompt': 'Metropolis cityscape with flying perspective, clouds, heroic atmosphere, comic book style',
+                'palette': [('#1E50C8', 0.55), ('#D01E1E', 0.35), ('#F0D020', 0.1)]
             },
             'mickey_mouse': {
                 'name': '米老鼠',
                 'keywords': ['disney', 'mickey', 'cartoon', 'classic', 'magical'],
-                'background_prompt': 'Disney magical kingdom with castle, fireworks, fairy tale atmosphere, cartoon style, colorful'
+                'background_prompt': 'Disney magical kingdom with castle, fireworks, fairy tale atmosphere, cartoon style, colorful',
+                'palette': [('#141414', 0.45), ('#D01E1E', 0.3), ('#F0C030', 0.1), ('#F8F8F8', 0.15)]
             },
             'elsa': {
                 'name': '艾莎',
                 'keywords': ['frozen', 'ice queen', 'blue', 'magical', 'disney'],
-                'background_prompt': 'Frozen ice palace with snowflakes, aurora borealis, magical ice crystals, Disney style, enchanting'
+                'background_prompt': 'Frozen ice palace with snowflakes, aurora borealis, magical ice crystals, Disney style, enchanting',
+                'palette': [('#A0D0F0', 0.5), ('#F8F8F8', 0.2), ('#F0E8C8', 0.2), ('#8070C0', 0.1)]
             },
             'iron_man': {
                 'name': '钢铁侠',
                 'keywords': ['iron man', 'marvel', 'red', 'gold', 'technology'],
-                'background_prompt': 'Stark Tower with futuristic technology, holographic displays, city skyline, sci-fi atmosphere'
+                'background_prompt': 'Stark Tower with futuristic technology, holographic displays, city skyline, sci-fi atmosphere',
+                'palette': [('#B41E1E', 0.55), ('#E0B030', 0.35), ('#909090', 0.1)]
             },
             'captain_america': {
                 'name': '美国队长',
                 'keywords': ['captain america', 'marvel', 'patriotic', 'shield', 'heroic'],
-                'background_prompt': 'Patriotic battlefield with American flag, heroic atmosphere, comic book style, dynamic action'
+                'background_prompt': 'Patriotic battlefield with American flag, heroic atmosphere, comic book style, dynamic action',
+                'palette': [('#1E3C8C', 0.5), ('#C8281E', 0.2), ('#F8F8F8', 0.2), ('#A0A0A0', 0.1)]
             }
         }
         
-        logger.info(f"角色识别器初始化完成，支持 {len(self.supported_characters)} 个角色")
+        self.index = index if index is not None else self._load_index()
+
+        logger.info(f"角色识别器初始化完成，支持 {len(self.supported_characters)} 个角色，索引 {len(self.index)} 条")
     
-    def recognize_character(self, image_path: str) -> str:
+    def recognize_character(self, image: ImageSource) -> str:
         """
-        识别图片中的角色（MVP版本使用随机选择）
+        识别图片中的角色（颜色特征最近邻）
         
         Args:
-            image_path (str): 图片路径
+            image (ImageSource): 输入图片（路径、字节数据、文件对象、PIL图片或numpy数组）
             
         Returns:
             str: 识别到的角色名称
         """
         try:
-            # MVP版本：随机选择一个角色
-            # 在实际实现中，这里会使用AI模型进行真正的角色识别
-            character_key = random.choice(list(self.supported_characters.keys()))
-            character_name = self.supported_characters[character_key]['name']
-            
-            logger.info(f"识别到角色: {character_name}")
+            candidates = self.recognize(image, k=1)
+            if not candidates:
+                return '皮卡丘'
+
+            character_name = candidates[0]['name']
+            logger.info(f"识别到角色: {character_name}（置信度 {candidates[0]['confidence']:.2f}）")
             return character_name
             
         except Exception as e:
             logger.error(f"角色识别失败: {str(e)}")
             # 返回默认角色
             return '皮卡丘'
+
+    def recognize(self, image: ImageSource, k: int = 3) -> List[Dict]:
+        """
+        返回最相似的k个角色
+
+        Args:
+            image (ImageSource): 输入图片
+            k (int): 候选数量
+
+        Returns:
+            List[Dict]: [{'key', 'name', 'score': 相似度, 'confidence': 置信度}]，按相似度降序
+        """
+        return self._search(color_histogram(image), k)
     
     def get_character_info(self, character_name: str) -> Dict:
         """
@@ -128,21 +163,41 @@ class CharacterRecognizer:
         character_info = self.get_character_info(character_name)
         return character_info['background_prompt']
     
-    def analyze_image_features(self, image_path: str) -> Dict:
+    def analyze_image_features(self, image: ImageSource) -> Dict:
         """
-        分析图片特征（为将来的AI识别做准备）
+        分析图片特征
         
         Args:
-            image_path (str): 图片路径
+            image (ImageSource): 输入图片（路径、字节数据、文件对象、PIL图片或numpy数组）
             
         Returns:
-            Dict: 图片特征分析结果
+            Dict: {'dominant_colors': 主要颜色及占比, 'candidates': 候选角色, 'confidence': 最佳候选的置信度}
         """
-        # 这里可以添加图片特征分析逻辑
-        # 例如：颜色分析、形状检测、纹理分析等
+        histogram = color_histogram(image)
+        candidates = self._search(histogram, 3)
         return {
-            'dominant_colors': ['yellow', 'red', 'blue'],
-            'detected_objects': ['person', 'costume'],
-            'style': 'anime',
-            'confidence': 0.85
+            'dominant_colors': dominant_colors(histogram),
+            'candidates': candidates,
+            'confidence': candidates[0]['confidence'] if candidates else 0.0
         }
+
+    def _search(self, histogram, k: int) -> List[Dict]:
+        """在索引中检索，并附上角色名称（索引中不在内置列表的角色以键作为名称）"""
+        candidates = self.index.search(histogram_feature(histogram), k)
+        for candidate in candidates:
+            info = self.supported_characters.get(candidate['key'])
+            candidate['name'] = info['name'] if info else candidate['key']
+        return candidates
+
+    def _load_index(self) -> CharacterIndex:
+        """加载预构建索引，不存在时由内置角色的代表色构建"""
+        path = os.getenv('CHARACTER_INDEX_PATH', os.path.join('data', 'character_index'))
+        if path and os.path.exists(f"{path}.npy"):
+            try:
+                return CharacterIndex.load(path)
+            except Exception as e:
+                logger.warning(f"加载角色索引失败，使用内置索引: {str(e)}")
+
+        return CharacterIndex.from_histograms({
+            key: palette_histogram(info['palette']) for key, info in self.supported_characters.items()
+        })
@@ -0,0 +1,59 @@
+import numpy as np
+from typing import Optional
+
+# 条带处理的行数（uint16中间结果在4K宽度下约1.5MB）
+STRIP_ROWS = 64
+
+def composite_over(foreground: np.ndarray, background: np.ndarray,
+                   out: Optional[np.ndarray] = None, strip_rows: int = STRIP_ROWS) -> np.ndarray:
+    """
+    整帧预乘alpha合成（前景 over 背景）
+
+    使用uint16整数运算完成 fg*a + bg*(255-a)，再精确地除以255，
+    结果与逐像素浮点融合一致（截断取整），不分配float32中间结果。
+    按行条带处理，uint16中间结果只占一个条带大小。
+
+    Args:
+        foreground (np.ndarray): 前景像素，形状 (H, W, 4)，uint8 RGBA
+        background (np.ndarray): 背景像素，形状 (H, W, 3)，uint8 RGB
+        out (np.ndarray): 可选的输出缓冲区，形状 (H, W, 3)，uint8；
+            可以直接传入background实现原地合成
+        strip_rows (int): 每个条带的行数
+
+    Returns:
+        np.ndarray: 融合后的像素，形状 (H, W, 3)，uint8
+    """
+    if foreground.ndim != 3 or foreground.shape[2] != 4:
+        raise ValueError(f"前景必须是RGBA数组，实际形状: {foreground.shape}")
+    if background.shape != foreground.shape[:2] + (3,):
+        raise ValueError(f"前景与背景尺寸不一致: {foreground.shape} vs {background.shape}")
+
+    if out is None:
+        out = np.empty(background.shape, dtype=np.uint8)
+
+    height, width = background.shape[:2]
+    rows = max(1, min(strip_rows, height))
+    work_strip = np.empty((rows, width, 3), dtype=np.uint16)
+    scratch_strip = np.empty((rows, width, 3), dtype=np.uint16)
+
+    for y0 in range(0, height, rows):
+        y1 = min(height, y0 + rows)
+        work, scratch = work_strip[:y1 - y0], scratch_strip[:y1 - y0]
+
+        alpha = foreground[y0:y1, :, 3:4]
+        inv_alpha = 255 - alpha
+
+        # 预乘前景 fg*a，再累加背景贡献 bg*(255-a)
+        np.multiply(foreground[y0:y1, :, :3], alpha, out=work, dtype=np.uint16)
+        np.multiply(background[y0:y1], inv_alpha, out=scratch, dtype=np.uint16)
+        work += scratch
+
+        # 精确整除255: (x + 1 + (x >> 8)) >> 8 == x // 255，对 0..65025 成立
+        np.right_shift(work, 8, out=scratch)
+        scratch += 1
+        work += scratch
+        work >>= 8
+
+        np.copyto(out[y0:y1], work, casting='unsafe')
+
+    return out
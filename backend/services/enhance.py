@@ -0,0 +1,161 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+# 条带处理的行数（两个条带缓冲区在4K宽度下约2MB，可留在缓存中）
+STRIP_ROWS = 64
+
+# 与 PIL convert('L') 相同的亮度权重（ITU-R 601-2）
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+def blur_halo(radius: float = 1.0) -> int:
+    """高斯模糊（锐化）的影响范围（像素），核大小为 2*halo+1"""
+    return int(math.ceil(3 * radius))
+
+def mean_luminance(pixels: np.ndarray) -> float:
+    """
+    计算平均亮度（0~255），等价于 convert('L') 后取均值
+
+    亮度是通道的线性组合，先对各通道求均值再加权，不分配灰度图。
+    """
+    import cv2
+
+    means = cv2.mean(pixels)
+    return float(np.dot(LUMA_WEIGHTS, means[:3]))
+
+def color_matrix(brightness: float = 1.0, contrast: float = 1.0, saturation: float = 1.0,
+                 contrast_mean: float = 0.0, channels: int = 3) -> np.ndarray:
+    """
+    构建与 ImageEnhance 链 Brightness → Contrast → Color 等效的仿射颜色矩阵
+
+    三步都是逐像素线性变换：x1 = b·x，x2 = c·x1 + m·(1-c)，x3 = s·x2 + (1-s)·L(x2)，
+    可合并为 x3 = c·b·S·x + m·(1-c)，其中 S 为饱和度矩阵（常数灰色经过S不变）。
+    PIL每一步都截断取整（平均偏低约0.5），偏移项中按步骤补偿，使取整偏差与逐步处理一致；
+    合并后省去中间结果的饱和截断，与逐步处理只在高光饱和处有少量差异。
+
+    Args:
+        brightness (float): 亮度系数
+        contrast (float): 对比度系数
+        saturation (float): 饱和度系数
+        contrast_mean (float): 对比度的中心灰度（PIL取亮度调整后图片的平均亮度）
+        channels (int): 3 为RGB；4 为RGBA（alpha原样保留）
+
+    Returns:
+        np.ndarray: 形状 (channels, channels+1) 的float32矩阵，可直接用于 cv2.transform
+    """
+    saturation_matrix = saturation * np.eye(3) + (1.0 - saturation) * np.outer(np.ones(3), LUMA_WEIGHTS)
+
+    # 逐步累积截断偏差：后续的对比度缩放会放大前面的偏差，饱和度矩阵保持常数不变
+    rounding = 0.0
+    if brightness != 1.0:
+        rounding -= 0.5
+    if contrast != 1.0:
+        rounding = rounding * contrast - 0.5
+    if saturation != 1.0:
+        rounding -= 0.5
+
+    matrix = np.zeros((channels, channels + 1), dtype=np.float64)
+    matrix[:3, :3] = contrast * brightness * saturation_matrix
+    matrix[:3, channels] = contrast_mean * (1.0 - contrast) + rounding
+    if channels == 4:
+        matrix[3, 3] = 1.0
+    return matrix.astype(np.float32)
+
+def enhance_pixels(pixels: np.ndarray, matrix: np.ndarray, percent: int, threshold: int,
+                   radius: float = 1.0, out: Optional[np.ndarray] = None,
+                   scratch: Optional['EnhanceScratch'] = None, strip_rows: int = STRIP_ROWS) -> np.ndarray:
+    """
+    单遍融合增强：仿射颜色变换 + 一次USM锐化
+
+    等价于 ImageEnhance 调整后再 filter(ImageFilter.UnsharpMask(radius, percent, threshold))：
+    与模糊图差值的绝对值不小于threshold的像素按 x + (x - blur)·percent/100 锐化，其余保持不变。
+    与PIL一致，锐化作用于所有通道（含alpha）。
+
+    按行条带处理（条带上下各多取模糊半径的行），中间结果只占两个条带大小的缓冲区，
+    除输出外不分配整帧内存。
+
+    Args:
+        pixels (np.ndarray): 输入像素，(H, W, 3|4) uint8，不会被修改
+        matrix (np.ndarray): color_matrix 构建的颜色矩阵
+        percent (int): 锐化强度（百分比）
+        threshold (int): 锐化阈值
+        radius (float): 高斯模糊半径
+        out (np.ndarray): 可选的输出缓冲区，形状同pixels（不能与pixels相同）
+        scratch (EnhanceScratch): 可复用的条带缓冲区，默认临时分配
+        strip_rows (int): 每个条带的行数
+
+    Returns:
+        np.ndarray: 增强后的像素，uint8
+    """
+    import cv2
+
+    if pixels.ndim != 3 or pixels.shape[2] not in (3, 4) or pixels.dtype != np.uint8:
+        raise ValueError(f"输入必须是RGB/RGBA的uint8数组，实际: {pixels.shape} {pixels.dtype}")
+    if matrix.shape != (pixels.shape[2], pixels.shape[2] + 1):
+        raise ValueError(f"颜色矩阵形状 {matrix.shape} 与通道数 {pixels.shape[2]} 不匹配")
+
+    if out is None:
+        out = np.empty_like(pixels)
+    pixels = np.ascontiguousarray(pixels)
+
+    height = pixels.shape[0]
+    halo = blur_halo(radius)
+    ksize = (2 * halo + 1, 2 * halo + 1)
+    amount = percent / 100.0
+    colored_strip, blurred_strip = (scratch or EnhanceScratch()).get((strip_rows + 2 * halo,) + pixels.shape[1:])
+
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        top, bottom = max(0, y0 - halo), min(height, y1 + halo)
+        colored = colored_strip[:bottom - top]
+        blurred = blurred_strip[:bottom - top]
+
+        # 1. 亮度/对比度/饱和度：一次仿射变换（饱和到0~255）
+        cv2.transform(pixels[top:bottom], matrix, dst=colored)
+        # 条带边缘的模糊结果不准确，只落在上下多取的行内，不写入输出
+        cv2.GaussianBlur(colored, ksize, radius, dst=blurred)
+
+        rows = slice(y0 - top, y1 - top)
+        colored, blurred, target = colored[rows], blurred[rows], out[y0:y1]
+
+        # 2. USM锐化：target = colored + k·(colored - blur)
+        cv2.addWeighted(colored, 1.0 + amount, blurred, -amount, 0.0, dst=target)
+
+        # 3. 差值小于阈值的像素保持原值：keep为0/255掩码，
+        #    min(target | keep, colored | ~keep) 在keep处取colored，其余取target（全部原地完成）
+        cv2.absdiff(colored, blurred, dst=blurred)
+        cv2.compare(blurred, threshold, cv2.CMP_LT, dst=blurred)
+        cv2.bitwise_or(target, blurred, dst=target)
+        cv2.bitwise_not(blurred, dst=blurred)
+        cv2.bitwise_or(colored, blurred, dst=blurred)
+        cv2.min(target, blurred, dst=target)
+
+    return out
+
+class EnhanceScratch:
+    """增强内核的条带缓冲区（每个线程按尺寸复用，最多保留max_shapes种尺寸）"""
+
+    def __init__(self, max_shapes: int = 2):
+        """
+        Args:
+            max_shapes (int): 每个线程保留的尺寸种数（前景RGBA与合成后的RGB各一种）
+        """
+        self.max_shapes = max_shapes
+        self._local = threading.local()
+
+    def get(self, shape: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """获取当前线程对应尺寸的两块条带缓冲区"""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = OrderedDict()
+
+        pair = buffers.get(shape)
+        if pair is None:
+            pair = buffers[shape] = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8))
+            while len(buffers) > self.max_shapes:
+                buffers.popitem(last=False)
+        buffers.move_to_end(shape)
+        return pair
@@ -0,0 +1,160 @@
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageStat
+
+# PIL可以直接映射numpy内存（不拷贝）的模式：PIL内部每像素1或4字节，与数组布局相同；
+# RGB在PIL内部按4字节存储，与(H, W, 3)数组之间的转换总要拷贝
+ZERO_COPY_MODES = ('L', 'RGBA')
+# 数组通道数 → 模式
+CHANNEL_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+# 当前请求的拷贝计量器（由 metering 设置，流水线阶段线程通过上下文复制继承）
+_current_meter: contextvars.ContextVar = contextvars.ContextVar('frame_copy_meter', default=None)
+
+@contextmanager
+def metering(meter) -> Iterator[None]:
+    """在代码块内把整帧拷贝记入meter（CopyMeter）"""
+    token = _current_meter.set(meter)
+    try:
+        yield
+    finally:
+        _current_meter.reset(token)
+
+def count_copy(label: str, nbytes: int):
+    """记录一次整帧拷贝（没有进行中的请求时忽略）"""
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.add_frame(label, nbytes)
+
+class Frame:
+    """
+    服务间传递的像素帧：以numpy数组为像素存储，带模式信息，PIL视图按需创建
+
+    由PIL图片包装时先不转换，第一次访问array时才拷贝；由数组创建时，L/RGBA的PIL视图直接映射
+    数组内存，RGB需要拷贝一次。两种表示创建后都缓存在帧上，同一帧不会重复转换。
+    所有转换拷贝都通过 count_copy 记入当前请求的整帧拷贝计数。
+
+    PIL视图与数组共享内存时，修改数组会反映到视图上；服务不修改输入帧，
+    需要原地修改时用 writable_array 取得自己的缓冲区。
+    """
+
+    __slots__ = ('_array', '_image', 'mode')
+
+    def __init__(self, array: Optional[np.ndarray] = None, mode: Optional[str] = None,
+                 image: Optional[Image.Image] = None):
+        """
+        Args:
+            array (np.ndarray): 像素数组，(H, W) / (H, W, 3) / (H, W, 4) uint8
+            mode (str): 模式（L / RGB / RGBA），默认按数组通道数或PIL图片推断
+            image (PIL.Image): PIL图片（与array至少提供一个）
+        """
+        if array is None and image is None:
+            raise ValueError("Frame需要像素数组或PIL图片")
+        self._array = array
+        self._image = image
+        if mode is None:
+            if image is not None:
+                mode = image.mode
+            else:
+                mode = CHANNEL_MODES[1 if array.ndim == 2 else array.shape[2]]
+        self.mode = mode
+
+    @classmethod
+    def wrap(cls, source: Union['Frame', Image.Image, np.ndarray]) -> 'Frame':
+        """包装为帧（帧原样返回，PIL图片与数组都不拷贝）"""
+        if isinstance(source, Frame):
+            return source
+        if isinstance(source, Image.Image):
+            return cls(image=source)
+        if isinstance(source, np.ndarray):
+            return cls(array=source)
+        raise TypeError(f"不支持的帧来源: {type(source).__name__}")
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(宽, 高)，与PIL一致"""
+        if self._image is not None:
+            return self._image.size
+        return self._array.shape[1], self._array.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def channels(self) -> int:
+        return len(self.mode)
+
+    @property
+    def nbytes(self) -> int:
+        """像素数据的字节数（按数组布局）"""
+        width, height = self.size
+        return width * height * self.channels
+
+    @property
+    def array(self) -> np.ndarray:
+        """像素数组（由PIL图片创建时拷贝一次，结果只读）"""
+        if self._array is None:
+            count_copy('frame_to_array', self.nbytes)
+            self._array = np.asarray(self._image)
+        return self._array
+
+    @property
+    def image(self) -> Image.Image:
+        """PIL视图（L/RGBA直接映射数组内存，只读；RGB拷贝一次）"""
+        if self._image is None:
+            array = self._array
+            if self.mode in ZERO_COPY_MODES and array.flags.c_contiguous:
+                self._image = Image.frombuffer(self.mode, self.size, array, 'raw', self.mode, 0, 1)
+            else:
+                count_copy('frame_to_image', self.nbytes)
+                self._image = Image.fromarray(array)
+        return self._image
+
+    def region(self, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """
+        裁剪区域的像素
+
+        Args:
+            box (Tuple): (left, top, right, bottom)
+
+        Returns:
+            np.ndarray: 已有数组时为视图（不拷贝），否则只拷贝该区域
+        """
+        left, top, right, bottom = box
+        if self._array is not None:
+            return self._array[top:bottom, left:right]
+        return np.asarray(self._image.crop(box))
+
+    def writable_array(self, label: str) -> np.ndarray:
+        """可原地修改的像素数组：始终是新拷贝（输入帧可能被缓存或其他阶段共享），记入整帧拷贝"""
+        count_copy(label, self.nbytes)
+        if self._array is not None:
+            return np.array(self._array)
+        return np.array(self._image)
+
+    def convert(self, mode: str) -> 'Frame':
+        """模式转换（模式相同时原样返回）"""
+        if mode == self.mode:
+            return self
+        count_copy('frame_convert', self.width * self.height * len(mode))
+        return Frame(image=self.image.convert(mode))
+
+    def channel_means(self) -> Tuple[float, ...]:
+        """各通道均值（有数组时由cv2统计，否则由PIL直方图统计，都不拷贝像素）"""
+        import cv2
+
+        if self._array is not None:
+            return tuple(cv2.mean(self._array)[:self.channels])
+        return tuple(ImageStat.Stat(self._image).mean)
+
+def like(source, frame: Frame):
+    """按输入类型返回结果：输入为帧时返回帧，否则返回PIL图片（兼容原有接口）"""
+    return frame if isinstance(source, Frame) else frame.image
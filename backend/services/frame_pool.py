@@ -0,0 +1,270 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from services.background_pack import BackgroundAsset
+
+logger = logging.getLogger(__name__)
+
+# 跨进程传递的帧描述：(共享内存名称, 形状, dtype字符串)
+FrameDescriptor = Tuple[str, Tuple[int, ...], str]
+
+class SharedFrame:
+    """共享内存中的一帧像素：跨进程只传递名称、形状与类型，像素本身不经过pickle"""
+
+    def __init__(self, shm: shared_memory.SharedMemory, shape: Tuple[int, ...], dtype=np.uint8,
+                 owner: bool = True):
+        """
+        Args:
+            shm (SharedMemory): 共享内存块
+            shape (Tuple): 像素数组形状
+            dtype: 像素类型
+            owner (bool): 是否由本进程负责释放（unlink）
+        """
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape: Tuple[int, ...], dtype=np.uint8) -> 'SharedFrame':
+        """分配一块新的共享内存帧"""
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype)
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> 'SharedFrame':
+        """把PIL图片的像素拷贝进共享内存（整个交接过程中唯一的一次输入拷贝）"""
+        pixels = np.asarray(image)
+        frame = cls.create(pixels.shape, pixels.dtype)
+        np.copyto(frame.array, pixels)
+        return frame
+
+    @classmethod
+    def attach(cls, descriptor: FrameDescriptor) -> 'SharedFrame':
+        """在工作进程中按描述附加到已有的共享内存帧"""
+        name, shape, dtype = descriptor
+        # 工作进程与服务进程共用同一个资源跟踪进程，重复登记同名内存块不会导致误删
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype, owner=False)
+
+    @property
+    def descriptor(self) -> FrameDescriptor:
+        """可pickle的帧描述"""
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        """释放本进程的映射；拥有方同时删除内存块"""
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # 仍有视图引用（如异常回溯中的图片）时，映射随垃圾回收释放
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self) -> 'SharedFrame':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parse_affinity(spec: str) -> List[int]:
+    """
+    解析CPU亲和性配置
+
+    Args:
+        spec (str): 逗号分隔的CPU编号或范围，如 "0-3,6"
+
+    Returns:
+        List[int]: CPU编号（升序去重），空字符串返回空列表
+    """
+    cpus = set()
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+# ---- 工作进程 ----
+
+_worker_blender = None
+_worker_blender_config: Dict = {}
+
+def _init_worker(affinity: Sequence[int], max_workers: int, counter, blender_config: Dict):
+    """工作进程初始化：设置CPU亲和性，限制库内部线程数（并行度由进程数决定），记录融合器参数"""
+    import cv2
+
+    global _worker_blender_config
+    _worker_blender_config = dict(blender_config)
+    cv2.setNumThreads(1)
+    if affinity and hasattr(os, 'sched_setaffinity'):
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        # CPU数不少于工作进程数时每个进程绑定一个CPU，否则共享整个集合
+        cpus = {affinity[index % len(affinity)]} if len(affinity) >= max_workers else set(affinity)
+        os.sched_setaffinity(0, cpus)
+
+def _blend_task(fg: FrameDescriptor, bg, out: FrameDescriptor) -> Dict:
+    """
+    工作进程：从共享内存读取前景与背景，融合结果写回共享内存
+
+    bg 为帧描述，或资源包背景（按资源包路径与键反序列化，工作进程映射同一文件，像素经页缓存共享）
+    """
+    global _worker_blender
+    if _worker_blender is None:
+        from services.image_blender import ImageBlender
+        # 与服务进程的融合器参数一致（不从工作进程的环境变量读取）
+        _worker_blender = ImageBlender(**_worker_blender_config)
+
+    frames = [SharedFrame.attach(descriptor) for descriptor in (fg, out)]
+    if isinstance(bg, tuple):
+        frames.append(SharedFrame.attach(bg))
+        background = Image.fromarray(frames[-1].array)
+    else:
+        background = bg
+    try:
+        # 前景（RGBA）直接映射共享内存，不拷贝
+        result = _worker_blender.blend_images(Image.fromarray(frames[0].array), background)
+        np.copyto(frames[1].array, np.asarray(result))
+        return {'pid': os.getpid(), 'tile_budget': _worker_blender.tile_budget}
+    finally:
+        for frame in frames:
+            frame.close()
+
+class FramePool:
+    """
+    CPU密集阶段的进程池：帧通过共享内存交接，绕开单进程内的GIL
+
+    工作进程意外退出（如大帧触发OOM被杀）时进程池整体失效，此时重建进程池并重试一次。
+    """
+
+    def __init__(self, max_workers: int = 2, affinity: Optional[Sequence[int]] = None,
+                 start_method: str = 'forkserver', blender_config: Optional[Dict] = None):
+        """
+        初始化进程池（工作进程在首次提交时启动）
+
+        Args:
+            max_workers (int): 工作进程数
+            affinity (Sequence[int]): 工作进程可使用的CPU，默认不限制
+            start_method (str): 进程启动方式；默认forkserver，不从多线程的服务进程直接fork
+            blender_config (Dict): 工作进程中 ImageBlender 的参数（如 tile_budget），见 ImageBlender.config
+        """
+        self.max_workers = max_workers
+        self.affinity = list(affinity or [])
+        self.blender_config = dict(blender_config or {})
+
+        self._context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # 服务进程只预加载本模块，不重新导入应用主模块
+            self._context.set_forkserver_preload(['services.frame_pool'])
+        self._executor = self._create_executor()
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'restarts': 0, 'bytes_shared': 0}
+
+        logger.info(f"进程池初始化完成，工作进程 {max_workers}，CPU亲和性 {self.affinity or '不限制'}")
+
+    @classmethod
+    def from_env(cls, blender_config: Optional[Dict] = None) -> Optional['FramePool']:
+        """根据环境变量创建进程池（CPU_POOL_WORKERS 为0时不启用，返回None）"""
+        max_workers = int(os.getenv('CPU_POOL_WORKERS', 0))
+        if max_workers <= 0:
+            return None
+        return cls(max_workers=max_workers, affinity=parse_affinity(os.getenv('CPU_POOL_AFFINITY', '')),
+                   start_method=os.getenv('CPU_POOL_START_METHOD', 'forkserver'), blender_config=blender_config)
+
+    def blend(self, foreground: Image.Image, background) -> Image.Image:
+        """
+        在工作进程中执行 ImageBlender.blend_images
+
+        Args:
+            foreground (PIL.Image): 前景人物图片
+            background (PIL.Image | BackgroundAsset): 背景图片（任意尺寸，由工作进程缩放）；
+                已保存的资源包背景只传递路径与键，不经过共享内存
+
+        Returns:
+            PIL.Image: 融合后的图片（RGB）
+        """
+        if foreground.mode != 'RGBA':
+            foreground = foreground.convert('RGBA')
+        if isinstance(background, BackgroundAsset):
+            if background.pack.path is not None:
+                with SharedFrame.from_image(foreground) as fg, \
+                        SharedFrame.create((foreground.height, foreground.width, 3)) as out:
+                    self._run(_blend_task, fg.descriptor, background, out.descriptor,
+                              nbytes=fg.array.nbytes + out.array.nbytes)
+                    return Image.fromarray(out.array)
+            background = Image.fromarray(background.render(foreground.size))
+        if background.mode != 'RGB':
+            background = background.convert('RGB')
+
+        with SharedFrame.from_image(foreground) as fg, SharedFrame.from_image(background) as bg, \
+                SharedFrame.create((foreground.height, foreground.width, 3)) as out:
+            self._run(_blend_task, fg.descriptor, bg.descriptor, out.descriptor,
+                      nbytes=fg.array.nbytes + bg.array.nbytes + out.array.nbytes)
+            return Image.fromarray(out.array)
+
+    def stats(self) -> Dict:
+        """获取进程池统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.max_workers
+        stats['affinity'] = self.affinity
+        return stats
+
+    def shutdown(self, wait: bool = True):
+        """关闭进程池"""
+        self._executor.shutdown(wait=wait)
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        """创建进程池执行器（工作进程在首次提交时启动）"""
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=self._context, initializer=_init_worker,
+            initargs=(self.affinity, self.max_workers, self._context.Value('i', 0), self.blender_config))
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """重建失效的进程池（并发的调用方只重建一次）"""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = self._create_executor()
+            self._stats['restarts'] += 1
+        logger.warning("进程池工作进程意外退出，已重建进程池")
+        broken.shutdown(wait=False)
+
+    def _run(self, func, *args, nbytes: int = 0):
+        """提交任务并等待结果（任务参数只有帧描述）；进程池失效时重建并重试一次"""
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['bytes_shared'] += nbytes
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                result = executor.submit(func, *args).result()
+                break
+            except BrokenProcessPool:
+                self._restart(executor)
+                if attempt == 0:
+                    continue
+                with self._lock:
+                    self._stats['failed'] += 1
+                raise
+            except Exception:
+                with self._lock:
+                    self._stats['failed'] += 1
+                raise
+        with self._lock:
+            self._stats['completed'] += 1
+        return result
@@ -0,0 +1,76 @@
+import numpy as np
+from PIL import Image
+from typing import Optional, Sequence, Tuple
+
+GradientStop = Tuple[float, Tuple[int, int, int]]
+
+def gradient_column(stops: Sequence[GradientStop], height: int) -> np.ndarray:
+    """
+    计算自上而下多段线性渐变的逐行颜色
+
+    每个通道在相邻色标之间线性插值（位置为 y / height）并向下取整。
+
+    Args:
+        stops (Sequence[GradientStop]): 色标列表 [(位置0~1, (R, G, B)), ...]，位置递增；
+            起止颜色相同的通道即为常量通道
+        height (int): 图片高度
+
+    Returns:
+        np.ndarray: 每行颜色，形状 (height, 3)，uint8
+    """
+    if height <= 0:
+        raise ValueError(f"无效的图片高度: {height}")
+    if len(stops) < 2:
+        raise ValueError("渐变至少需要两个色标")
+
+    positions = np.array([position for position, _ in stops], dtype=np.float64)
+    colors = np.array([color for _, color in stops], dtype=np.float64)
+    t = np.arange(height, dtype=np.float64) / height
+
+    column = np.empty((height, 3), dtype=np.uint8)
+    for channel in range(3):
+        column[:, channel] = np.floor(np.interp(t, positions, colors[:, channel]))
+    return column
+
+def render_vertical_gradient(stops: Sequence[GradientStop], width: int, height: int,
+                             out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    将渐变渲染到NumPy缓冲区
+
+    以32位整像素把逐行颜色广播到整帧，整帧只分配一次（传入out时不分配）。
+
+    Args:
+        stops (Sequence[GradientStop]): 色标列表
+        width (int): 图片宽度
+        height (int): 图片高度
+        out (np.ndarray): 可选的输出缓冲区，形状 (height, width, 4)，uint8，C连续
+
+    Returns:
+        np.ndarray: 渐变像素，形状 (height, width, 4)，uint8 RGBX（X通道为255）
+    """
+    if width <= 0:
+        raise ValueError(f"无效的图片宽度: {width}")
+
+    column = np.full((height, 4), 255, dtype=np.uint8)
+    column[:, :3] = gradient_column(stops, height)
+
+    if out is None:
+        out = np.empty((height, width, 4), dtype=np.uint8)
+    out.view(np.uint32)[..., 0] = column.view(np.uint32)
+    return out
+
+def gradient_image(stops: Sequence[GradientStop], width: int, height: int) -> Image.Image:
+    """
+    将渐变渲染为RGB模式的PIL图片
+
+    逐行颜色由NumPy计算，再由PIL在C层横向广播到整帧：整帧只在PIL内部分配
+    一次，避免先分配NumPy整帧再拷贝进PIL带来的双倍内存和缺页开销。
+
+    Returns:
+        PIL.Image: 渐变背景图片
+    """
+    if width <= 0:
+        raise ValueError(f"无效的图片宽度: {width}")
+
+    column = Image.fromarray(gradient_column(stops, height)[:, np.newaxis, :], 'RGB')
+    return column.resize((width, height), Image.Resampling.NEAREST)
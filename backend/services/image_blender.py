@@ -1,51 +1,197 @@
 import logging
 import numpy as np
-from PIL import Image, ImageEnhance, ImageFilter
-import cv2
-from typing import Tuple
+from PIL import Image, ImageStat
+from typing import Dict, Optional, Tuple, Union
+
+from services.background_pack import BackgroundAsset
+from services.compositor import composite_over
+from services.enhance import LUMA_WEIGHTS, EnhanceScratch, blur_halo, color_matrix, enhance_pixels, mean_luminance
+from services.frame import Frame, count_copy, like
+from services.metrics import BLEND_STEP_SECONDS, StepTimer
+from services.tiling import plan_tiles, tile_budget_from_env, tile_size_for_budget
 
 logger = logging.getLogger(__name__)
 
+# 分块融合时每个像素的中间结果字节数：前景裁剪与数组（RGBA×2）、背景裁剪与数组（RGB×2）、
+# 增强结果（RGBA）、后处理结果（RGB）、羽化合成输入（RGBA），取整留出余量
+TILE_BYTES_PER_PIXEL = 32
+
 class ImageBlender:
     """图像融合服务类"""
     
-    def __init__(self):
-        """初始化图像融合器"""
-        logger.info("图像融合器初始化完成")
+    def __init__(self, tile_budget: Optional[int] = None):
+        """
+        初始化图像融合器
+
+        Args:
+            tile_budget (int): 分块处理的内存预算（字节），人物区域的中间结果超过预算时分块融合；
+                0表示始终整块处理，默认取 TILE_MEMORY_BUDGET 环境变量
+        """
+        self.tile_budget = tile_budget_from_env() if tile_budget is None else tile_budget
+        # 增强内核的中间缓冲区（按线程复用）
+        self._scratch = EnhanceScratch()
+        logger.info(f"图像融合器初始化完成，分块内存预算 {self.tile_budget or '未启用'}")
+    
+    def config(self) -> Dict:
+        """构造参数（进程池工作进程按此创建相同配置的融合器）"""
+        return {'tile_budget': self.tile_budget}
     
-    def blend_images(self, foreground: Image.Image, background: Image.Image) -> Image.Image:
+    def blend_images(self, foreground: Union[Image.Image, Frame],
+                     background: Union[Image.Image, Frame, BackgroundAsset]) -> Union[Image.Image, Frame]:
         """
         将前景人物与背景进行融合
         
         Args:
-            foreground (PIL.Image): 前景人物图片（带透明通道）
-            background (PIL.Image): 背景图片
+            foreground (PIL.Image | Frame): 前景人物图片（带透明通道）
+            background (PIL.Image | Frame | BackgroundAsset): 背景图片或资源包背景（从最近的金字塔层级取像素，
+                亮度使用预计算统计）
             
         Returns:
-            PIL.Image: 融合后的图片
+            PIL.Image | Frame: 融合后的图片；前景为帧时返回帧（融合画布直接作为像素存储，不转换为PIL）
         """
+        # 各子步骤耗时（resize/analyze/copy/enhance/composite/post_process）
+        steps = StepTimer(BLEND_STEP_SECONDS)
         try:
             # 确保背景图片大小合适
-            background = self._resize_background(background, foreground.size)
+            with steps('resize'):
+                fg = Frame.wrap(foreground).convert('RGBA')
+                # 资源包背景渲染出的像素是本次请求独有的缓冲区，直接作为融合画布
+                canvas, bg_brightness = None, None
+                if isinstance(background, BackgroundAsset):
+                    bg_brightness = background.crop_brightness(fg.size)
+                    canvas = background.render(fg.size)
+                    background = Frame(canvas)
+                else:
+                    background = self._resize_background(Frame.wrap(background).image, fg.size)
+                    if background.mode != 'RGB':
+                        background = background.convert('RGB')
             
-            # 调整前景图片的光线和色彩
-            enhanced_foreground = self._enhance_foreground(foreground, background)
+            with steps('analyze'):
+                # 只处理人物所在的区域（alpha包围盒外扩锐化半径），其余像素保持背景不变
+                roi = self._subject_roi(fg)
+                if roi is None:
+                    logger.info("前景完全透明，直接返回背景")
+                    if canvas is not None:
+                        return like(foreground, background)
+                    count_copy('blend_output', Frame.wrap(background).nbytes)
+                    return like(foreground, Frame(image=background.copy()))
+                
+                # 前景亮度统计基于整帧
+                fg_luminance = self._mean_luminance(fg)
             
-            # 进行图像融合
-            blended_image = self._blend_with_lighting(enhanced_foreground, background)
-            
-            # 后处理优化
-            final_image = self._post_process(blended_image)
+            roi_pixels = (roi[0].stop - roi[0].start) * (roi[1].stop - roi[1].start)
+            if self.tile_budget and roi_pixels * TILE_BYTES_PER_PIXEL > self.tile_budget:
+                final_frame = self._blend_tiled(fg, Frame.wrap(background).image, roi, fg_luminance, steps,
+                                                bg_brightness=bg_brightness)
+            else:
+                # 输出画布：ROI以外的像素就是背景本身（背景可能被其他阶段共享，必须拷贝）
+                with steps('copy'):
+                    if canvas is None:
+                        canvas = Frame.wrap(background).writable_array('blend_canvas')
+                    fg_pixels = fg.region(self._box(roi))
+                if bg_brightness is None:
+                    with steps('analyze'):
+                        bg_brightness = mean_luminance(canvas) / 255.0
+                self._blend_region(fg_pixels, canvas[roi], bg_brightness, fg_luminance, steps)
+                final_frame = Frame(canvas)
             
             logger.info("图像融合完成")
-            return final_image
+            with steps('copy'):
+                return like(foreground, final_frame)
             
         except Exception as e:
             logger.error(f"图像融合失败: {str(e)}")
             raise
+        finally:
+            steps.observe()
+    
+    def _blend_region(self, fg_pixels: np.ndarray, bg_pixels: np.ndarray, bg_brightness: float,
+                      fg_luminance: float, steps: StepTimer):
+        """
+        融合一块区域：前景增强 → 合成 → 后处理，结果原地写入bg_pixels
+
+        Args:
+            fg_pixels (np.ndarray): 前景像素（RGBA）
+            bg_pixels (np.ndarray): 同尺寸的背景像素（RGB，原地修改）
+            bg_brightness (float): 整帧背景的平均亮度（0~1）
+            fg_luminance (float): 整帧前景的平均亮度（0~255）
+            steps (StepTimer): 子步骤计时
+        """
+        # 调整前景图片的光线和色彩
+        with steps('enhance'):
+            enhanced = self._enhance_foreground_pixels(fg_pixels, bg_brightness, luminance=fg_luminance)
+        
+        # 进行图像融合（原地写入背景）
+        with steps('composite'):
+            self._blend_pixels(enhanced, bg_pixels, out=bg_pixels)
+        
+        # 后处理优化（按alpha羽化，透明处保持背景原样，ROI边界无接缝）
+        with steps('post_process'):
+            self._post_process_subject(bg_pixels, enhanced[..., 3:4])
+    
+    def _blend_tiled(self, foreground: Frame, background: Image.Image, roi: Tuple[slice, slice],
+                     fg_luminance: float, steps: StepTimer, bg_brightness: Optional[float] = None) -> Frame:
+        """
+        分块融合人物区域：每次只裁剪一个分块，中间结果受tile_budget约束而与图片尺寸无关
+
+        分块四周重叠两级锐化的半径（前景增强、后处理各一次），重叠部分只参与计算，
+        输出与整块处理逐像素相同。结果直接贴回背景的副本，不分配整帧的numpy画布。
+        bg_brightness 为预计算的背景亮度（资源包背景），未提供时统计背景。
+        """
+        # 背景亮度由通道直方图统计（不拷贝像素），与整块处理的 mean_luminance 相同
+        if bg_brightness is None:
+            with steps('analyze'):
+                bg_brightness = float(np.dot(LUMA_WEIGHTS, ImageStat.Stat(background).mean[:3])) / 255.0
+        with steps('copy'):
+            count_copy('blend_output', Frame.wrap(background).nbytes)
+            output = background.copy()
+        
+        halo = 2 * blur_halo()
+        tile_size = tile_size_for_budget(self.tile_budget, TILE_BYTES_PER_PIXEL, halo)
+        tiles = plan_tiles(background.height, background.width, tile_size, halo, bounds=roi)
+        
+        for tile in tiles:
+            with steps('copy'):
+                fg_pixels = foreground.region(tile.box)
+                bg_pixels = np.array(background.crop(tile.box))
+            self._blend_region(fg_pixels, bg_pixels, bg_brightness, fg_luminance, steps)
+            with steps('copy'):
+                rows, cols = tile.core
+                output.paste(Image.fromarray(bg_pixels[tile.inner]), (cols.start, rows.start))
+        
+        logger.info(f"分块融合完成，共 {len(tiles)} 块（边长 {tile_size}）")
+        return Frame(image=output)
+    
+    @staticmethod
+    def _box(region: Tuple[slice, slice]) -> Tuple[int, int, int, int]:
+        """(行切片, 列切片) 转换为PIL裁剪框"""
+        rows, cols = region
+        return cols.start, rows.start, cols.stop, rows.stop
+    
+    def _subject_roi(self, foreground: Union[Image.Image, Frame]) -> Optional[Tuple[slice, slice]]:
+        """
+        计算人物区域：alpha非零像素的包围盒，四周外扩锐化滤波的半径
+
+        外扩后ROI内的滤波结果与整帧处理一致，外扩部分的alpha仍为0。
+
+        Returns:
+            Tuple[slice, slice]: (行切片, 列切片)，前景完全透明时返回None
+        """
+        bbox = Frame.wrap(foreground).image.getchannel('A').getbbox()
+        if bbox is None:
+            return None
+
+        left, top, right, bottom = bbox
+        margin = blur_halo()
+        width, height = foreground.size
+        return (slice(max(0, top - margin), min(height, bottom + margin)),
+                slice(max(0, left - margin), min(width, right + margin)))
     
     def _resize_background(self, background: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
         """调整背景图片大小以匹配前景"""
+        if background.size == tuple(target_size):
+            return background
+        
         # 计算缩放比例，保持宽高比
         bg_width, bg_height = background.size
         fg_width, fg_height = target_size
@@ -69,105 +215,86 @@ class ImageBlender:
         
         return resized_bg.crop((left, top, right, bottom))
     
-    def _enhance_foreground(self, foreground: Image.Image, background: Image.Image) -> Image.Image:
-        """增强前景图片以匹配背景环境"""
+    def _enhance_foreground(self, foreground, background):
+        """增强前景图片以匹配背景环境（接受PIL图片或帧，返回同类型）"""
+        fg = Frame.wrap(foreground)
+        if fg.mode not in ('RGB', 'RGBA'):
+            fg = fg.convert('RGBA')
+        return like(foreground, Frame(self._enhance_foreground_pixels(fg.array, self._calculate_brightness(background))))
+    
+    def _enhance_foreground_pixels(self, pixels: np.ndarray, bg_brightness: float,
+                                   luminance: Optional[float] = None) -> np.ndarray:
+        """
+        增强前景像素（亮度/对比度/饱和度一次仿射变换 + 一次锐化），失败时返回原像素
+
+        Args:
+            pixels (np.ndarray): 前景像素
+            bg_brightness (float): 背景的平均亮度（0~1）
+            luminance (float): 前景的平均亮度（0~255），只传入ROI时用整帧的值，默认按pixels计算
+        """
         try:
-            # 分析背景的主要颜色和亮度
-            bg_colors = self._analyze_background_colors(background)
-            bg_brightness = self._calculate_brightness(background)
-            
             # 调整前景的亮度
-            brightness_factor = self._calculate_brightness_adjustment(foreground, bg_brightness)
-            enhanced = ImageEnhance.Brightness(foreground).enhance(brightness_factor)
+            fg_luminance = mean_luminance(pixels) if luminance is None else luminance
+            brightness_factor = self._calculate_brightness_adjustment(fg_luminance / 255.0, bg_brightness)
             
-            # 调整对比度
-            contrast_factor = 1.1  # 稍微增加对比度
-            enhanced = ImageEnhance.Contrast(enhanced).enhance(contrast_factor)
-            
-            # 调整饱和度
-            saturation_factor = 1.05  # 稍微增加饱和度
-            enhanced = ImageEnhance.Color(enhanced).enhance(saturation_factor)
+            # 稍微增加对比度（以亮度调整后的平均亮度为中心）和饱和度
+            matrix = color_matrix(brightness=brightness_factor, contrast=1.1, saturation=1.05,
+                                  contrast_mean=round(brightness_factor * fg_luminance),
+                                  channels=pixels.shape[2])
             
             # 添加轻微的锐化
-            enhanced = enhanced.filter(ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3))
-            
-            return enhanced
+            return enhance_pixels(pixels, matrix, percent=150, threshold=3, scratch=self._scratch)
             
         except Exception as e:
             logger.error(f"前景增强失败: {str(e)}")
-            return foreground
+            return pixels
     
-    def _blend_with_lighting(self, foreground: Image.Image, background: Image.Image) -> Image.Image:
-        """考虑光照效果的图像融合"""
+    def _blend_with_lighting(self, foreground, background):
+        """考虑光照效果的图像融合（接受PIL图片或帧，返回与前景同类型）"""
+        fg = Frame.wrap(foreground).convert('RGBA')
+        bg_pixels = Frame.wrap(background).convert('RGB').writable_array('blend_canvas')
+        return like(foreground, Frame(self._blend_pixels(fg.array, bg_pixels, out=bg_pixels)))
+    
+    def _blend_pixels(self, fg_pixels: np.ndarray, bg_pixels: np.ndarray,
+                      out: Optional[np.ndarray] = None) -> np.ndarray:
+        """前景像素（RGBA）与背景像素（RGB）融合，out可以就是bg_pixels（原地融合）"""
         try:
-            # 转换为RGBA模式
-            if foreground.mode != 'RGBA':
-                foreground = foreground.convert('RGBA')
-            if background.mode != 'RGB':
-                background = background.convert('RGB')
-            
-            # 创建新的图片
-            result = Image.new('RGB', background.size)
-            
-            # 获取像素数据
-            fg_pixels = np.array(foreground)
-            bg_pixels = np.array(background)
-            
-            # 创建结果像素数组
-            result_pixels = np.zeros_like(bg_pixels, dtype=np.float32)
-            
-            # 逐像素融合
-            for y in range(fg_pixels.shape[0]):
-                for x in range(fg_pixels.shape[1]):
-                    fg_pixel = fg_pixels[y, x]
-                    bg_pixel = bg_pixels[y, x]
-                    
-                    # 获取alpha通道值
-                    alpha = fg_pixel[3] / 255.0
-                    
-                    if alpha > 0:  # 如果前景像素不透明
-                        # 计算融合后的颜色
-                        for c in range(3):  # RGB三个通道
-                            # 使用alpha混合
-                            result_pixels[y, x, c] = (
-                                fg_pixel[c] * alpha + 
-                                bg_pixel[c] * (1 - alpha)
-                            )
-                    else:  # 如果前景像素透明
-                        result_pixels[y, x] = bg_pixel
-            
-            # 转换回PIL Image
-            result_pixels = np.clip(result_pixels, 0, 255).astype(np.uint8)
-            result = Image.fromarray(result_pixels)
-            
-            return result
+            # 整帧预乘alpha融合（透明像素保持背景不变）
+            return composite_over(fg_pixels, bg_pixels, out=out)
             
         except Exception as e:
             logger.error(f"光照融合失败: {str(e)}")
             # 回退到简单融合
-            return self._simple_blend(foreground, background)
-    
-    def _simple_blend(self, foreground: Image.Image, background: Image.Image) -> Image.Image:
-        """简单的图像融合（回退方案）"""
-        if foreground.mode != 'RGBA':
-            foreground = foreground.convert('RGBA')
-        if background.mode != 'RGB':
-            background = background.convert('RGB')
+            result = self._simple_blend(Frame(fg_pixels), Frame(bg_pixels)).array
+            if out is None:
+                return result
+            out[...] = result
+            return out
+    
+    def _simple_blend(self, foreground, background):
+        """简单的图像融合（回退方案，接受PIL图片或帧，返回与前景同类型）"""
+        fg_image = Frame.wrap(foreground).convert('RGBA').image
+        bg = Frame.wrap(background).convert('RGB')
         
-        # 使用PIL的paste方法进行融合
-        result = background.copy()
-        result.paste(foreground, (0, 0), foreground)
+        # 使用PIL的paste方法进行融合（paste原地修改，先拷贝背景）
+        count_copy('blend_canvas', bg.nbytes)
+        result = bg.image.copy()
+        result.paste(fg_image, (0, 0), fg_image)
         
-        return result
+        return like(foreground, Frame(image=result))
     
-    def _analyze_background_colors(self, background: Image.Image) -> dict:
-        """分析背景的主要颜色"""
+    def _analyze_background_colors(self, background) -> dict:
+        """分析背景的主要颜色（接受PIL图片、帧或资源包背景）"""
         try:
-            # 转换为numpy数组
-            img_array = np.array(background)
-            
-            # 计算平均颜色
-            mean_colors = np.mean(img_array, axis=(0, 1))
+            if isinstance(background, BackgroundAsset):
+                # 资源包背景使用构建时预计算的平均颜色
+                mean_colors = np.array(background.mean_color)
+            else:
+                # 按通道统计均值，不拷贝像素数据（RGBA取前三个通道）
+                frame = Frame.wrap(background)
+                if frame.mode not in ('RGB', 'RGBA'):
+                    frame = frame.convert('RGB')
+                mean_colors = np.array(frame.channel_means()[:3])
             
             return {
                 'mean_r': mean_colors[0],
@@ -179,51 +306,54 @@ class ImageBlender:
             logger.error(f"背景颜色分析失败: {str(e)}")
             return {'mean_r': 128, 'mean_g': 128, 'mean_b': 128}
     
-    def _calculate_brightness(self, image: Image.Image) -> float:
-        """计算图片的平均亮度"""
+    def _calculate_brightness(self, image) -> float:
+        """计算图片的平均亮度（资源包背景使用预计算值）"""
         try:
-            # 转换为灰度图
-            gray = image.convert('L')
-            gray_array = np.array(gray)
-            
-            # 计算平均亮度
-            brightness = np.mean(gray_array)
-            return brightness / 255.0  # 归一化到0-1
+            if isinstance(image, BackgroundAsset):
+                return image.brightness
+            return self._mean_luminance(image) / 255.0  # 归一化到0-1
             
         except Exception as e:
             logger.error(f"亮度计算失败: {str(e)}")
             return 0.5
     
-    def _calculate_brightness_adjustment(self, foreground: Image.Image, target_brightness: float) -> float:
+    def _calculate_brightness_adjustment(self, current_brightness: float, target_brightness: float) -> float:
         """计算前景亮度调整因子"""
-        try:
-            current_brightness = self._calculate_brightness(foreground)
-            
-            # 计算调整因子
-            if current_brightness > 0:
-                adjustment = target_brightness / current_brightness
-                # 限制调整范围
-                adjustment = max(0.7, min(1.3, adjustment))
-            else:
-                adjustment = 1.0
-            
-            return adjustment
-            
-        except Exception as e:
-            logger.error(f"亮度调整计算失败: {str(e)}")
-            return 1.0
+        # 计算调整因子
+        if current_brightness > 0:
+            adjustment = target_brightness / current_brightness
+            # 限制调整范围
+            return max(0.7, min(1.3, adjustment))
+        return 1.0
+    
+    def _post_process(self, image):
+        """后处理优化（接受PIL图片或帧，返回同类型）"""
+        frame = Frame.wrap(image).convert('RGB')
+        return like(image, Frame(self._post_process_pixels(frame.array)))
     
-    def _post_process(self, image: Image.Image) -> Image.Image:
-        """后处理优化"""
+    def _post_process_pixels(self, pixels: np.ndarray) -> np.ndarray:
+        """后处理（轻微的色彩增强与锐化，单遍完成），失败时返回原像素"""
         try:
-            # 轻微的色彩增强
-            enhanced = ImageEnhance.Color(image).enhance(1.05)
-            
-            # 轻微的锐化
-            sharpened = enhanced.filter(ImageFilter.UnsharpMask(radius=1, percent=120, threshold=3))
-            
-            return sharpened
+            matrix = color_matrix(saturation=1.05)
+            return enhance_pixels(pixels, matrix, percent=120, threshold=3, scratch=self._scratch)
             
         except Exception as e:
             logger.error(f"后处理失败: {str(e)}")
-            return image
+            return pixels
+    
+    def _post_process_subject(self, pixels: np.ndarray, alpha: np.ndarray):
+        """
+        只对人物做后处理：处理结果按alpha与原像素混合后原地写回
+
+        Args:
+            pixels (np.ndarray): 融合后的ROI像素（RGB，原地修改）
+            alpha (np.ndarray): 同尺寸的前景alpha，形状 (H, W, 1)
+        """
+        processed = self._post_process_pixels(pixels)
+        if processed is pixels:
+            return
+        composite_over(np.concatenate((processed, alpha), axis=2), pixels, out=pixels)
+    
+    def _mean_luminance(self, image) -> float:
+        """图片（或帧）的平均亮度（0~255），由灰度直方图统计，不拷贝像素到numpy"""
+        return ImageStat.Stat(Frame.wrap(image).image.convert('L')).mean[0]
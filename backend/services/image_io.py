@@ -0,0 +1,202 @@
+import io
+import logging
+import os
+import threading
+from typing import BinaryIO, Dict, Optional, Union
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from services.frame import Frame
+
+logger = logging.getLogger(__name__)
+
+# 服务接口接受的图片来源：文件路径、字节数据、文件对象、PIL图片、numpy数组或像素帧
+ImageSource = Union[str, bytes, bytearray, memoryview, BinaryIO, Image.Image, np.ndarray, Frame]
+
+def load_image(source: ImageSource) -> Image.Image:
+    """
+    将任意图片来源解码为PIL图片（已加载像素数据）
+
+    PIL图片原样返回；像素帧返回其PIL视图；numpy数组零拷贝包装；字节数据直接在内存中解码，不落盘。
+
+    Args:
+        source (ImageSource): 图片来源
+
+    Returns:
+        PIL.Image: 图片
+    """
+    if isinstance(source, Image.Image):
+        return source
+
+    if isinstance(source, Frame):
+        return source.image
+
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(source)
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    image = Image.open(source)
+    image.load()
+    return image
+
+# 接受的上传格式（JPEG解码器同时处理部分手机相机输出的多帧MPO）
+SUPPORTED_FORMATS = ('JPEG', 'PNG', 'WEBP', 'BMP', 'GIF')
+# 默认的上传像素上限（解码前按文件头检查）
+DEFAULT_MAX_PIXELS = 64_000_000
+# 解码后缩放时先按整数倍盒式缩小，剩余至少该倍数再做LANCZOS
+DECODE_REDUCING_GAP = 3.0
+# EXIF方向标签
+EXIF_ORIENTATION = 0x0112
+
+class InvalidImageError(ValueError):
+    """上传内容不是可支持的图片"""
+
+class ImageTooLargeError(InvalidImageError):
+    """图片像素数超过上限"""
+
+def probe_image(source: ImageSource, max_pixels: Optional[int] = None) -> Dict:
+    """
+    只读取文件头获取图片格式与尺寸，不解码像素数据
+
+    Args:
+        source (ImageSource): 图片来源（字节数据、文件对象或路径）
+        max_pixels (int): 像素数上限，默认取 MAX_IMAGE_PIXELS 环境变量；0表示不限制
+
+    Returns:
+        Dict: {'format', 'width', 'height', 'orientation': EXIF方向（1为正常）}，
+            宽高为文件中存储的尺寸（未按EXIF方向旋转）
+
+    Raises:
+        InvalidImageError: 不是可识别的图片或格式不受支持
+        ImageTooLargeError: 像素数超过上限
+    """
+    return _describe(_open_checked(source, max_pixels))
+
+def decode_image(source: ImageSource, max_size: int = 0, max_pixels: Optional[int] = None) -> Image.Image:
+    """
+    解码上传的图片：先检查文件头，再按目标尺寸解码并应用EXIF方向
+
+    JPEG在DCT域直接缩小（draft，1/2、1/4、1/8），只解码接近目标尺寸的像素，
+    再以LANCZOS缩放到目标尺寸（缩小倍数较大时先做整数倍盒式缩小）；其他格式解码后缩放。
+
+    Args:
+        source (ImageSource): 图片来源；PIL图片、numpy数组与像素帧原样按 load_image 处理
+        max_size (int): 最长边上限，0表示保持原尺寸
+        max_pixels (int): 像素数上限（按文件头检查，超过时不解码），默认取 MAX_IMAGE_PIXELS 环境变量
+
+    Returns:
+        PIL.Image: 已加载像素数据的图片（方向已校正）
+
+    Raises:
+        InvalidImageError: 不是可识别的图片、格式不受支持或数据损坏
+        ImageTooLargeError: 像素数超过上限
+    """
+    if isinstance(source, (Image.Image, np.ndarray, Frame)):
+        image = load_image(source)
+        if max_size and max(image.size) > max_size:
+            image = ImageOps.contain(image, (max_size, max_size), Image.Resampling.LANCZOS)
+        return image
+
+    image = _open_checked(source, max_pixels)
+    orientation = _describe(image)['orientation']
+
+    try:
+        # 目标框为正方形，旋转前后适用同一个框
+        if max_size and max(image.size) > max_size:
+            scale = max_size / max(image.size)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            # JPEG按不小于目标尺寸的最大比例（1/2、1/4、1/8）解码，其他格式不变
+            image.draft(None, size)
+            image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=DECODE_REDUCING_GAP)
+        else:
+            image.load()
+    except (OSError, SyntaxError, ValueError) as e:
+        raise InvalidImageError(f"图片数据损坏: {str(e)}") from e
+
+    # 只有需要旋转时才转置（exif_transpose在方向正常时也会拷贝整图）
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    return image
+
+def _open_checked(source: ImageSource, max_pixels: Optional[int]) -> Image.Image:
+    """打开图片（只解析文件头）并检查格式与像素数"""
+    if max_pixels is None:
+        max_pixels = int(os.getenv('MAX_IMAGE_PIXELS', DEFAULT_MAX_PIXELS))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    try:
+        image = Image.open(source, formats=SUPPORTED_FORMATS)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError) as e:
+        raise InvalidImageError(f"无法识别的图片格式，支持: {', '.join(SUPPORTED_FORMATS)}") from e
+
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(f"图片尺寸 {width}x{height} 超过上限 {max_pixels} 像素")
+    return image
+
+def _describe(image: Image.Image) -> Dict:
+    """未加载图片的格式、尺寸与EXIF方向"""
+    try:
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        orientation = 1
+    return {'format': image.format, 'width': image.width, 'height': image.height,
+            'orientation': orientation if orientation in range(1, 9) else 1}
+
+def image_nbytes(image: Union[Image.Image, Frame]) -> int:
+    """计算图片（或像素帧）像素数据的字节数"""
+    if isinstance(image, Frame):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
+
+class CopyMeter:
+    """单次请求的数据拷贝计量（流水线阶段可并发记录）"""
+
+    def __init__(self):
+        """初始化计量器"""
+        self.copies: Dict[str, int] = {}
+        # 整帧拷贝次数（按位置）：流水线的拷贝次数是固定的，次数增加即为回归
+        self.frames: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, label: str, nbytes: int):
+        """
+        记录一次拷贝
+
+        Args:
+            label (str): 拷贝发生的位置
+            nbytes (int): 拷贝的字节数
+        """
+        with self._lock:
+            self.copies[label] = self.copies.get(label, 0) + int(nbytes)
+
+    def add_frame(self, label: str, nbytes: int):
+        """记录一次整帧拷贝（字节数同时计入拷贝总量）"""
+        with self._lock:
+            self.copies[label] = self.copies.get(label, 0) + int(nbytes)
+            self.frames[label] = self.frames.get(label, 0) + 1
+
+    def add_image(self, label: str, image: Union[Image.Image, Frame]):
+        """记录一次整帧拷贝"""
+        self.add_frame(label, image_nbytes(image))
+
+    @property
+    def total(self) -> int:
+        """拷贝字节总数"""
+        return sum(self.copies.values())
+
+    @property
+    def frame_copies(self) -> int:
+        """整帧拷贝总次数"""
+        return sum(self.frames.values())
+
+    def to_dict(self) -> Dict:
+        """转换为可序列化的字典"""
+        return {'bytesCopied': self.total, 'copies': dict(self.copies),
+                'frameCopies': self.frame_copies, 'frames': dict(self.frames)}
@@ -1,42 +1,79 @@
 import os
-import cv2
 import numpy as np
 from PIL import Image
 import logging
-from rembg import remove, new_session
-import io
+from typing import List, Optional
+
+from services.image_io import ImageSource, decode_image, load_image
+from services.session_manager import SessionManager, get_session_manager
+from services.matting import upsample_alpha, working_image
+from services.tiling import map_tiles
+from services.frame import Frame, like
 
 logger = logging.getLogger(__name__)
 
+# u2net系列模型（u2net / u2netp / silueta）的输入尺寸与归一化参数
+MODEL_INPUT_SIZE = (320, 320)
+MODEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+MODEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
 class ImageProcessor:
     """图像处理服务类"""
     
-    def __init__(self):
-        """初始化图像处理器"""
-        # 初始化rembg会话
-        self.session = new_session('u2net')
-        logger.info("图像处理器初始化完成")
+    def __init__(self, model_name: Optional[str] = None, session_manager: Optional[SessionManager] = None,
+                 working_size: Optional[int] = None):
+        """
+        初始化图像处理器（rembg模型在首次抠图时才加载）
+        
+        Args:
+            model_name (str): 抠图模型（u2net / u2netp / silueta），默认取 REMBG_MODEL 环境变量
+            session_manager (SessionManager): 会话管理器，默认使用进程内共享的实例
+            working_size (int): 抠图工作分辨率（最长边），大图先缩小分割再把遮罩放大回原尺寸；
+                0表示按原尺寸分割，默认取 SEGMENT_WORKING_SIZE 环境变量
+        """
+        self.session_manager = session_manager or get_session_manager()
+        self.model_name = model_name or self.session_manager.default_model
+        if working_size is None:
+            working_size = int(os.getenv('SEGMENT_WORKING_SIZE', 0))
+        self.working_size = working_size
+        logger.info(f"图像处理器初始化完成，抠图模型 {self.model_name}")
+    
+    @property
+    def session(self):
+        """rembg会话（延迟加载，进程内共享）"""
+        return self.session_manager.get_session(self.model_name)
     
-    def extract_person(self, image_path):
+    def warm_up(self) -> float:
+        """
+        加载模型并执行一次预热推理
+        
+        Returns:
+            float: 预热耗时（秒）
+        """
+        return self.session_manager.warm_up(self.model_name)
+    
+    def extract_person(self, image: ImageSource):
         """
         从图片中提取人物主体
         
         Args:
-            image_path (str): 输入图片路径
+            image (ImageSource): 输入图片（路径、字节数据、文件对象、PIL图片或numpy数组）
             
         Returns:
             PIL.Image: 提取的人物图像（带透明背景）
         """
+        from rembg import remove
+        
         try:
-            # 读取图片
-            with open(image_path, 'rb') as f:
-                input_image = f.read()
+            # 在内存中解码图片（不落盘）
+            input_image = load_image(image)
             
-            # 使用rembg进行背景移除
-            output_image = remove(input_image, session=self.session)
+            # 低分辨率分割模式
+            if self.working_size and max(input_image.size) > self.working_size:
+                return self._extract_person_low_res(input_image)
             
-            # 转换为PIL Image
-            result_image = Image.open(io.BytesIO(output_image))
+            # 使用rembg进行背景移除（输入PIL图片时直接返回PIL图片，省去PNG编解码）
+            result_image = remove(input_image, session=self.session)
             
             # 确保是RGBA模式（带透明通道）
             if result_image.mode != 'RGBA':
@@ -49,17 +86,109 @@ class ImageProcessor:
             logger.error(f"人物抠图失败: {str(e)}")
             raise
     
+    def _extract_person_low_res(self, image: Image.Image) -> Image.Image:
+        """在工作分辨率下分割，再把遮罩边缘感知地放大回原尺寸（原图RGB保持不变）"""
+        from rembg import remove
+        
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        small = working_image(image, self.working_size)
+        cutout = remove(small, session=self.session)
+        alpha = upsample_alpha(cutout.getchannel('A'), image, guide_low=small)
+        
+        result_image = image.convert('RGBA')
+        result_image.putalpha(alpha)
+        
+        logger.info("人物抠图完成（低分辨率分割）")
+        return result_image
+    
+    def extract_persons(self, images: List[ImageSource]) -> List[Image.Image]:
+        """
+        批量提取人物主体：缩放到模型输入尺寸后堆叠成一批，一次送入ONNX会话
+        
+        与extract_person相比省去了逐张的会话调度和输出PNG编解码；
+        结果保留原始RGB，仅替换alpha通道。
+        
+        Args:
+            images (List[ImageSource]): 输入图片列表
+            
+        Returns:
+            List[PIL.Image]: 提取的人物图像（RGBA），顺序与输入一致
+        """
+        if not images:
+            return []
+        
+        try:
+            inputs = [load_image(image) for image in images]
+            inputs = [image if image.mode == 'RGB' else image.convert('RGB') for image in inputs]
+            
+            # 低分辨率分割模式下先缩小到工作分辨率，遮罩再引导放大回原尺寸
+            working = [working_image(image, self.working_size) for image in inputs]
+            masks = self._predict_masks(working)
+            
+            results = []
+            for image, small, mask in zip(inputs, working, masks):
+                if small is not image:
+                    mask = upsample_alpha(mask, image, guide_low=small)
+                result_image = image.convert('RGBA')
+                result_image.putalpha(mask)
+                results.append(result_image)
+            
+            logger.info(f"批量人物抠图完成，共 {len(results)} 张")
+            return results
+            
+        except Exception as e:
+            logger.error(f"批量人物抠图失败: {str(e)}")
+            raise
+    
+    def _predict_masks(self, images: List[Image.Image]) -> List[Image.Image]:
+        """对一批RGB图片执行分割推理，返回与原图同尺寸的alpha遮罩"""
+        inner_session = self.session.inner_session
+        model_input = inner_session.get_inputs()[0]
+        
+        # 预处理：缩放、按图片最大值归一化、标准化、NHWC -> NCHW
+        batch = np.stack([
+            np.asarray(image.resize(MODEL_INPUT_SIZE, Image.Resampling.LANCZOS)) for image in images
+        ]).astype(np.float32)
+        batch /= np.maximum(batch.max(axis=(1, 2, 3), keepdims=True), 1.0)
+        batch -= MODEL_MEAN
+        batch /= MODEL_STD
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+        
+        # 固定batch=1导出的模型只能逐张推理
+        if model_input.shape and model_input.shape[0] == 1:
+            predictions = np.concatenate([
+                inner_session.run(None, {model_input.name: batch[i:i + 1]})[0] for i in range(len(images))
+            ])
+        else:
+            predictions = inner_session.run(None, {model_input.name: batch})[0]
+        
+        masks = []
+        for image, prediction in zip(images, predictions[:, 0]):
+            low, high = prediction.min(), prediction.max()
+            prediction = (prediction - low) / max(high - low, 1e-6)
+            mask = Image.fromarray((prediction * 255).astype(np.uint8))
+            masks.append(mask.resize(image.size, Image.Resampling.LANCZOS))
+        return masks
+    
     def resize_image(self, image, max_size=1024):
         """
         调整图片大小，保持宽高比
         
+        未解码的上传（字节数据、文件对象、路径）在解码时直接缩小：JPEG在DCT域按1/2~1/8解码，
+        再缩放到目标尺寸，并按EXIF方向校正，不会先解码整幅原图。
+        
         Args:
-            image (PIL.Image): 输入图片
+            image (ImageSource): 输入图片（PIL图片或未解码的图片数据）
             max_size (int): 最大尺寸
             
         Returns:
             PIL.Image: 调整后的图片
         """
+        if not isinstance(image, Image.Image):
+            return decode_image(image, max_size=max_size)
+        
         width, height = image.size
         
         if width > height:
@@ -79,54 +208,56 @@ class ImageProcessor:
     
     def enhance_image(self, image):
         """
-        增强图片质量
+        增强图片质量（分块处理，中间结果受 TILE_MEMORY_BUDGET 约束）
         
         Args:
-            image (PIL.Image): 输入图片
+            image (PIL.Image | Frame): 输入图片
             
         Returns:
-            PIL.Image: 增强后的图片
+            PIL.Image | Frame: 增强后的图片（与输入同类型）
         """
-        # 转换为numpy数组
-        img_array = np.array(image)
+        import cv2
         
         # 应用锐化滤镜
         kernel = np.array([[-1,-1,-1],
                           [-1, 9,-1],
                           [-1,-1,-1]])
         
-        # 分别处理每个通道
-        if len(img_array.shape) == 3:
-            enhanced = np.zeros_like(img_array)
-            for i in range(img_array.shape[2]):
-                enhanced[:,:,i] = cv2.filter2D(img_array[:,:,i], -1, kernel)
-        else:
-            enhanced = cv2.filter2D(img_array, -1, kernel)
-        
-        # 限制像素值范围
-        enhanced = np.clip(enhanced, 0, 255).astype(np.uint8)
+        def sharpen(img_array):
+            # 分别处理每个通道
+            if len(img_array.shape) == 3:
+                enhanced = np.zeros_like(img_array)
+                for i in range(img_array.shape[2]):
+                    enhanced[:,:,i] = cv2.filter2D(img_array[:,:,i], -1, kernel)
+            else:
+                enhanced = cv2.filter2D(img_array, -1, kernel)
+            
+            # 限制像素值范围
+            return np.clip(enhanced, 0, 255).astype(np.uint8)
         
-        return Image.fromarray(enhanced)
+        # 3x3卷积核：分块四周重叠1个像素
+        channels = Frame.wrap(image).channels
+        return like(image, Frame(map_tiles(image, sharpen, halo=1, bytes_per_pixel=4 * channels)))
     
     def adjust_lighting(self, image, brightness=1.0, contrast=1.0):
         """
-        调整图片亮度和对比度
+        调整图片亮度和对比度（分块处理，float32中间结果只占一个分块）
         
         Args:
-            image (PIL.Image): 输入图片
+            image (PIL.Image | Frame): 输入图片
             brightness (float): 亮度调整因子
             contrast (float): 对比度调整因子
             
         Returns:
-            PIL.Image: 调整后的图片
+            PIL.Image | Frame: 调整后的图片（与输入同类型）
         """
-        # 转换为numpy数组
-        img_array = np.array(image, dtype=np.float32)
-        
-        # 调整亮度和对比度
-        img_array = img_array * contrast + (brightness - 1) * 128
-        
-        # 限制像素值范围
-        img_array = np.clip(img_array, 0, 255).astype(np.uint8)
+        def adjust(img_array):
+            # 调整亮度和对比度
+            img_array = img_array.astype(np.float32) * contrast + (brightness - 1) * 128
+            
+            # 限制像素值范围
+            return np.clip(img_array, 0, 255).astype(np.uint8)
         
-        return Image.fromarray(img_array)
+        # 逐像素运算，分块之间无需重叠
+        channels = Frame.wrap(image).channels
+        return like(image, Frame(map_tiles(image, adjust, halo=0, bytes_per_pixel=11 * channels)))
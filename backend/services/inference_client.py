@@ -0,0 +1,204 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Hashable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# 可重试的HTTP状态码（503单独处理“模型加载中”）
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class InferenceError(Exception):
+    """推理API请求失败"""
+
+class _Flight:
+    """一次进行中的上游请求，供相同请求的并发调用方共享结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[bytes] = None
+        self.error: Optional[BaseException] = None
+
+class InferenceClient:
+    """推理API客户端：连接池复用、连接/读取超时、抖动退避重试、相同请求合并"""
+
+    def __init__(self, api_url: str, api_token: Optional[str] = None,
+                 connect_timeout: float = 5.0, read_timeout: float = 60.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 max_loading_wait: float = 120.0, pool_size: int = 8):
+        """
+        初始化推理API客户端
+
+        Args:
+            api_url (str): API地址
+            api_token (str): 访问令牌
+            connect_timeout (float): 建立连接超时（秒）
+            read_timeout (float): 读取响应超时（秒）
+            max_retries (int): 失败后的最大重试次数（不含模型加载等待）
+            backoff_base (float): 退避基准时间（秒），第n次重试最多等待 base * 2^n
+            backoff_max (float): 单次退避的上限（秒）
+            max_loading_wait (float): 从第一次收到模型加载中（503）起等待加载的总时长上限（秒）
+            pool_size (int): 连接池大小
+        """
+        self.api_url = api_url
+        self.api_token = api_token
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_loading_wait = max_loading_wait
+
+        # 复用Keep-Alive连接，避免每次请求重新握手TLS
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_token:
+            self.session.headers['Authorization'] = f"Bearer {api_token}"
+
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._flights_lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'loading_waits': 0, 'coalesced': 0}
+
+    @classmethod
+    def from_env(cls, api_url: str, api_token: Optional[str] = None) -> 'InferenceClient':
+        """根据环境变量创建客户端"""
+        return cls(
+            api_url,
+            api_token,
+            connect_timeout=float(os.getenv('INFERENCE_CONNECT_TIMEOUT', 5)),
+            read_timeout=float(os.getenv('INFERENCE_READ_TIMEOUT', 60)),
+            max_retries=int(os.getenv('INFERENCE_MAX_RETRIES', 3)),
+            max_loading_wait=float(os.getenv('INFERENCE_MAX_LOADING_WAIT', 120)),
+        )
+
+    def post(self, payload: Dict, key: Optional[Hashable] = None) -> bytes:
+        """
+        发送推理请求；key相同的并发请求只向上游发送一次，共享同一结果
+
+        Args:
+            payload (Dict): JSON请求体
+            key (Hashable): 合并请求使用的键，None表示不合并
+
+        Returns:
+            bytes: 响应内容
+
+        Raises:
+            InferenceError: 重试耗尽或遇到不可重试的错误
+        """
+        if key is None:
+            return self._post_with_retries(payload)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            # 第一个请求卡住时（如读取迟迟不返回）不随之无限等待
+            if not flight.done.wait(self.coalesce_timeout):
+                raise InferenceError(f"等待合并的相同请求超过 {self.coalesce_timeout:g}s")
+            if flight.error is not None:
+                # 抛出新的异常并链接原异常：多个线程并发重抛同一个异常对象会互相追加traceback
+                raise InferenceError(f"合并的相同请求失败: {str(flight.error)}") from flight.error
+            return flight.result
+
+        try:
+            flight.result = self._post_with_retries(payload)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @property
+    def coalesce_timeout(self) -> float:
+        """合并请求的等待上限：第一个请求按重试策略最长可能用时（每次尝试连接+读取超时，加退避与模型加载等待）"""
+        connect_timeout, read_timeout = self.timeout
+        attempts = self.max_retries + 1
+        return attempts * (connect_timeout + read_timeout) + self.max_retries * self.backoff_max + self.max_loading_wait
+
+    def stats(self) -> Dict:
+        """获取请求统计信息"""
+        with self._flights_lock:
+            return dict(self._stats)
+
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+
+    def _post_with_retries(self, payload: Dict) -> bytes:
+        """发送请求，按策略重试"""
+        attempt = 0
+        loading_started: Optional[float] = None
+
+        while True:
+            self._count('requests')
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = InferenceError(f"请求失败: {str(e)}")
+            else:
+                if response.status_code == 200:
+                    return response.content
+
+                error = InferenceError(f"API请求失败: {response.status_code}")
+                if response.status_code not in RETRYABLE_STATUS:
+                    raise error
+
+                # 503“模型加载中”：按上游给出的预计时间等待（至少 backoff_base，避免预计时间为0时空转），
+                # 不消耗重试次数；等待阶段按实际经过的时间限界
+                loading_time = self._loading_time(response)
+                if loading_time is not None:
+                    now = time.monotonic()
+                    if loading_started is None:
+                        loading_started = now
+                    remaining = self.max_loading_wait - (now - loading_started)
+                    if remaining > 0:
+                        delay = min(max(loading_time, self.backoff_base) * random.uniform(0.8, 1.2), remaining)
+                        self._count('loading_waits')
+                        logger.info(f"上游模型加载中，{delay:.1f}s后重试")
+                        time.sleep(delay)
+                        continue
+
+            if attempt >= self.max_retries:
+                raise error
+
+            # 全抖动指数退避
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+            attempt += 1
+            self._count('retries')
+            logger.warning(f"{str(error)}，{delay:.2f}s后第{attempt}次重试")
+            time.sleep(delay)
+
+    @staticmethod
+    def _loading_time(response: requests.Response) -> Optional[float]:
+        """解析503“模型加载中”响应中的预计加载时间"""
+        if response.status_code != 503:
+            return None
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        if not isinstance(body, dict) or 'estimated_time' not in body:
+            return None
+        try:
+            return max(0.0, float(body['estimated_time']))
+        except (TypeError, ValueError):
+            return None
+
+    def _count(self, name: str):
+        """累加统计计数"""
+        with self._flights_lock:
+            self._stats[name] += 1
@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class JobQueueFullError(Exception):
+    """任务队列已满"""
+
+class JobManager:
+    """后台任务管理器：有界工作线程池 + 任务状态跟踪 + 过期清理"""
+
+    def __init__(self, stages: List[str], max_workers: int = 2, max_queue: int = 16,
+                 ttl_seconds: float = 600):
+        """
+        初始化任务管理器
+
+        Args:
+            stages (List[str]): 任务的阶段名称（用于报告进度）
+            max_workers (int): 并发执行的任务数
+            max_queue (int): 最多排队等待的任务数
+            ttl_seconds (float): 任务结束后保留结果的秒数
+        """
+        self.stages = list(stages)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.ttl_seconds = ttl_seconds
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        # 任务状态变化时通知等待者（SSE推送）
+        self._changed = threading.Condition(self._lock)
+
+        logger.info(f"任务管理器初始化完成，工作线程 {max_workers}，队列上限 {max_queue}")
+
+    @classmethod
+    def from_env(cls, stages: List[str]) -> 'JobManager':
+        """根据环境变量创建任务管理器"""
+        return cls(
+            stages,
+            max_workers=int(os.getenv('JOB_WORKERS', os.cpu_count() or 2)),
+            max_queue=int(os.getenv('JOB_QUEUE_SIZE', 16)),
+            ttl_seconds=float(os.getenv('JOB_TTL_SECONDS', 600)),
+        )
+
+    def submit(self, func: Callable, *args) -> str:
+        """
+        提交任务
+
+        Args:
+            func (Callable): 任务函数，调用方式为 func(*args, on_stage=回调)，返回值作为任务结果
+
+        Returns:
+            str: 任务ID
+
+        Raises:
+            JobQueueFullError: 排队任务数已达上限
+        """
+        with self._lock:
+            self._expire_jobs()
+
+            if self._count('queued') >= self.max_queue:
+                raise JobQueueFullError(f"任务队列已满（{self.max_queue}）")
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'status': 'queued',
+                'stages': {stage: 'pending' for stage in self.stages},
+                'result': None,
+                'error': None,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                # 每次状态或阶段变化加一
+                'version': 0,
+            }
+
+        self._executor.submit(self._run, job_id, func, args)
+        logger.info(f"任务已提交: {job_id}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """
+        查询任务状态
+
+        Returns:
+            Dict: 任务状态快照，任务不存在或已过期时返回None
+        """
+        with self._lock:
+            self._expire_jobs()
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    def wait(self, job_id: str, version: Optional[int] = None, timeout: Optional[float] = None) -> Optional[Dict]:
+        """
+        等待任务状态变化
+
+        Args:
+            job_id (str): 任务ID
+            version (int): 调用方已知的版本号，None表示立即返回当前状态
+            timeout (float): 最长等待秒数，超时返回未变化的状态
+
+        Returns:
+            Dict: 任务状态快照（含version），任务不存在或已过期时返回None
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id]['version'] != version, timeout)
+            self._expire_jobs()
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    def stats(self) -> Dict:
+        """获取队列统计信息（用于按CPU核数调整线程池大小）"""
+        with self._lock:
+            self._expire_jobs()
+            return {
+                'workers': self.max_workers,
+                'running': self._count('running'),
+                'queued': self._count('queued'),
+                'max_queue': self.max_queue,
+                'jobs': len(self._jobs),
+            }
+
+    def shutdown(self, wait: bool = True):
+        """关闭工作线程池"""
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job_id: str, func: Callable, args: tuple):
+        """在工作线程中执行任务"""
+        self._update(job_id, status='running', started_at=time.time())
+
+        def on_stage(stage: str, state: str):
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job['stages'][stage] = state
+                    self._touch(job)
+
+        try:
+            result = func(*args, on_stage=on_stage)
+            self._update(job_id, status='done', result=result, finished_at=time.time())
+            logger.info(f"任务完成: {job_id}")
+        except Exception as e:
+            logger.error(f"任务失败: {job_id}: {str(e)}")
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    for stage, state in job['stages'].items():
+                        if state == 'running':
+                            job['stages'][stage] = 'failed'
+                    self._touch(job)
+            self._update(job_id, status='failed', error=str(e), finished_at=time.time())
+
+    def _update(self, job_id: str, **fields):
+        """更新任务字段"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+                self._touch(job)
+
+    def _touch(self, job: Dict):
+        """记录任务变化并唤醒等待者（调用方需持有锁）"""
+        job['version'] += 1
+        self._changed.notify_all()
+
+    def _snapshot(self, job: Dict) -> Dict:
+        """任务状态快照，附带进度（调用方需持有锁）"""
+        snapshot = dict(job)
+        snapshot['stages'] = dict(job['stages'])
+        done_stages = sum(1 for state in job['stages'].values() if state == 'done')
+        snapshot['progress'] = done_stages / len(self.stages) if self.stages else 1.0
+        return snapshot
+
+    def _count(self, status: str) -> int:
+        """统计指定状态的任务数（调用方需持有锁）"""
+        return sum(1 for job in self._jobs.values() if job['status'] == status)
+
+    def _expire_jobs(self):
+        """清理已结束且超过保留时间的任务（调用方需持有锁）"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and now - job['finished_at'] > self.ttl_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,93 @@
+import numpy as np
+from PIL import Image
+from typing import Optional, Tuple
+
+def working_image(image: Image.Image, working_size: int) -> Image.Image:
+    """
+    将图片缩小到工作分辨率（最长边不超过working_size）
+
+    先用整数倍的 Image.reduce（盒式平均）快速降到目标尺寸附近，
+    再在小图上做一次高质量缩放。
+
+    Args:
+        image (PIL.Image): 原始图片
+        working_size (int): 工作分辨率的最长边
+
+    Returns:
+        PIL.Image: 缩小后的图片，原图不超过working_size时原样返回
+    """
+    width, height = image.size
+    longest = max(width, height)
+    if working_size <= 0 or longest <= working_size:
+        return image
+
+    scale = working_size / longest
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    factor = longest // working_size
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.resize(target, Image.Resampling.LANCZOS)
+
+def upsample_alpha(alpha: Image.Image, guide: Image.Image, guide_low: Optional[Image.Image] = None,
+                   radius: int = 1, eps: float = 1e-3) -> Image.Image:
+    """
+    把低分辨率alpha遮罩上采样到引导图尺寸，并用快速引导滤波做边缘感知细化
+
+    引导滤波的线性系数 (a, b) 在低分辨率下计算，再双线性放大后作用于全分辨率
+    灰度引导图（He & Sun, Fast Guided Filter），使遮罩边缘贴合原图细节，
+    同时全分辨率上只需要少量逐像素运算。
+
+    Args:
+        alpha (PIL.Image): 低分辨率alpha遮罩（L模式）
+        guide (PIL.Image): 全分辨率原图
+        guide_low (PIL.Image): 与alpha同尺寸的低分辨率原图（通常就是送去分割的工作图），默认由guide缩小得到
+        radius (int): 低分辨率下的滤波半径（像素）
+        eps (float): 正则化系数，越大越平滑
+
+    Returns:
+        PIL.Image: 与guide同尺寸的alpha遮罩（L模式）
+    """
+    import cv2
+
+    full_size = guide.size
+    low_size = alpha.size
+
+    guide_gray = guide.convert('L')
+    if guide_low is None or guide_low.size != low_size:
+        guide_low = guide_gray.resize(low_size, Image.Resampling.BILINEAR)
+    guide_low = np.asarray(guide_low.convert('L'), dtype=np.float32) / 255.0
+    alpha_low = np.asarray(alpha.convert('L'), dtype=np.float32) / 255.0
+
+    a_low, b_low = _guided_filter_coefficients(guide_low, alpha_low, radius, eps)
+    b_low *= 255.0
+
+    # 放大线性系数并作用于全分辨率引导图（0~255）: q = A * I + 255 * B
+    a_full = cv2.resize(a_low, full_size, interpolation=cv2.INTER_LINEAR)
+    b_full = cv2.resize(b_low, full_size, interpolation=cv2.INTER_LINEAR)
+
+    result = cv2.multiply(np.asarray(guide_gray), a_full, dtype=cv2.CV_32F)
+    cv2.add(result, b_full, dst=result)
+
+    # 截断负值后饱和转换为uint8
+    cv2.max(result, 0.0, dst=result)
+    return Image.fromarray(cv2.convertScaleAbs(result))
+
+def _guided_filter_coefficients(guide: np.ndarray, source: np.ndarray, radius: int,
+                                eps: float) -> Tuple[np.ndarray, np.ndarray]:
+    """计算灰度引导滤波的平均线性系数 (mean_a, mean_b)"""
+    import cv2
+
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    def box(values):
+        return cv2.boxFilter(values, -1, ksize, borderType=cv2.BORDER_REFLECT)
+
+    mean_i = box(guide)
+    mean_p = box(source)
+    cov_ip = box(guide * source) - mean_i * mean_p
+    var_i = box(guide * guide) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return box(a), box(b)
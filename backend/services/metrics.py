@@ -0,0 +1,337 @@
+import bisect
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 耗时直方图的默认桶边界（秒）：覆盖毫秒级的缓存命中到数十秒的上游API调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 内存直方图的桶边界（字节）
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+def _format_value(value: float) -> str:
+    """数值格式化（整数不带小数点，无穷大为+Inf）"""
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    """标签值转义（反斜杠、双引号、换行）"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+class _Metric:
+    """指标基类：按标签值分组保存样本"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        Args:
+            name (str): 指标名称
+            documentation (str): 说明（HELP行）
+            labelnames (Sequence[str]): 标签名称
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        """按标签名顺序取出标签值（标签必须与定义完全一致）"""
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际: {tuple(labels)}")
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as e:
+            raise ValueError(f"指标 {self.name} 缺少标签 {e}") from None
+
+    def collect(self) -> List[str]:
+        """样本行（不含HELP/TYPE）"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        documentation = self.documentation.replace('\\', '\\\\').replace('\n', '\\n')
+        lines = [f'# HELP {self.name} {documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.collect())
+        return '\n'.join(lines)
+
+class Histogram(_Metric):
+    """
+    直方图：每次观测只做一次二分查找和计数加一（持锁时间为微秒级），可在生产环境常开
+
+    桶计数按区间保存，输出时累加为Prometheus要求的累计计数。
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 → [各区间计数（最后一项为+Inf区间）, 总和, 总数]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        """记录一次观测值"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """记录代码块的耗时（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        """某组标签的观测次数"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return series[2] if series else 0
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+        lines = []
+        names = self.labelnames + ('le',)
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(names, key + (_format_value(bound),))} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+class Gauge(_Metric):
+    """仪表：直接设置/增减的数值，或在输出时由回调函数读取（如缓存占用）"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    @contextmanager
+    def track_inprogress(self, **labels) -> Iterator[None]:
+        """代码块执行期间数值加一（如进行中的请求数）"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def set_function(self, function: Callable):
+        """
+        输出时调用function读取数值
+
+        Args:
+            function (Callable): 无标签时返回数值；有标签时返回 {标签值元组: 数值}
+        """
+        self._function = function
+
+    def collect(self) -> List[str]:
+        if self._function is not None:
+            value = self._function()
+            values = value if self.labelnames else {(): value}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(values.items())]
+
+class MetricsRegistry:
+    """指标注册表：按注册顺序输出Prometheus文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Prometheus文本格式（以换行结尾）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+class StepTimer:
+    """累计一次调用内各子步骤的耗时（分块处理时同一步骤执行多次），结束时每个步骤记一次观测"""
+
+    def __init__(self, histogram: Histogram, label: str = 'step'):
+        """
+        Args:
+            histogram (Histogram): 目标直方图
+            label (str): 步骤名称对应的标签
+        """
+        self.histogram = histogram
+        self.label = label
+        self.totals: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, step: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[step] = self.totals.get(step, 0.0) + time.perf_counter() - start
+
+    def observe(self):
+        """把累计的耗时记入直方图（只调用一次）"""
+        for step, seconds in self.totals.items():
+            self.histogram.observe(seconds, **{self.label: step})
+        self.totals = {}
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def resident_memory_bytes() -> Optional[int]:
+    """当前进程的常驻内存（字节），读取 /proc/self/statm，不可用时返回None"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemorySampler:
+    """
+    请求级内存峰值采样
+
+    后台线程在有请求进行时按固定间隔读取进程常驻内存（每次只读一个/proc文件，约数微秒），
+    请求结束时记录期间的峰值相对开始时的增量。没有进行中的请求时线程休眠，不产生开销。
+    RSS是进程级的：并发请求期间的峰值会计入每个重叠的请求，反映的是请求经历的内存压力。
+    """
+
+    def __init__(self, histogram: Histogram, interval: float = 0.01):
+        """
+        Args:
+            histogram (Histogram): 记录峰值增量（字节）的直方图
+            interval (float): 采样间隔（秒），0表示不采样
+        """
+        self.histogram = histogram
+        self.interval = interval
+        self.enabled = interval > 0 and resident_memory_bytes() is not None
+        # 进行中的请求：令牌 → [开始时的RSS, 期间的峰值RSS]
+        self._active: Dict[object, List[int]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, histogram: Histogram) -> 'MemorySampler':
+        """根据环境变量创建（METRICS_MEMORY_SAMPLE_MS，0表示关闭）"""
+        return cls(histogram, interval=float(os.getenv('METRICS_MEMORY_SAMPLE_MS', 10)) / 1000.0)
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """采样代码块执行期间的内存峰值"""
+        if not self.enabled:
+            yield
+            return
+
+        token = object()
+        start = resident_memory_bytes()
+        with self._cond:
+            self._active[token] = [start, start]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name='memory-sampler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        try:
+            yield
+        finally:
+            end = resident_memory_bytes()
+            with self._cond:
+                start, peak = self._active.pop(token)
+            self.histogram.observe(max(peak, end) - start)
+
+    def _sample_loop(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+            rss = resident_memory_bytes()
+            with self._cond:
+                for sample in self._active.values():
+                    if rss > sample[1]:
+                        sample[1] = rss
+            time.sleep(self.interval)
+
+# ---- 服务指标（进程内共享） ----
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'cosplay_stage_duration_seconds', '流水线各阶段耗时（decode/recognize/generate/extract/blend/encode）',
+    ['stage']))
+BACKGROUND_SECONDS = REGISTRY.register(Histogram(
+    'cosplay_background_duration_seconds', '背景生成耗时，按来源（pack/cache/api/local/error；API失败后回退本地为fallback）', ['source']))
+BLEND_STEP_SECONDS = REGISTRY.register(Histogram(
+    'cosplay_blend_step_duration_seconds', '图像融合各子步骤耗时（分块融合时为各块之和）', ['step']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'cosplay_request_duration_seconds', '处理请求的总耗时，按结果缓存状态（miss/hit/coalesced）', ['cache']))
+REQUEST_PEAK_MEMORY = REGISTRY.register(Histogram(
+    'cosplay_request_peak_memory_bytes', '执行流水线期间进程常驻内存峰值相对开始时的增量',
+    buckets=MEMORY_BUCKETS))
+REQUEST_FRAME_COPIES = REGISTRY.register(Histogram(
+    'cosplay_request_frame_copies', '计算一次结果期间的整帧拷贝次数（解码、格式转换、融合画布等）',
+    buckets=(1, 2, 4, 8, 16, 32, 64)))
+ADMISSION_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'cosplay_admission_wait_seconds', '请求等待准入预算的时间，按结果（admitted/queue_full/timeout）', ['outcome']))
+IN_FLIGHT = REGISTRY.register(Gauge('cosplay_requests_in_flight', '正在执行的处理请求数'))
+ADMISSION_LOAD = REGISTRY.register(Gauge(
+    'cosplay_admission_load', '准入控制的当前负载（in_flight/pixels/memory/waiting/background_waiting）', ['resource']))
+CACHE_BYTES = REGISTRY.register(Gauge('cosplay_cache_bytes', '各缓存的内存占用（字节）', ['cache']))
+CACHE_ENTRIES = REGISTRY.register(Gauge('cosplay_cache_entries', '各缓存的条目数', ['cache']))
+JOBS = REGISTRY.register(Gauge('cosplay_jobs', '后台任务数，按状态', ['state']))
+PROCESS_MEMORY = REGISTRY.register(Gauge('process_resident_memory_bytes', '进程常驻内存（字节）'))
+PROCESS_MEMORY.set_function(lambda: resident_memory_bytes() or 0)
+
+REQUEST_MEMORY = MemorySampler.from_env(REQUEST_PEAK_MEMORY)
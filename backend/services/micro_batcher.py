@@ -0,0 +1,105 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """微批处理器：把并发提交的单个请求在短时间窗口内合并为一批处理"""
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 max_wait_ms: float = 5.0, name: str = 'micro-batcher'):
+        """
+        初始化微批处理器
+
+        Args:
+            process_batch (Callable): 批处理函数，输入N个请求，按顺序返回N个结果
+            max_batch_size (int): 单批最大请求数
+            max_wait_ms (float): 收到第一个请求后最多等待其它请求的毫秒数
+            name (str): 后台线程名称
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stats = {'batches': 0, 'items': 0, 'max_batch': 0, 'fallbacks': 0}
+        self._stats_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """
+        提交单个请求
+
+        Returns:
+            Future: 该请求的结果
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        """提交请求并等待结果"""
+        return self.submit(item).result()
+
+    def stats(self) -> Dict:
+        """获取批处理统计信息"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['mean_batch'] = stats['items'] / stats['batches'] if stats['batches'] else 0.0
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _worker(self):
+        """后台线程：收集一批请求并处理"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._run(batch)
+
+    def _run(self, batch: List):
+        """处理一批请求并回填结果；整批失败时逐个重新处理，只有出错的请求收到异常"""
+        items = [item for item, _ in batch]
+        try:
+            results = self._process(items)
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"批处理失败: {str(e)}")
+                batch[0][1].set_exception(e)
+                return
+            logger.warning(f"批处理失败，逐个重新处理 {len(batch)} 个请求: {str(e)}")
+            with self._stats_lock:
+                self._stats['fallbacks'] += 1
+            for item, future in batch:
+                try:
+                    future.set_result(self._process([item])[0])
+                except Exception as item_error:
+                    future.set_exception(item_error)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['items'] += len(batch)
+            self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+
+    def _process(self, items: List) -> List:
+        """调用批处理函数并校验结果数量"""
+        results = self.process_batch(items)
+        if len(results) != len(items):
+            raise RuntimeError(f"批处理结果数量不匹配: {len(results)} != {len(items)}")
+        return results
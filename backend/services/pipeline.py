@@ -0,0 +1,261 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Union
+
+from PIL import Image
+
+from services.character_recognizer import CharacterRecognizer
+from services.background_generator import BackgroundGenerator
+from services.background_pack import BackgroundAsset
+from services.image_blender import ImageBlender
+from services.frame import Frame, metering
+from services.frame_pool import FramePool
+from services.image_io import CopyMeter, ImageSource, decode_image
+from services.matting import upsample_alpha, working_image
+from services.metrics import STAGE_SECONDS
+from services.session_manager import rembg_available
+from services.micro_batcher import MicroBatcher
+from services.stage_scheduler import Stage, StageScheduler
+
+logger = logging.getLogger(__name__)
+
+# 流水线阶段（拓扑顺序）：抠图与“识别 → 背景生成”互不依赖，并发执行
+PIPELINE_STAGES = ['recognize', 'generate', 'extract', 'blend']
+# 预览优先模式的全分辨率阶段：角色沿用预览的识别结果，遮罩由预览的粗遮罩引导放大
+REFINE_STAGES = ['generate', 'extract', 'blend']
+
+StageCallback = Callable[[str, str], None]
+
+class FusionPipeline:
+    """角色扮演融合流水线：(角色识别 → 背景生成) ∥ 人物抠图 → 图像融合"""
+
+    def __init__(self, recognizer: Optional[CharacterRecognizer] = None,
+                 generator: Optional[BackgroundGenerator] = None,
+                 processor=None,
+                 blender: Optional[ImageBlender] = None,
+                 frame_pool: Optional[FramePool] = None):
+        """
+        初始化流水线
+
+        Args:
+            recognizer (CharacterRecognizer): 角色识别器
+            generator (BackgroundGenerator): 背景生成器
+            processor (ImageProcessor): 图像处理器，默认在首次抠图时创建
+            blender (ImageBlender): 图像融合器
+            frame_pool (FramePool): 融合阶段的进程池（帧经共享内存交接），默认按 CPU_POOL_WORKERS 创建
+                （工作进程使用与 blender 相同的参数），未配置时在本进程内融合
+        """
+        self.recognizer = recognizer or CharacterRecognizer()
+        self.generator = generator or BackgroundGenerator()
+        self.blender = blender or ImageBlender()
+        self.frame_pool = frame_pool if frame_pool is not None else FramePool.from_env(self.blender.config())
+        self._processor = processor
+        self._processor_lock = threading.Lock()
+        self._processor_unavailable = False
+
+        # 上传图片的最长边上限（解码时直接缩小，JPEG按DCT缩放），0表示保持原尺寸
+        self.max_image_size = int(os.getenv('MAX_IMAGE_SIZE', 0))
+        # 预览优先模式下预览图的最长边
+        self.preview_size = int(os.getenv('PREVIEW_SIZE', 512))
+
+        # 抠图微批处理：并发请求在等待窗口内合并为一批推理，等待时间为0时关闭
+        self.segment_batch_wait_ms = float(os.getenv('SEGMENT_BATCH_WAIT_MS', 5))
+        self.segment_max_batch = int(os.getenv('SEGMENT_MAX_BATCH', 8))
+        self._segment_batcher: Optional[MicroBatcher] = None
+
+        # 阶段依赖：背景生成需要角色，融合需要背景和人物。
+        # 依赖链在请求线程上执行，共享线程池只执行并行分支（每个请求最多占用一个线程），默认CPU核数
+        stage_workers = int(os.getenv('PIPELINE_STAGE_WORKERS', 0)) or os.cpu_count() or 4
+        self._stage_executor = ThreadPoolExecutor(max_workers=stage_workers, thread_name_prefix='stage-worker')
+        self.scheduler = StageScheduler([
+            Stage('recognize', lambda results: self.recognizer.recognize_character(results['image'])),
+            Stage('generate', self._generate_stage, deps=['recognize']),
+            Stage('extract', self._extract_stage),
+            Stage('blend', self._blend_stage, deps=['generate', 'extract']),
+        ], executor=self._stage_executor)
+        self.refine_scheduler = StageScheduler([
+            Stage('generate', self._generate_stage),
+            Stage('extract', self._refine_extract_stage),
+            Stage('blend', self._blend_stage, deps=['generate', 'extract']),
+        ], executor=self._stage_executor)
+
+        logger.info("融合流水线初始化完成")
+
+    def process(self, image_data: ImageSource, on_stage: Optional[StageCallback] = None,
+                meter: Optional[CopyMeter] = None) -> Dict:
+        """
+        处理上传的图片（全程在内存中完成，不写临时文件）
+
+        Args:
+            image_data (ImageSource): 上传的图片（字节数据、文件对象、PIL图片或numpy数组）
+            on_stage (StageCallback): 阶段回调 on_stage(阶段名, 'running' | 'done')
+            meter (CopyMeter): 数据拷贝计量器，默认新建
+
+        Returns:
+            Dict: {'character': 角色名称, 'image': 融合结果（帧或PIL图片，在编码时才转换）, 'meter': 拷贝计量,
+                   'timings': 各阶段耗时与关键路径}
+        """
+        meter = meter or CopyMeter()
+
+        with metering(meter):
+            # 只解码一次（按文件头检查后解码到目标尺寸并校正方向），后续各阶段共享解码后的图片
+            image = self._decode(image_data, meter)
+
+            run = self.scheduler.run({'image': image, 'meter': meter}, on_stage=on_stage)
+        results = run['results']
+        self._observe_stages(run['timings'])
+
+        return {'character': results['recognize'], 'image': results['blend'], 'meter': meter,
+                'timings': run['timings']}
+
+    def preview(self, image_data: ImageSource, on_stage: Optional[StageCallback] = None,
+                meter: Optional[CopyMeter] = None) -> Dict:
+        """
+        预览优先模式的第一遍：在 preview_size 工作尺寸上完整执行一遍流水线
+
+        Args:
+            image_data (ImageSource): 上传的图片
+            on_stage (StageCallback): 阶段回调
+            meter (CopyMeter): 数据拷贝计量器，默认新建
+
+        Returns:
+            Dict: {'character', 'image': 预览图, 'meter', 'timings',
+                   'source': 全尺寸解码图, 'working': 预览工作图, 'mask': 预览的粗遮罩（未抠图时为None）}
+                  整个字典传给 refine 计算全分辨率结果
+        """
+        meter = meter or CopyMeter()
+        with metering(meter):
+            image = self._decode(image_data, meter)
+            small = working_image(image, self.preview_size)
+
+            run = self.scheduler.run({'image': small, 'meter': meter}, on_stage=on_stage)
+        results = run['results']
+        self._observe_stages(run['timings'], prefix='preview_')
+
+        # 只有实际执行了抠图时粗遮罩才有意义（rembg不可用时人物为整图）
+        mask = results['extract'].getchannel('A') if self._get_processor() is not None else None
+        return {'character': results['recognize'], 'image': results['blend'], 'meter': meter,
+                'timings': run['timings'], 'source': image, 'working': small, 'mask': mask}
+
+    def refine(self, preview: Dict, on_stage: Optional[StageCallback] = None,
+               meter: Optional[CopyMeter] = None) -> Dict:
+        """
+        预览优先模式的第二遍：沿用预览的识别结果与粗遮罩，在全分辨率上生成背景并融合
+
+        不再执行角色识别和人物分割（分割模型的输入本就只有320×320，全尺寸分割并不更精细），
+        粗遮罩按全尺寸原图做边缘感知放大。
+
+        Args:
+            preview (Dict): preview 的返回值
+            on_stage (StageCallback): 阶段回调（阶段为 REFINE_STAGES）
+            meter (CopyMeter): 数据拷贝计量器，默认沿用预览的计量器
+
+        Returns:
+            Dict: 与 process 相同
+        """
+        meter = meter or preview['meter']
+        with metering(meter):
+            run = self.refine_scheduler.run({
+                'image': preview['source'], 'meter': meter, 'recognize': preview['character'],
+                'preview': preview,
+            }, on_stage=on_stage)
+        self._observe_stages(run['timings'], prefix='refine_')
+
+        return {'character': preview['character'], 'image': run['results']['blend'], 'meter': meter,
+                'timings': run['timings']}
+
+    def cache_params(self) -> Dict:
+        """影响输出结果的流水线参数（用于构建结果缓存键）"""
+        return {
+            'stages': PIPELINE_STAGES,
+            'segment': rembg_available(),
+            'model': os.getenv('REMBG_MODEL', 'u2net'),
+            'working_size': int(os.getenv('SEGMENT_WORKING_SIZE', 0)),
+            'max_image_size': self.max_image_size,
+            'background': 'local' if self.generator.use_local_fallback else 'api',
+            'background_pack': self.generator.packs.fingerprint if self.generator.packs is not None else None,
+        }
+
+    def _decode(self, image_data: ImageSource, meter: CopyMeter) -> Image.Image:
+        """解码上传图片并计入解码耗时与拷贝量"""
+        with STAGE_SECONDS.time(stage='decode'):
+            image = decode_image(image_data, max_size=self.max_image_size)
+        if image is not image_data:
+            meter.add_image('decode', image)
+        return image
+
+    @staticmethod
+    def _observe_stages(timings: Dict, prefix: str = ''):
+        """记录各阶段耗时"""
+        for name, span in timings['stages'].items():
+            STAGE_SECONDS.observe(span['duration_ms'] / 1000.0, stage=prefix + name)
+
+    def _generate_stage(self, results: Dict) -> Union[Image.Image, BackgroundAsset]:
+        """背景生成阶段（资源包背景不在此处取像素，由融合阶段按实际尺寸取最近层级）"""
+        asset = self.generator.packed_background(results['recognize'])
+        if asset is not None:
+            return asset
+        image = results['image']
+        return self.generator.generate_background(results['recognize'], image.width, image.height)
+
+    def _extract_stage(self, results: Dict) -> Image.Image:
+        """人物抠图阶段"""
+        person = self._extract_person(results['image'])
+        results['meter'].add_image('extract', person)
+        return person
+
+    def _refine_extract_stage(self, results: Dict) -> Image.Image:
+        """全分辨率人物：预览的粗遮罩以原图为引导放大，没有粗遮罩时正常抠图"""
+        preview = results['preview']
+        if preview['mask'] is None:
+            return self._extract_stage(results)
+
+        image = results['image']
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        person = image.convert('RGBA')
+        person.putalpha(upsample_alpha(preview['mask'], image, guide_low=preview['working']))
+        results['meter'].add_image('extract', person)
+        return person
+
+    def _blend_stage(self, results: Dict) -> Union[Image.Image, Frame]:
+        """图像融合阶段（本地融合返回帧，融合画布直接作为结果，编码时才转换为PIL）"""
+        if self.frame_pool is not None:
+            blended = self.frame_pool.blend(results['extract'], results['generate'])
+            results['meter'].add_image('blend', blended)
+            return blended
+        # 本地融合的画布拷贝由融合器自行计入
+        return self.blender.blend_images(Frame.wrap(results['extract']), results['generate'])
+
+    def _extract_person(self, image: Image.Image) -> Image.Image:
+        """人物抠图，rembg不可用时回退为整图（不透明）"""
+        processor = self._get_processor()
+        if self._segment_batcher is not None:
+            return self._segment_batcher(image)
+        if processor is not None:
+            return processor.extract_person(image)
+
+        return image.convert('RGBA')
+
+    def _get_processor(self):
+        """获取图像处理器（模型本身在首次抠图时才加载）"""
+        if self._processor is not None or self._processor_unavailable:
+            return self._processor
+
+        with self._processor_lock:
+            if self._processor is None and not self._processor_unavailable:
+                if rembg_available():
+                    from services.image_processor import ImageProcessor
+                    self._processor = ImageProcessor()
+                    if self.segment_batch_wait_ms > 0:
+                        self._segment_batcher = MicroBatcher(
+                            self._processor.extract_persons,
+                            max_batch_size=self.segment_max_batch,
+                            max_wait_ms=self.segment_batch_wait_ms,
+                            name='segment-batcher')
+                else:
+                    logger.warning("rembg未安装，跳过人物抠图")
+                    self._processor_unavailable = True
+        return self._processor
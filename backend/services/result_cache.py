@@ -0,0 +1,328 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class _Flight:
+    """一次进行中的计算，供相同请求的并发调用方共享结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict] = None
+        self.error: Optional[BaseException] = None
+
+class ResultCache:
+    """
+    内容寻址的处理结果缓存：以上传字节和流水线参数的哈希为键
+
+    两级存储：进程内LRU（按字节预算）+ 磁盘（编码后的图片与元数据，按字节预算淘汰最久未访问的条目）。
+    相同键的并发请求只计算一次，其余请求等待并共享结果。
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, cache_dir: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024, wait_timeout: float = 300.0):
+        """
+        初始化结果缓存
+
+        Args:
+            max_bytes (int): 内存层字节预算，0表示禁用内存层
+            cache_dir (str): 磁盘层目录，None表示禁用磁盘层
+            max_disk_bytes (int): 磁盘层字节预算，0表示不限制
+            wait_timeout (float): 相同请求等待第一个请求计算结果的最长秒数
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.wait_timeout = wait_timeout
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._current_bytes = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'coalesced': 0,
+            'misses': 0,
+            'evictions': 0,
+            'disk_evictions': 0,
+            'bytes_saved': 0,
+            'seconds_saved': 0.0,
+        }
+        # 磁盘层占用（启动时统计已有条目，其他进程写入的条目在淘汰时重新统计）
+        self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+
+        logger.info(f"结果缓存初始化完成，内存预算 {max_bytes} 字节，磁盘目录 {cache_dir or '未启用'}，"
+                    f"磁盘预算 {max_disk_bytes or '不限'} 字节（已用 {self._disk_bytes}）")
+
+    @classmethod
+    def from_env(cls) -> 'ResultCache':
+        """根据环境变量创建缓存"""
+        max_bytes = int(os.getenv('RESULT_CACHE_BYTES', 128 * 1024 * 1024))
+        cache_dir = os.getenv('RESULT_CACHE_DIR', os.path.join('cache', 'results')) or None
+        return cls(max_bytes=max_bytes, cache_dir=cache_dir,
+                   max_disk_bytes=int(os.getenv('RESULT_CACHE_DISK_BYTES', 1024 * 1024 * 1024)),
+                   wait_timeout=float(os.getenv('RESULT_CACHE_WAIT_SECONDS', 300)))
+
+    @staticmethod
+    def make_key(upload: bytes, params: Dict) -> str:
+        """
+        构建缓存键
+
+        Args:
+            upload (bytes): 上传的原始字节
+            params (Dict): 影响输出的流水线参数（需可JSON序列化）
+
+        Returns:
+            str: 十六进制SHA-256摘要
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(upload)
+        return digest.hexdigest()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Dict]) -> Tuple[Dict, str]:
+        """
+        查询缓存，未命中时计算并写入；相同键的并发请求等待第一个请求的结果
+
+        Args:
+            key (str): 缓存键
+            compute (Callable): 计算函数，返回 {'data': 编码后的图片字节, 'mimetype', ...元数据}，
+                可带 'compute_seconds' 记录计算耗时
+
+        Returns:
+            Tuple[Dict, str]: (结果, 'hit' | 'coalesced' | 'miss')
+
+        Raises:
+            TimeoutError: 等待第一个请求的计算结果超过 wait_timeout
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry, 'hit'
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            if not flight.done.wait(self.wait_timeout):
+                raise TimeoutError(f"等待相同请求的计算结果超过 {self.wait_timeout:g}s")
+            if flight.error is not None:
+                raise self._follower_error(flight.error) from flight.error
+            self._record_saved(flight.result)
+            return flight.result, 'coalesced'
+
+        try:
+            with self._lock:
+                self._stats['misses'] += 1
+            flight.result = compute()
+            self.put(key, flight.result)
+            return flight.result, 'miss'
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @staticmethod
+    def _follower_error(error: BaseException) -> BaseException:
+        """
+        合并请求收到的异常：第一个请求异常的副本（保持类型，调用方按类型返回相应的状态码）
+
+        多个线程并发重抛同一个异常对象会互相追加traceback，因此每个等待者抛出各自的副本；无法复制时改为RuntimeError
+        """
+        try:
+            return copy.copy(error)
+        except Exception:
+            return RuntimeError(f"合并的相同请求计算失败: {str(error)}")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        查询缓存（不计算）
+
+        Returns:
+            Dict: 缓存的结果，未命中返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                self._record_saved(entry, locked=True)
+                return entry
+
+        entry = self._load_from_disk(key)
+        if entry is None:
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._record_saved(entry, locked=True)
+            self._store_in_memory(key, entry)
+        return entry
+
+    def put(self, key: str, entry: Dict):
+        """写入缓存（内存层与磁盘层）"""
+        with self._lock:
+            self._store_in_memory(key, entry)
+        self._save_to_disk(key, entry)
+
+    def stats(self) -> Dict:
+        """获取缓存统计信息（含命中率与节省的字节数/计算时间）"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._current_bytes
+            stats['max_bytes'] = self.max_bytes
+            stats['disk_bytes'] = self._disk_bytes
+            stats['max_disk_bytes'] = self.max_disk_bytes
+
+        hits = stats['memory_hits'] + stats['disk_hits'] + stats['coalesced']
+        lookups = hits + stats['misses']
+        stats['hit_ratio'] = hits / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """清空内存层（磁盘层保留）"""
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def _record_saved(self, entry: Dict, locked: bool = False):
+        """累加命中节省的结果字节数与计算时间"""
+        if not locked:
+            with self._lock:
+                return self._record_saved(entry, locked=True)
+        self._stats['bytes_saved'] += len(entry['data'])
+        self._stats['seconds_saved'] += entry.get('compute_seconds', 0.0)
+
+    def _store_in_memory(self, key: str, entry: Dict):
+        """写入内存层并按字节预算淘汰（调用方需持有锁）"""
+        size = len(entry['data'])
+        if size > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._current_bytes -= len(previous['data'])
+
+        self._entries[key] = entry
+        self._current_bytes += size
+
+        while self._current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= len(evicted['data'])
+            self._stats['evictions'] += 1
+
+    def _disk_paths(self, key: str) -> Tuple[str, str]:
+        """缓存键对应的数据文件与元数据文件路径"""
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return f"{base}.bin", f"{base}.json"
+
+    def _load_from_disk(self, key: str) -> Optional[Dict]:
+        """从磁盘层读取"""
+        if not self.cache_dir:
+            return None
+
+        data_path, meta_path = self._disk_paths(key)
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            with open(data_path, 'rb') as f:
+                entry['data'] = f.read()
+            # 元数据文件的修改时间即最近访问时间（磁盘层按此淘汰）
+            os.utime(meta_path)
+            return entry
+        except Exception as e:
+            logger.warning(f"读取结果缓存失败: {str(e)}")
+            return None
+
+    def _save_to_disk(self, key: str, entry: Dict):
+        """写入磁盘层（数据先于元数据写入，元数据存在即表示条目完整）"""
+        if not self.cache_dir:
+            return
+
+        data_path, meta_path = self._disk_paths(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        metadata = {name: value for name, value in entry.items() if name != 'data'}
+        try:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            with open(data_path + suffix, 'wb') as f:
+                f.write(entry['data'])
+            os.replace(data_path + suffix, data_path)
+            with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False)
+            os.replace(meta_path + suffix, meta_path)
+        except Exception as e:
+            logger.warning(f"写入结果缓存失败: {str(e)}")
+            for path in (data_path + suffix, meta_path + suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        with self._lock:
+            self._disk_bytes += os.path.getsize(data_path) + os.path.getsize(meta_path)
+            over_budget = self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _scan_disk(self) -> List[Tuple[float, int, str]]:
+        """磁盘层的完整条目：(最近访问时间, 字节数, 元数据文件路径)"""
+        if not self.cache_dir:
+            return []
+
+        entries = []
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(directory, name)
+                data_path = meta_path[:-len('.json')] + '.bin'
+                try:
+                    entries.append((os.path.getmtime(meta_path),
+                                    os.path.getsize(meta_path) + os.path.getsize(data_path), meta_path))
+                except OSError:
+                    # 其他进程正在写入或淘汰
+                    continue
+        return entries
+
+    def _evict_disk(self):
+        """按最近访问时间淘汰磁盘层条目，直到占用降到预算的90%（留出余量，避免每次写入都重新统计目录）"""
+        entries = sorted(self._scan_disk())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9
+        evicted = 0
+        for _, size, meta_path in entries:
+            if total <= target:
+                break
+            # 先删元数据：读取方看到元数据才认为条目完整
+            for path in (meta_path, meta_path[:-len('.json')] + '.bin'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self._stats['disk_evictions'] += evicted
+        logger.info(f"结果缓存磁盘层淘汰 {evicted} 个条目，当前占用 {total} 字节")
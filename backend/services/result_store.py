@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class ResultStore:
+    """编码后结果图片的内存存储：按字节预算LRU淘汰，并按保留时间过期"""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 3600):
+        """
+        初始化结果存储
+
+        Args:
+            max_bytes (int): 字节预算
+            ttl_seconds (float): 结果保留时间（秒）
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'stored': 0, 'evictions': 0, 'expired': 0}
+
+        logger.info(f"结果存储初始化完成，字节预算 {max_bytes}，保留 {ttl_seconds}s")
+
+    @classmethod
+    def from_env(cls) -> 'ResultStore':
+        """根据环境变量创建结果存储"""
+        return cls(
+            max_bytes=int(os.getenv('RESULT_STORE_BYTES', 256 * 1024 * 1024)),
+            ttl_seconds=float(os.getenv('RESULT_TTL_SECONDS', 3600)),
+        )
+
+    def put(self, data: bytes, mimetype: str, metadata: Optional[Dict] = None,
+            result_id: Optional[str] = None) -> str:
+        """
+        保存结果
+
+        Args:
+            data (bytes): 编码后的图片数据
+            mimetype (str): MIME类型
+            metadata (Dict): 附加信息（如宽高）
+            result_id (str): 指定结果ID（如内容哈希），已存在时只刷新保留时间；默认随机生成
+
+        Returns:
+            str: 结果ID
+        """
+        result_id = result_id or uuid.uuid4().hex
+        entry = {
+            'data': data,
+            'mimetype': mimetype,
+            'etag': hashlib.sha256(data).hexdigest()[:32],
+            'metadata': dict(metadata or {}),
+            'created_at': time.time(),
+        }
+
+        with self._lock:
+            self._expire()
+            previous = self._entries.pop(result_id, None)
+            if previous is not None:
+                self._current_bytes -= len(previous['data'])
+            self._entries[result_id] = entry
+            self._current_bytes += len(data)
+            self._stats['stored'] += 1
+
+            while self._current_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._current_bytes -= len(evicted['data'])
+                self._stats['evictions'] += 1
+
+        return result_id
+
+    def get(self, result_id: str) -> Optional[Dict]:
+        """
+        读取结果
+
+        Returns:
+            Dict: {'data', 'mimetype', 'etag', 'metadata', 'created_at', 'expires_in'}，不存在或已过期时返回None
+        """
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(result_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(result_id)
+
+        result = dict(entry)
+        result['expires_in'] = max(0, int(entry['created_at'] + self.ttl_seconds - time.time()))
+        return result
+
+    def stats(self) -> Dict:
+        """获取存储统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._current_bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _expire(self):
+        """清理过期结果（调用方需持有锁）"""
+        deadline = time.time() - self.ttl_seconds
+        expired = [result_id for result_id, entry in self._entries.items() if entry['created_at'] < deadline]
+        for result_id in expired:
+            self._current_bytes -= len(self._entries.pop(result_id)['data'])
+            self._stats['expired'] += 1
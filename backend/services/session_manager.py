@@ -0,0 +1,163 @@
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 可选的抠图模型：u2net（质量最好）、u2netp（最快、最小）、silueta（u2net的精简版）
+SUPPORTED_MODELS = ('u2net', 'u2netp', 'silueta')
+
+def rembg_available() -> bool:
+    """rembg是否已安装（不实际导入）"""
+    return importlib.util.find_spec('rembg') is not None
+
+def current_rss_bytes() -> int:
+    """当前进程的常驻内存（字节）"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+
+    # 非Linux平台退化为峰值常驻内存（macOS单位为字节，其余为KB），Windows不支持时返回0
+    try:
+        import resource
+    except ImportError:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class SessionManager:
+    """rembg会话管理：延迟加载、进程内共享、fork前预加载与预热"""
+
+    def __init__(self, default_model: str = 'u2net'):
+        """
+        初始化会话管理器（不加载任何模型）
+
+        Args:
+            default_model (str): 默认模型名称
+        """
+        self._check_model(default_model)
+        self.default_model = default_model
+
+        self._sessions: Dict[str, object] = {}
+        self._stats: Dict[str, Dict] = {}
+        self._locks: Dict[str, threading.Lock] = {model: threading.Lock() for model in SUPPORTED_MODELS}
+
+    @classmethod
+    def from_env(cls) -> 'SessionManager':
+        """根据环境变量创建会话管理器"""
+        return cls(default_model=os.getenv('REMBG_MODEL', 'u2net'))
+
+    def get_session(self, model: Optional[str] = None):
+        """
+        获取模型会话，首次调用时加载模型
+
+        Args:
+            model (str): 模型名称，默认使用default_model
+
+        Returns:
+            rembg会话对象
+        """
+        model = model or self.default_model
+        session = self._sessions.get(model)
+        if session is not None:
+            return session
+
+        self._check_model(model)
+        with self._locks[model]:
+            session = self._sessions.get(model)
+            if session is None:
+                session = self._load(model)
+        return session
+
+    def preload(self, models: Optional[Iterable[str]] = None, warm_up: bool = False):
+        """
+        预加载模型。在Gunicorn等预派生服务器fork工作进程之前调用（gunicorn.conf.py 开启了 preload_app），
+        重启工作进程时无需重新加载（部署为单工作进程，不再有多个工作进程共享模型内存页）。
+
+        Args:
+            models (Iterable[str]): 要加载的模型，默认只加载default_model
+            warm_up (bool): 是否在加载后执行一次预热推理
+        """
+        for model in models or [self.default_model]:
+            self.get_session(model)
+            if warm_up:
+                self.warm_up(model)
+
+    def warm_up(self, model: Optional[str] = None) -> float:
+        """
+        执行一次空白图片推理，完成ONNX运行时的延迟初始化
+
+        Returns:
+            float: 预热耗时（秒）
+        """
+        from PIL import Image
+        from rembg import remove
+
+        model = model or self.default_model
+        session = self.get_session(model)
+
+        start = time.perf_counter()
+        remove(Image.new('RGB', (64, 64)), session=session)
+        elapsed = time.perf_counter() - start
+
+        self._stats[model]['warm_up_seconds'] = elapsed
+        logger.info(f"模型 {model} 预热完成，耗时 {elapsed:.2f}s")
+        return elapsed
+
+    def is_loaded(self, model: Optional[str] = None) -> bool:
+        """模型是否已加载"""
+        return (model or self.default_model) in self._sessions
+
+    def stats(self) -> Dict:
+        """
+        获取各模型的加载统计
+
+        Returns:
+            Dict: {模型名称: {'load_seconds', 'rss_delta_bytes', 'warm_up_seconds'}}
+        """
+        return {model: dict(stats) for model, stats in self._stats.items()}
+
+    def _load(self, model: str):
+        """加载模型并记录耗时与常驻内存增量（调用方需持有该模型的锁）"""
+        from rembg import new_session
+
+        rss_before = current_rss_bytes()
+        start = time.perf_counter()
+        session = new_session(model)
+        elapsed = time.perf_counter() - start
+        rss_delta = current_rss_bytes() - rss_before
+
+        self._stats[model] = {
+            'load_seconds': elapsed,
+            'rss_delta_bytes': rss_delta,
+            'warm_up_seconds': None,
+        }
+        self._sessions[model] = session
+
+        logger.info(f"模型 {model} 加载完成，耗时 {elapsed:.2f}s，常驻内存增加 {rss_delta / 1024 / 1024:.1f}MB")
+        return session
+
+    @staticmethod
+    def _check_model(model: str):
+        """校验模型名称"""
+        if model not in SUPPORTED_MODELS:
+            raise ValueError(f"不支持的抠图模型: {model}，可选: {', '.join(SUPPORTED_MODELS)}")
+
+_default_manager: Optional[SessionManager] = None
+_default_manager_lock = threading.Lock()
+
+def get_session_manager() -> SessionManager:
+    """获取进程内共享的会话管理器"""
+    global _default_manager
+    if _default_manager is None:
+        with _default_manager_lock:
+            if _default_manager is None:
+                _default_manager = SessionManager.from_env()
+    return _default_manager
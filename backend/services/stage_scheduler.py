@@ -0,0 +1,172 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+class Stage(NamedTuple):
+    """流水线阶段：func(results) 读取依赖阶段的结果并返回本阶段结果"""
+    name: str
+    func: Callable[[Dict[str, Any]], Any]
+    deps: Sequence[str] = ()
+
+class StageScheduler:
+    """
+    按依赖关系（DAG）调度流水线阶段，互不依赖的阶段并发执行
+
+    每轮就绪的阶段中，下游阶段最多的一个在调用方线程上执行，其余提交到线程池：
+    单条依赖链的流水线不占用线程池，线程池只承担并行分支，不会成为所有请求的并发上限。
+    """
+
+    def __init__(self, stages: List[Stage], max_workers: Optional[int] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """
+        初始化调度器
+
+        Args:
+            stages (List[Stage]): 阶段列表，依赖必须指向已声明的阶段
+            max_workers (int): 并行分支的线程数（所有请求共享），默认CPU核数
+            executor (ThreadPoolExecutor): 共享的线程池（多个调度器共用时传入，此时忽略max_workers）
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self._check_dag()
+        self._descendants = {name: len(self._downstream(name)) for name in self.stages}
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 4,
+                                                        thread_name_prefix='stage-worker')
+
+    def run(self, inputs: Dict[str, Any], on_stage: Optional[Callable[[str, str], None]] = None) -> Dict:
+        """
+        执行一次流水线
+
+        Args:
+            inputs (Dict): 初始输入（阶段可通过results读取）
+            on_stage (Callable): 阶段回调 on_stage(阶段名, 'running' | 'done')
+
+        Returns:
+            Dict: {'results': 各阶段结果（含初始输入）, 'timings': 阶段耗时与关键路径}
+        """
+        report = on_stage or (lambda stage, state: None)
+        results = dict(inputs)
+        spans: Dict[str, Dict[str, float]] = {}
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        origin = time.perf_counter()
+
+        def execute(stage: Stage):
+            start = time.perf_counter()
+            report(stage.name, 'running')
+            value = stage.func(results)
+            end = time.perf_counter()
+            report(stage.name, 'done')
+            return value, start, end
+
+        def record(stage: Stage, outcome: Callable[[], Any]):
+            nonlocal error
+            try:
+                value, start, end = outcome()
+            except Exception as e:
+                logger.error(f"阶段 {stage.name} 失败: {str(e)}")
+                error = error or e
+                return
+            results[stage.name] = value
+            spans[stage.name] = {'start': start - origin, 'end': end - origin}
+
+        while pending or running:
+            # 先收集已完成的并行分支，使依赖它们的阶段尽早就绪
+            for future in [future for future in running if future.done()]:
+                record(running.pop(future), future.result)
+
+            inline = None
+            if error is None:
+                ready = [stage for stage in pending.values() if all(dep in spans for dep in stage.deps)]
+                if ready:
+                    inline = max(ready, key=lambda stage: self._descendants[stage.name])
+                for stage in ready:
+                    del pending[stage.name]
+                    if stage is not inline:
+                        # 阶段在调用方的上下文副本中执行（如请求的拷贝计量器）
+                        context = contextvars.copy_context()
+                        running[self._executor.submit(context.run, execute, stage)] = stage
+
+            if inline is not None:
+                context = contextvars.copy_context()
+                record(inline, functools.partial(context.run, execute, inline))
+                continue
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                record(running.pop(future), future.result)
+
+        if error is not None:
+            raise error
+
+        return {'results': results, 'timings': self._timings(spans, time.perf_counter() - origin)}
+
+    def shutdown(self, wait: bool = True):
+        """关闭线程池（共享的线程池由创建方关闭）"""
+        if self._owns_executor:
+            self._executor.shutdown(wait=wait)
+
+    def _downstream(self, name: str) -> set:
+        """直接或间接依赖该阶段的阶段"""
+        found = set()
+        for stage in self.stages.values():
+            if name in stage.deps and stage.name not in found:
+                found.add(stage.name)
+                found |= self._downstream(stage.name)
+        return found
+
+    def _timings(self, spans: Dict[str, Dict[str, float]], total: float) -> Dict:
+        """汇总各阶段耗时，并沿“最后完成的依赖”回溯出关键路径"""
+        stages = {
+            name: {
+                'start_ms': span['start'] * 1000,
+                'end_ms': span['end'] * 1000,
+                'duration_ms': (span['end'] - span['start']) * 1000,
+            }
+            for name, span in spans.items()
+        }
+
+        path = []
+        current = max(spans, key=lambda name: spans[name]['end']) if spans else None
+        while current is not None:
+            path.append(current)
+            deps = self.stages[current].deps
+            current = max(deps, key=lambda name: spans[name]['end']) if deps else None
+        path.reverse()
+
+        return {
+            'stages': stages,
+            'critical_path': path,
+            'critical_path_ms': sum(stages[name]['duration_ms'] for name in path),
+            'total_ms': total * 1000,
+        }
+
+    def _check_dag(self):
+        """校验依赖存在且无环"""
+        visiting, visited = set(), set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"阶段依赖存在环: {name}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                if dep not in self.stages:
+                    raise ValueError(f"阶段 {name} 依赖未声明的阶段 {dep}")
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
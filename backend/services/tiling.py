@@ -0,0 +1,113 @@
+import math
+import os
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from services.frame import Frame
+
+# 分块处理的默认内存预算（单个分块的中间结果总字节数）
+DEFAULT_TILE_BUDGET = 64 * 1024 * 1024
+# 分块输出区域的最小边长（避免预算过小时重叠区域占比过高）
+MIN_TILE_SIZE = 32
+
+Region = Tuple[slice, slice]
+
+class Tile(NamedTuple):
+    """一个分块：core为写入输出的区域，region为含重叠边缘的输入区域（均为整图坐标）"""
+    core: Region
+    region: Region
+
+    @property
+    def inner(self) -> Region:
+        """core在region内的相对位置（从分块结果中取出有效部分）"""
+        rows, cols = self.core
+        region_rows, region_cols = self.region
+        return (slice(rows.start - region_rows.start, rows.stop - region_rows.start),
+                slice(cols.start - region_cols.start, cols.stop - region_cols.start))
+
+    @property
+    def box(self) -> Tuple[int, int, int, int]:
+        """region对应的PIL裁剪框 (left, top, right, bottom)"""
+        rows, cols = self.region
+        return cols.start, rows.start, cols.stop, rows.stop
+
+def tile_budget_from_env() -> int:
+    """读取分块内存预算（TILE_MEMORY_BUDGET，字节；0表示不分块）"""
+    return int(os.getenv('TILE_MEMORY_BUDGET', DEFAULT_TILE_BUDGET))
+
+def tile_size_for_budget(budget: int, bytes_per_pixel: int, halo: int) -> int:
+    """
+    根据内存预算计算分块输出区域的边长
+
+    Args:
+        budget (int): 单个分块的内存预算（字节）
+        bytes_per_pixel (int): 处理一个像素的中间结果字节数
+        halo (int): 每侧的重叠宽度
+
+    Returns:
+        int: 边长，使 (边长 + 2*halo)² × bytes_per_pixel 不超过预算（不小于MIN_TILE_SIZE）
+    """
+    side = int(math.isqrt(max(0, budget) // max(1, bytes_per_pixel))) - 2 * halo
+    return max(MIN_TILE_SIZE, side)
+
+def plan_tiles(height: int, width: int, tile_size: int, halo: int,
+               bounds: Optional[Region] = None) -> List[Tile]:
+    """
+    把区域划分为互不重叠的输出分块，每个分块的输入区域四周外扩halo（在边界处截断）
+
+    输入区域在边界处截断，滤波在边界的反射填充与整图处理一致；
+    内部边缘多取的halo行列只用于计算，不写入输出，因此分块结果与整图处理逐像素相同。
+
+    Args:
+        height (int): 图片高度
+        width (int): 图片宽度
+        tile_size (int): 输出分块边长
+        halo (int): 每侧的重叠宽度（各级滤波半径之和）
+        bounds (Region): 只划分该区域（如人物ROI），默认整图
+
+    Returns:
+        List[Tile]: 按行优先排列的分块
+    """
+    rows, cols = bounds or (slice(0, height), slice(0, width))
+    tiles = []
+    for y0 in range(rows.start, rows.stop, tile_size):
+        y1 = min(rows.stop, y0 + tile_size)
+        for x0 in range(cols.start, cols.stop, tile_size):
+            x1 = min(cols.stop, x0 + tile_size)
+            tiles.append(Tile(
+                core=(slice(y0, y1), slice(x0, x1)),
+                region=(slice(max(rows.start, y0 - halo), min(rows.stop, y1 + halo)),
+                        slice(max(cols.start, x0 - halo), min(cols.stop, x1 + halo))),
+            ))
+    return tiles
+
+def map_tiles(image: Union[Image.Image, Frame], func: Callable[[np.ndarray], np.ndarray], halo: int,
+              bytes_per_pixel: int, budget: Optional[int] = None) -> np.ndarray:
+    """
+    分块执行逐像素/邻域处理：每次只裁剪一个分块的像素，中间结果受预算约束而与图片尺寸无关
+
+    Args:
+        image (PIL.Image | Frame): 输入图片（帧已有像素数组时分块直接取视图）
+        func (Callable): 处理函数，输入分块像素，返回同尺寸的结果
+        halo (int): 处理函数的邻域半径（逐像素处理为0）
+        bytes_per_pixel (int): 处理一个像素的中间结果字节数
+        budget (int): 单个分块的内存预算，默认取 TILE_MEMORY_BUDGET；0表示整图一次处理
+
+    Returns:
+        np.ndarray: 整图结果
+    """
+    if budget is None:
+        budget = tile_budget_from_env()
+    frame = Frame.wrap(image)
+    width, height = frame.size
+    tile_size = tile_size_for_budget(budget, bytes_per_pixel, halo) if budget > 0 else max(width, height)
+
+    out = None
+    for tile in plan_tiles(height, width, tile_size, halo):
+        result = func(frame.region(tile.box))
+        if out is None:
+            out = np.empty((height, width) + result.shape[2:], dtype=result.dtype)
+        out[tile.core] = result[tile.inner]
+    return out
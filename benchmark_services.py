@@ -0,0 +1,913 @@
+#!/usr/bin/env python3
+"""
+AI角色扮演场景融合器性能基准脚本
+
+用法:
+    python benchmark_services.py blend [--sizes 512 1024 2048 4096]
+    python benchmark_services.py gradient [--sizes 1024x1024 3840x2160]
+    python benchmark_services.py segment [--megapixels 2 6 12 24] [--working-size 1024]
+    python benchmark_services.py recognize [--catalog 10 1000 10000]
+    python benchmark_services.py enhance [--megapixels 1 4 12]
+    python benchmark_services.py roi [--coverage 0.1 0.25 0.5 1.0] [--megapixels 12]
+    python benchmark_services.py tiles [--megapixels 6 12 24] [--budget 64]
+    python benchmark_services.py ingest [--megapixels 8 12 24 48] [--max-size 2048]
+    python benchmark_services.py pool [--workers 1 2 4 8] [--megapixels 4] [--frames 32]
+    python benchmark_services.py encode [--megapixels 0.5 2 4 12]
+    python benchmark_services.py preview [--megapixels 2 4 12] [--preview-size 512]
+    python benchmark_services.py pack [--source-megapixels 12] [--sizes 512x768 1536x2048 2048x1536]
+    python benchmark_services.py admission [--burst 16] [--megapixels 4] [--budget-megapixels 8 0]
+    python benchmark_services.py suite [--quick] [--output results.json] [--update-baseline]
+                                       [--latency-threshold 0.25] [--memory-threshold 0.2]
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import functools
+import numpy as np
+from PIL import Image, ImageDraw
+
+# 添加backend目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+from services.compositor import composite_over
+from services.background_generator import BACKGROUND_THEMES
+from services.gradient import gradient_image, render_vertical_gradient
+
+# 基准套件的默认基线文件（与本脚本一起提交）
+SUITE_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SUITE_VERSION = 1
+
+def _time_call(func, repeat=3):
+    """多次执行取最快耗时（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _synthetic_frame(size, seed=0):
+    """生成带随机alpha的前景和背景"""
+    rng = np.random.default_rng(seed)
+    fg_pixels = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    bg_pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    return fg_pixels, bg_pixels
+
+def _legacy_blend_rows(fg_pixels, bg_pixels, rows):
+    """原逐像素融合实现，只处理前rows行（用于估算整帧耗时）"""
+    result_pixels = np.zeros_like(bg_pixels[:rows], dtype=np.float32)
+    for y in range(rows):
+        for x in range(fg_pixels.shape[1]):
+            fg_pixel = fg_pixels[y, x]
+            bg_pixel = bg_pixels[y, x]
+            alpha = fg_pixel[3] / 255.0
+            if alpha > 0:
+                for c in range(3):
+                    result_pixels[y, x, c] = fg_pixel[c] * alpha + bg_pixel[c] * (1 - alpha)
+            else:
+                result_pixels[y, x] = bg_pixel
+    return np.clip(result_pixels, 0, 255).astype(np.uint8)
+
+def bench_blend(args):
+    """对比逐像素融合与整帧预乘alpha融合"""
+    print(f"{'尺寸':>6} {'逐像素(s)':>12} {'向量化(ms)':>12} {'加速比':>10}")
+    for size in args.sizes:
+        fg_pixels, bg_pixels = _synthetic_frame(size)
+
+        # 逐像素实现太慢，超过legacy_rows时按行采样后按比例估算
+        rows = min(size, args.legacy_rows)
+        legacy = _time_call(lambda: _legacy_blend_rows(fg_pixels, bg_pixels, rows), repeat=1)
+        legacy *= size / rows
+        estimated = '*' if rows < size else ' '
+
+        vectorized = _time_call(lambda: composite_over(fg_pixels, bg_pixels), repeat=args.repeat)
+
+        print(f"{size:>6} {legacy:>11.2f}{estimated} {vectorized * 1000:>12.2f} {legacy / vectorized:>9.0f}x")
+    print("* 按采样行数估算")
+
+def _legacy_line_gradient(stops, width, height):
+    """原逐行draw.line渐变实现"""
+    (_, start), (_, end) = stops
+    image = Image.new('RGB', (width, height), start)
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        color = tuple(int(s + (y / height) * (e - s)) for s, e in zip(start, end))
+        draw.line([(0, y), (width, y)], fill=color)
+    return image
+
+def _parse_size(text):
+    """解析 WxH 格式的尺寸"""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def bench_gradient(args):
+    """对比逐行draw.line与NumPy广播渐变渲染"""
+    stops = BACKGROUND_THEMES['pokemon']
+    print(f"{'尺寸':>10} {'逐行(ms)':>10} {'PIL图片(ms)':>12} {'加速比':>8} {'复用缓冲区(ms)':>14}")
+    for width, height in args.sizes:
+        legacy = _time_call(lambda: _legacy_line_gradient(stops, width, height), repeat=args.repeat)
+        vectorized = _time_call(lambda: gradient_image(stops, width, height), repeat=args.repeat)
+
+        # 渲染到预分配缓冲区（不含分配和PIL转换）
+        buffer = np.empty((height, width, 4), dtype=np.uint8)
+        in_place = _time_call(lambda: render_vertical_gradient(stops, width, height, out=buffer), repeat=args.repeat)
+
+        print(f"{width}x{height:<5} {legacy * 1000:>10.2f} {vectorized * 1000:>12.2f} "
+              f"{legacy / vectorized:>7.1f}x {in_place * 1000:>14.2f}")
+
+def _stub_rembg_module():
+    """rembg不可用时的替身：复现rembg.remove的预处理、遮罩放大和抠图合成，不含模型推理"""
+    import types
+
+    def remove(image, session=None):
+        small = image.convert('RGB').resize((320, 320), Image.Resampling.LANCZOS)
+        prediction = (np.asarray(small, dtype=np.int16).std(axis=2) > 20).astype(np.uint8) * 255
+        mask = Image.fromarray(prediction).resize(image.size, Image.Resampling.LANCZOS)
+        return Image.composite(image.convert('RGBA'), Image.new('RGBA', image.size, 0), mask)
+
+    module = types.ModuleType('rembg')
+    module.new_session = lambda model: object()
+    module.remove = remove
+    return module
+
+def _synthetic_photo(megapixels, seed=0):
+    """生成4:3的合成照片：噪声背景 + 居中的彩色人物轮廓"""
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    rng = np.random.default_rng(seed)
+    small = rng.integers(100, 160, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse([width * 0.35, height * 0.1, width * 0.65, height * 0.95], fill=(230, 200, 20))
+    return image
+
+def bench_segment(args):
+    """按像素数对比原尺寸分割与低分辨率分割 + 遮罩引导放大"""
+    from unittest import mock
+    from services.image_processor import ImageProcessor
+    from services.session_manager import SessionManager, rembg_available
+
+    modules = {}
+    if not rembg_available():
+        modules['rembg'] = _stub_rembg_module()
+        print("rembg未安装：使用替身分割器，耗时不含模型推理")
+
+    with mock.patch.dict(sys.modules, modules):
+        manager = SessionManager(default_model=args.model)
+        full_res = ImageProcessor(session_manager=manager, working_size=0)
+        low_res = ImageProcessor(session_manager=manager, working_size=args.working_size)
+        full_res.extract_person(Image.new('RGB', (64, 64)))
+
+        print(f"{'像素':>6} {'原尺寸(ms)':>12} {'低分辨率(ms)':>14} {'加速比':>8}")
+        for megapixels in args.megapixels:
+            image = _synthetic_photo(megapixels)
+            full = _time_call(lambda: full_res.extract_person(image), repeat=args.repeat)
+            low = _time_call(lambda: low_res.extract_person(image), repeat=args.repeat)
+            print(f"{megapixels:>4}MP {full * 1000:>12.1f} {low * 1000:>14.1f} {full / low:>7.1f}x")
+
+def bench_recognize(args):
+    """按角色目录规模测试索引加载（内存映射）、检索与完整识别耗时"""
+    import tempfile
+    from services.character_index import CharacterIndex, FEATURE_DIM, extract_features
+
+    image = _synthetic_photo(args.megapixels)
+    extract = _time_call(lambda: extract_features(image), repeat=args.repeat)
+    feature = extract_features(image)
+    print(f"特征提取（{args.megapixels}MP）: {extract * 1000:.2f}ms")
+
+    rng = np.random.default_rng(0)
+    print(f"{'角色数':>8} {'索引(KB)':>10} {'加载(ms)':>10} {'检索(ms)':>10} {'识别(ms)':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.catalog:
+            histograms = rng.dirichlet(np.full(FEATURE_DIM, 0.3), size=size).astype(np.float32)
+            path = os.path.join(directory, f"index_{size}")
+            CharacterIndex.from_histograms({f"character_{i}": h for i, h in enumerate(histograms)}).save(path)
+
+            load = _time_call(lambda: CharacterIndex.load(path), repeat=args.repeat)
+            index = CharacterIndex.load(path)
+            search = _time_call(lambda: index.search(feature, k=args.top_k), repeat=args.repeat * 10)
+            index_kb = os.path.getsize(f"{path}.npy") / 1024
+            print(f"{size:>8} {index_kb:>10.1f} {load * 1000:>10.2f} {search * 1000:>10.3f} "
+                  f"{(extract + search) * 1000:>10.2f}")
+
+def _legacy_enhance_chain(foreground, background):
+    """原ImageEnhance链：前景亮度/对比度/饱和度/锐化 + 合成后饱和度/锐化"""
+    from PIL import ImageEnhance, ImageFilter
+
+    def brightness(image):
+        return np.mean(np.array(image.convert('L'))) / 255.0
+
+    current = brightness(foreground)
+    factor = max(0.7, min(1.3, brightness(background) / current)) if current > 0 else 1.0
+    enhanced = ImageEnhance.Brightness(foreground).enhance(factor)
+    enhanced = ImageEnhance.Contrast(enhanced).enhance(1.1)
+    enhanced = ImageEnhance.Color(enhanced).enhance(1.05)
+    enhanced = enhanced.filter(ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3))
+
+    blended = background.copy()
+    blended.paste(enhanced, (0, 0), enhanced)
+    blended = ImageEnhance.Color(blended).enhance(1.05)
+    return blended.filter(ImageFilter.UnsharpMask(radius=1, percent=120, threshold=3))
+
+def _read_status_kb(field):
+    """读取 /proc/self/status 中的内存字段（KB）"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+def _enhance_inputs(megapixels):
+    """生成增强基准的前景（柔和边缘遮罩）和背景"""
+    background = _synthetic_photo(megapixels, seed=1)
+    foreground = _synthetic_photo(megapixels).convert('RGBA')
+    mask = Image.new('L', (256, 256), 0)
+    ImageDraw.Draw(mask).ellipse([64, 16, 192, 250], fill=255)
+    foreground.putalpha(mask.resize(foreground.size, Image.Resampling.BILINEAR))
+    return foreground, background
+
+def _enhance_peak_child(variant, megapixels, tile_budget, conn):
+    """子进程：执行一次融合，报告RSS高水位增量（字节）"""
+    import cv2  # noqa: F401  模块加载本身占用的内存不计入
+    from services.image_blender import ImageBlender
+
+    foreground, background = _enhance_inputs(megapixels)
+    blender = ImageBlender(tile_budget=tile_budget)
+
+    # 写 /proc/self/clear_refs 重置VmHWM，只统计本次调用（仅Linux）
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = _read_status_kb('VmRSS')
+    if variant == 'legacy':
+        _legacy_enhance_chain(foreground, background)
+    else:
+        blender.blend_images(foreground, background)
+    conn.send((_read_status_kb('VmHWM') - baseline) * 1024)
+
+def _peak_rss_delta(variant, megapixels, tile_budget=None):
+    """在全新的子进程中测量一次融合的内存高水位增量（避免父进程已分配的内存被复用）"""
+    return _spawn_peak(_enhance_peak_child, variant, megapixels, tile_budget)
+
+def _spawn_peak(child, *args):
+    """在spawn的子进程中执行child(*args, conn)，返回其报告的内存高水位增量"""
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=child, args=args + (child_conn,))
+    process.start()
+    delta = parent_conn.recv()
+    process.join()
+    return delta
+
+def bench_enhance(args):
+    """对比原ImageEnhance链与融合增强内核的耗时和内存高水位"""
+    from services.image_blender import ImageBlender
+
+    blender = ImageBlender()
+
+    print(f"{'像素':>6} {'原链(ms)':>10} {'融合(ms)':>10} {'加速比':>8} {'原链峰值(MB)':>14} {'融合峰值(MB)':>14}")
+    for megapixels in args.megapixels:
+        foreground, background = _enhance_inputs(megapixels)
+
+        legacy = _time_call(lambda: _legacy_enhance_chain(foreground, background), repeat=args.repeat)
+        current = _time_call(lambda: blender.blend_images(foreground, background), repeat=args.repeat)
+        legacy_peak = _peak_rss_delta('legacy', megapixels)
+        current_peak = _peak_rss_delta('fused', megapixels)
+        print(f"{megapixels:>4}MP {legacy * 1000:>10.1f} {current * 1000:>10.1f} {legacy / current:>7.1f}x "
+              f"{legacy_peak / 2**20:>14.1f} {current_peak / 2**20:>14.1f}")
+
+def _subject_foreground(photo, coverage):
+    """在照片上叠加柔和边缘的椭圆人物alpha，包围盒面积为画面的coverage倍（居中）"""
+    width, height = photo.size
+    scale = coverage ** 0.5
+    box_w, box_h = max(1, int(width * scale)), max(1, int(height * scale))
+    left, top = (width - box_w) // 2, (height - box_h) // 2
+    mask = Image.new('L', (256, 256), 0)
+    ImageDraw.Draw(mask).ellipse([0, 0, 255, 255], fill=255)
+    alpha = Image.new('L', (width, height), 0)
+    alpha.paste(mask.resize((box_w, box_h), Image.Resampling.BILINEAR), (left, top))
+    foreground = photo.convert('RGBA')
+    foreground.putalpha(alpha)
+    return foreground, (box_w, box_h)
+
+def bench_roi(args):
+    """按人物包围盒占画面的比例测试融合耗时（只处理ROI）"""
+    from services.image_blender import ImageBlender
+
+    blender = ImageBlender()
+    background = _synthetic_photo(args.megapixels, seed=1)
+    photo = _synthetic_photo(args.megapixels)
+
+    print(f"{'覆盖率':>8} {'ROI':>12} {'耗时(ms)':>10} {'相对整帧':>10}")
+    full = None
+    for coverage in sorted(args.coverage, reverse=True):
+        foreground, (box_w, box_h) = _subject_foreground(photo, coverage)
+
+        elapsed = _time_call(lambda: blender.blend_images(foreground, background), repeat=args.repeat)
+        full = full or elapsed
+        print(f"{coverage:>7.0%} {f'{box_w}x{box_h}':>12} {elapsed * 1000:>10.1f} {elapsed / full:>9.0%}")
+
+def bench_tiles(args):
+    """对比整块融合与分块融合的耗时和内存高水位（分块预算决定峰值，与图片尺寸无关）"""
+    from services.image_blender import ImageBlender
+
+    budget = args.budget * 2**20
+    whole_blender, tiled_blender = ImageBlender(tile_budget=0), ImageBlender(tile_budget=budget)
+
+    print(f"分块内存预算 {args.budget}MB")
+    print(f"{'像素':>6} {'整块(ms)':>10} {'分块(ms)':>10} {'整块峰值(MB)':>14} {'分块峰值(MB)':>14}")
+    for megapixels in args.megapixels:
+        foreground, background = _enhance_inputs(megapixels)
+
+        whole = _time_call(lambda: whole_blender.blend_images(foreground, background), repeat=args.repeat)
+        tiled = _time_call(lambda: tiled_blender.blend_images(foreground, background), repeat=args.repeat)
+        whole_peak = _peak_rss_delta('fused', megapixels, tile_budget=0)
+        tiled_peak = _peak_rss_delta('fused', megapixels, tile_budget=budget)
+        print(f"{megapixels:>4}MP {whole * 1000:>10.1f} {tiled * 1000:>10.1f} "
+              f"{whole_peak / 2**20:>14.1f} {tiled_peak / 2**20:>14.1f}")
+    print("峰值为融合调用期间的RSS增量，含输出图片（整帧）与前景灰度亮度统计（整帧L）")
+
+def _phone_jpeg(megapixels, orientation=6):
+    """生成带EXIF方向的手机照片JPEG（质量90）"""
+    import io
+
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    _synthetic_photo(megapixels).save(buffer, format='JPEG', quality=90, exif=exif)
+    return buffer.getvalue()
+
+def _legacy_ingest(upload, max_size):
+    """原做法：整幅解码、校正方向后再LANCZOS缩放"""
+    import io
+    from PIL import ImageOps
+    from services.image_processor import ImageProcessor
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(upload)))
+    return ImageProcessor.__new__(ImageProcessor).resize_image(image, max_size)
+
+def _ingest_peak_child(variant, megapixels, max_size, conn):
+    """子进程：解码并缩放一次上传，报告RSS高水位增量（字节）"""
+    from services.image_io import decode_image
+
+    upload = _phone_jpeg(megapixels)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = _read_status_kb('VmRSS')
+    if variant == 'legacy':
+        _legacy_ingest(upload, max_size)
+    else:
+        decode_image(upload, max_size=max_size)
+    conn.send((_read_status_kb('VmHWM') - baseline) * 1024)
+
+def bench_ingest(args):
+    """对比整幅解码后缩放与解码时缩小（JPEG DCT缩放 + reducing_gap）的耗时和内存高水位"""
+    from services.image_io import decode_image
+
+    print(f"目标最长边 {args.max_size}")
+    print(f"{'像素':>6} {'原做法(ms)':>12} {'解码缩小(ms)':>14} {'加速比':>8} {'原峰值(MB)':>12} {'解码缩小峰值(MB)':>18}")
+    for megapixels in args.megapixels:
+        upload = _phone_jpeg(megapixels)
+
+        legacy = _time_call(lambda: _legacy_ingest(upload, args.max_size), repeat=args.repeat)
+        current = _time_call(lambda: decode_image(upload, max_size=args.max_size), repeat=args.repeat)
+        legacy_peak = _spawn_peak(_ingest_peak_child, 'legacy', megapixels, args.max_size)
+        current_peak = _spawn_peak(_ingest_peak_child, 'draft', megapixels, args.max_size)
+        print(f"{megapixels:>4}MP {legacy * 1000:>12.1f} {current * 1000:>14.1f} {legacy / current:>7.1f}x "
+              f"{legacy_peak / 2**20:>12.1f} {current_peak / 2**20:>18.1f}")
+
+def bench_pool(args):
+    """融合吞吐量随工作进程数的扩展（帧经共享内存交接）与单进程多线程对比"""
+    from concurrent.futures import ThreadPoolExecutor
+    from services.frame_pool import FramePool
+    from services.image_blender import ImageBlender
+
+    foreground, background = _enhance_inputs(args.megapixels)
+    blender = ImageBlender()
+
+    def throughput(blend, threads):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            start = time.perf_counter()
+            list(executor.map(lambda _: blend(foreground, background), range(args.frames)))
+        return args.frames / (time.perf_counter() - start)
+
+    print(f"{args.megapixels}MP × {args.frames} 帧，可用CPU {len(os.sched_getaffinity(0))}")
+    print(f"{'并发':>6} {'线程(帧/s)':>12} {'进程池(帧/s)':>14} {'相对1进程':>10} {'扩展效率':>10}")
+    single = None
+    for workers in args.workers:
+        threaded = throughput(blender.blend_images, workers)
+        pool = FramePool(max_workers=workers)
+        try:
+            # 预热：启动全部工作进程并完成各自的模块导入
+            throughput(pool.blend, workers)
+            pooled = throughput(pool.blend, workers)
+        finally:
+            pool.shutdown()
+        single = single or pooled
+        print(f"{workers:>6} {threaded:>12.2f} {pooled:>14.2f} {pooled / single:>9.2f}x "
+              f"{pooled / single / workers:>9.0%}")
+
+# 编码基准的格式与参数组合：(名称, 格式, OutputEncoder参数)
+ENCODE_VARIANTS = [
+    ('png (level 6)', 'png', {'png_compress_level': 6}),
+    ('png (level 1)', 'png', {'png_compress_level': 1}),
+    ('jpeg q85 渐进', 'jpeg', {'jpeg_quality': 85, 'jpeg_progressive': True}),
+    ('jpeg q85 基线', 'jpeg', {'jpeg_quality': 85, 'jpeg_progressive': False}),
+    ('jpeg q75 渐进', 'jpeg', {'jpeg_quality': 75, 'jpeg_progressive': True}),
+    ('webp q80 m0', 'webp', {'webp_quality': 80, 'webp_method': 0}),
+    ('webp q80 m4', 'webp', {'webp_quality': 80, 'webp_method': 4}),
+    ('webp q80 m6', 'webp', {'webp_quality': 80, 'webp_method': 6}),
+]
+
+def bench_encode(args):
+    """各输出格式与编码参数在不同分辨率下的编码耗时和结果大小"""
+    from services.image_blender import ImageBlender
+    from services.output_encoder import OutputEncoder, available_formats
+
+    blender = ImageBlender()
+    formats = available_formats()
+    print(f"{'格式':<16}" + ''.join(f"{f'{mp:g}MP(ms)':>12}{f'{mp:g}MP(KB)':>12}" for mp in args.megapixels)
+          + f"{'相对PNG大小':>12}")
+
+    # 编码对象为实际的融合结果（人物 + 背景）
+    frames = []
+    for megapixels in args.megapixels:
+        foreground, _ = _subject_foreground(_synthetic_photo(megapixels), 0.5)
+        frames.append(blender.blend_images(foreground, _synthetic_photo(megapixels, seed=1)))
+
+    png_sizes = None
+    for label, name, options in ENCODE_VARIANTS:
+        if name not in formats:
+            print(f"{label:<16} 当前Pillow不支持")
+            continue
+        encoder = OutputEncoder(default_format=name, **options)
+        row, sizes = '', []
+        for frame in frames:
+            seconds = _time_call(lambda: encoder.encode(frame, name), repeat=args.repeat)
+            sizes.append(len(encoder.encode(frame, name)))
+            row += f"{seconds * 1000:>12.1f}{sizes[-1] / 1024:>12.0f}"
+        png_sizes = png_sizes or sizes
+        print(f"{label:<16}{row}{sum(sizes) / sum(png_sizes):>11.0%}")
+
+def bench_preview(args):
+    """预览优先模式：首张图片（预览）耗时、全分辨率补算耗时与完整流水线对比"""
+    from unittest import mock
+    from services.image_processor import ImageProcessor
+    from services.output_encoder import OutputEncoder
+    from services.pipeline import FusionPipeline
+    from services.session_manager import SessionManager, rembg_available
+
+    modules = {}
+    if not rembg_available():
+        modules['rembg'] = _stub_rembg_module()
+        print("rembg未安装：使用替身分割器，耗时不含模型推理")
+
+    encoder = OutputEncoder(default_format=args.format)
+    with mock.patch.dict(sys.modules, modules):
+        processor = ImageProcessor(session_manager=SessionManager())
+        pipeline = FusionPipeline(processor=processor)
+        pipeline.preview_size = args.preview_size
+
+        def full(upload):
+            encoder.encode(pipeline.process(upload)['image'], args.format)
+
+        def first_image(upload):
+            preview = pipeline.preview(upload)
+            encoder.encode(preview['image'], args.format)
+            return preview
+
+        print(f"预览尺寸 {args.preview_size}，编码格式 {args.format}")
+        print(f"{'像素':>6} {'完整流水线(ms)':>16} {'首张预览(ms)':>14} {'全分辨率补算(ms)':>18} {'首图占比':>10}")
+        for megapixels in args.megapixels:
+            buffer = io.BytesIO()
+            _synthetic_photo(megapixels).save(buffer, format='JPEG', quality=90)
+            upload = buffer.getvalue()
+
+            full_seconds = _time_call(lambda: full(upload), repeat=args.repeat)
+            preview_seconds = _time_call(lambda: first_image(upload), repeat=args.repeat)
+            preview = first_image(upload)
+            refine_seconds = _time_call(
+                lambda: encoder.encode(pipeline.refine(preview)['image'], args.format), repeat=args.repeat)
+            print(f"{megapixels:>4}MP {full_seconds * 1000:>16.1f} {preview_seconds * 1000:>14.1f} "
+                  f"{refine_seconds * 1000:>18.1f} {preview_seconds / full_seconds:>9.0%}")
+
+class _StubInferenceClient:
+    """桩推理客户端：立即返回预先编码的PNG（只测量API模式下的解码路径）"""
+
+    def __init__(self, width, height):
+        buffer = io.BytesIO()
+        _synthetic_photo(width * height / 1e6).resize((width, height)).save(buffer, format='PNG')
+        self.data = buffer.getvalue()
+
+    def post(self, payload, key=None):
+        return self.data
+
+def bench_pack(args):
+    """背景资源包（最近的mipmap层级 + 一次区域重采样）vs 每次请求整图LANCZOS缩放后裁剪"""
+    import tempfile
+    from services.background_pack import BackgroundPack
+    from services.enhance import mean_luminance
+    from services.image_blender import ImageBlender
+
+    blender = ImageBlender()
+    source = _synthetic_photo(args.source_megapixels, seed=1)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'packs')
+        start = time.perf_counter()
+        BackgroundPack.from_images({'bg': source}).save(path)
+        build = time.perf_counter() - start
+        asset = BackgroundPack.load(path).get('bg')
+        print(f"源背景 {source.width}x{source.height}，{len(asset.levels)} 个层级，构建 {build * 1000:.0f}ms")
+
+        print(f"{'目标尺寸':>10} {'LANCZOS(ms)':>12} {'资源包(ms)':>11} {'加速比':>8} {'层级':>5} {'平均差':>7} "
+              f"{'亮度统计(ms)':>13} {'预计算(ms)':>11}")
+        for width, height in args.sizes:
+            size = (width, height)
+            legacy = _time_call(lambda: blender._resize_background(source, size), repeat=args.repeat)
+            packed = _time_call(lambda: asset.render(size), repeat=args.repeat)
+            diff = np.abs(asset.render(size).astype(np.int16) - np.asarray(blender._resize_background(source, size)))
+
+            resized = np.asarray(blender._resize_background(source, size))
+            stats = _time_call(lambda: mean_luminance(resized), repeat=args.repeat)
+            precomputed = _time_call(lambda: asset.crop_brightness(size), repeat=args.repeat)
+            print(f"{width}x{height:<5} {legacy * 1000:>12.2f} {packed * 1000:>11.2f} {legacy / packed:>7.1f}x "
+                  f"{asset.select_level(size):>5} {diff.mean():>7.2f} {stats * 1000:>13.2f} {precomputed * 1000:>11.3f}")
+
+def bench_admission(args):
+    """突发流量：同时到达的融合请求在准入预算下的内存峰值、完成延迟与503比例（预算0表示不限制）"""
+    import threading
+    import tracemalloc
+    from services.admission import AdmissionController, AdmissionRejectedError
+    from services.image_blender import ImageBlender
+
+    blender = ImageBlender()
+    foreground, _ = _subject_foreground(_synthetic_photo(args.megapixels), 0.5)
+    background = _synthetic_photo(args.megapixels, seed=1)
+    blender.blend_images(foreground, background)
+
+    print(f"{args.burst} 个 {args.megapixels}MP 请求同时到达，等待截止 {args.wait}s")
+    print(f"{'像素预算(MP)':>12} {'完成':>5} {'503':>5} {'内存峰值(MB)':>13} {'完成p50(ms)':>12} "
+          f"{'完成p95(ms)':>12} {'503延迟p50(ms)':>15}")
+    for budget in args.budget_megapixels:
+        controller = AdmissionController(max_pixels=int(budget * 1e6), max_memory=0,
+                                         max_waiting=args.queue, wait_timeout=args.wait)
+        cost = controller.estimate(0, *background.size)
+        done, rejected = [], []
+        gate = threading.Barrier(args.burst)
+
+        def request():
+            gate.wait()
+            start = time.perf_counter()
+            try:
+                with controller.admit(cost):
+                    blender.blend_images(foreground, background)
+            except AdmissionRejectedError:
+                rejected.append(time.perf_counter() - start)
+                return
+            done.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        threads = [threading.Thread(target=request) for _ in range(args.burst)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        done.sort()
+        rejected.sort()
+        label = f"{budget:g}" if budget else '不限'
+        rejected_p50 = f"{rejected[len(rejected) // 2] * 1000:.1f}" if rejected else '-'
+        print(f"{label:>12} {len(done):>5} {len(rejected):>5} {peak / 1e6:>13.1f} "
+              f"{done[len(done) // 2] * 1000:>12.0f} {done[int(len(done) * 0.95)] * 1000:>12.0f} "
+              f"{rejected_p50:>15}")
+
+def _case_recognize(megapixels):
+    from services.character_recognizer import CharacterRecognizer
+
+    recognizer = CharacterRecognizer()
+    image = _synthetic_photo(megapixels)
+    return lambda: recognizer.recognize(image), megapixels
+
+def _case_blend(megapixels, coverage):
+    from services.image_blender import ImageBlender
+
+    blender = ImageBlender()
+    foreground, _ = _subject_foreground(_synthetic_photo(megapixels), coverage)
+    background = _synthetic_photo(megapixels, seed=1)
+    return lambda: blender.blend_images(foreground, background), megapixels
+
+def _case_background(mode, width, height):
+    from services.background_cache import BackgroundCache
+    from services.background_generator import BackgroundGenerator
+
+    # 禁用缓存，每次都执行渲染（本地）或解码（API）
+    client = _StubInferenceClient(width, height) if mode == 'api-stub' else None
+    generator = BackgroundGenerator(cache=BackgroundCache(max_bytes=0), client=client)
+    generator.use_local_fallback = mode == 'local'
+    return lambda: generator.generate_background('皮卡丘', width, height), width * height / 1e6
+
+def _case_processor(operation, megapixels):
+    from services.image_processor import ImageProcessor
+
+    processor = ImageProcessor.__new__(ImageProcessor)
+    if operation == 'ingest':
+        upload = _phone_jpeg(megapixels)
+        return lambda: processor.resize_image(upload, max_size=2048), megapixels
+    photo = _synthetic_photo(megapixels)
+    if operation == 'enhance':
+        return lambda: processor.enhance_image(photo), megapixels
+    return lambda: processor.adjust_lighting(photo, brightness=1.1, contrast=1.1), megapixels
+
+def _case_encode(name, megapixels):
+    from services.output_encoder import OutputEncoder
+
+    encoder = OutputEncoder(default_format=name)
+    photo = _synthetic_photo(megapixels)
+    return lambda: encoder.encode(photo, name), megapixels
+
+def _suite_cases(quick=False):
+    """
+    基准套件用例：名称 → 准备函数
+
+    准备函数生成合成输入，返回 (被测调用, 每次调用处理的百万像素数)。
+    quick模式去掉最大的尺寸，用例名称不变，可与完整基线的同名用例比较。
+    """
+    from services.output_encoder import available_formats
+
+    megapixels = [1, 4] if quick else [1, 4, 12]
+    cases = {}
+    for size in megapixels:
+        cases[f'recognize/{size}MP'] = functools.partial(_case_recognize, size)
+    for size in megapixels:
+        for coverage in (0.25, 1.0):
+            cases[f'blend/{size}MP/{coverage:.0%}'] = functools.partial(_case_blend, size, coverage)
+    for mode in ('local', 'api-stub'):
+        for width, height in ([(1024, 1024)] if quick else [(1024, 1024), (3840, 2160)]):
+            cases[f'background/{mode}/{width}x{height}'] = functools.partial(_case_background, mode, width, height)
+    for size in ([12] if quick else [12, 24]):
+        cases[f'processor/ingest/{size}MP'] = functools.partial(_case_processor, 'ingest', size)
+    cases['processor/enhance/4MP'] = functools.partial(_case_processor, 'enhance', 4)
+    cases['processor/adjust-lighting/4MP'] = functools.partial(_case_processor, 'adjust-lighting', 4)
+    for name in available_formats():
+        cases[f'encode/{name}/4MP'] = functools.partial(_case_encode, name, 4)
+    return cases
+
+def _suite_peak_child(name, quick, conn):
+    """子进程：准备用例后执行一次，报告RSS高水位增量（字节）"""
+    import cv2  # noqa: F401  模块加载本身占用的内存不计入
+
+    call, _ = _suite_cases(quick)[name]()
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = _read_status_kb('VmRSS')
+    call()
+    conn.send((_read_status_kb('VmHWM') - baseline) * 1024)
+
+def _run_case(call, megapixels, repeat, warmup=1):
+    """执行用例，返回延迟分位数与吞吐量"""
+    for _ in range(warmup):
+        call()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    mean = float(latencies.mean())
+    return {
+        'repeat': repeat,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'mean_ms': round(mean, 3),
+        'throughput_per_s': round(1000 / mean, 3),
+        'megapixels_per_s': round(megapixels * 1000 / mean, 3),
+    }
+
+def _suite_environment():
+    """基准运行环境（比较不同机器上的结果时参考）"""
+    import cv2
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'opencv': cv2.__version__,
+    }
+
+def compare_to_baseline(results, baseline, latency_threshold, memory_threshold, memory_slack_mb=2.0):
+    """
+    与基线比较
+
+    p50延迟超过基线的 (1 + latency_threshold) 倍，或内存高水位超过基线的 (1 + memory_threshold) 倍
+    再加 memory_slack_mb 时判定为回归；基线中没有的用例标记为new。
+
+    Returns:
+        Tuple[List[Dict], List[str]]: (逐用例比较结果, 回归的用例名称)
+    """
+    rows, regressions = [], []
+    for name, current in results.items():
+        reference = baseline.get('results', {}).get(name)
+        row = {'name': name, 'p50_ms': current['p50_ms'], 'peak_rss_mb': current.get('peak_rss_mb')}
+        if reference is None:
+            row['status'] = 'new'
+            rows.append(row)
+            continue
+
+        failures = []
+        row['latency_ratio'] = current['p50_ms'] / reference['p50_ms'] if reference['p50_ms'] else 1.0
+        if row['latency_ratio'] > 1 + latency_threshold:
+            failures.append('latency')
+        if current.get('peak_rss_mb') is not None and reference.get('peak_rss_mb') is not None:
+            row['memory_ratio'] = current['peak_rss_mb'] / max(reference['peak_rss_mb'], 0.1)
+            if current['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + memory_threshold) + memory_slack_mb:
+                failures.append('memory')
+
+        row['status'] = f"regressed: {', '.join(failures)}" if failures else 'ok'
+        if failures:
+            regressions.append(name)
+        rows.append(row)
+    return rows, regressions
+
+def _write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+def bench_suite(args):
+    """全部服务的基准套件：延迟分位数、吞吐量、内存高水位，输出JSON并与基线比较"""
+    cases = _suite_cases(args.quick)
+    if args.cases:
+        cases = {name: setup for name, setup in cases.items() if any(part in name for part in args.cases)}
+    repeat = args.repeat or (3 if args.quick else 10)
+
+    results = {}
+    print(f"{'用例':<32} {'p50(ms)':>10} {'p95(ms)':>10} {'次/s':>9} {'MP/s':>9} {'峰值(MB)':>10}")
+    for name, setup in cases.items():
+        call, megapixels = setup()
+        result = _run_case(call, megapixels, repeat)
+        del call
+        if args.memory:
+            result['peak_rss_mb'] = round(_spawn_peak(_suite_peak_child, name, args.quick) / 2**20, 1)
+        results[name] = result
+        peak = f"{result['peak_rss_mb']:.1f}" if args.memory else '-'
+        print(f"{name:<32} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} {result['throughput_per_s']:>9.2f} "
+              f"{result['megapixels_per_s']:>9.1f} {peak:>10}")
+
+    report = {
+        'version': SUITE_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'quick': args.quick,
+        'repeat': repeat,
+        'environment': _suite_environment(),
+        'results': results,
+    }
+    if args.output:
+        _write_json(args.output, report)
+        print(f"结果已写入 {args.output}")
+
+    if args.update_baseline:
+        _write_json(args.baseline, report)
+        print(f"基线已更新: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"基线不存在: {args.baseline}（使用 --update-baseline 生成）")
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    baseline_cpus = baseline.get('environment', {}).get('cpus')
+    if baseline_cpus != report['environment']['cpus']:
+        print(f"注意: 基线在 {baseline_cpus} 个CPU上生成，当前 {report['environment']['cpus']} 个，延迟不可直接比较")
+
+    rows, regressions = compare_to_baseline(results, baseline, args.latency_threshold, args.memory_threshold)
+    print(f"\n与基线比较（延迟阈值 +{args.latency_threshold:.0%}，内存阈值 +{args.memory_threshold:.0%}）")
+    for row in rows:
+        latency = f"{row['latency_ratio']:.2f}x" if 'latency_ratio' in row else '-'
+        memory = f"{row['memory_ratio']:.2f}x" if 'memory_ratio' in row else '-'
+        print(f"{row['name']:<32} 延迟 {latency:>7}  内存 {memory:>7}  {row['status']}")
+
+    if regressions:
+        print(f"\n❌ {len(regressions)} 个用例性能回归: {', '.join(regressions)}")
+        return 1
+    print("\n✅ 未发现性能回归")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='服务性能基准')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    blend_parser = subparsers.add_parser('blend', help='图像融合（alpha合成）')
+    blend_parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096])
+    blend_parser.add_argument('--legacy-rows', type=int, default=64, help='逐像素实现采样行数')
+    blend_parser.add_argument('--repeat', type=int, default=5)
+    blend_parser.set_defaults(func=bench_blend)
+
+    gradient_parser = subparsers.add_parser('gradient', help='本地回退背景渐变渲染')
+    gradient_parser.add_argument('--sizes', type=_parse_size, nargs='+',
+                                 default=[(512, 512), (1024, 1024), (1920, 1080), (3840, 2160)])
+    gradient_parser.add_argument('--repeat', type=int, default=5)
+    gradient_parser.set_defaults(func=bench_gradient)
+
+    segment_parser = subparsers.add_parser('segment', help='人物抠图（原尺寸 vs 低分辨率分割）')
+    segment_parser.add_argument('--megapixels', type=float, nargs='+', default=[2, 6, 12, 24])
+    segment_parser.add_argument('--working-size', type=int, default=1024)
+    segment_parser.add_argument('--model', default='u2net')
+    segment_parser.add_argument('--repeat', type=int, default=3)
+    segment_parser.set_defaults(func=bench_segment)
+
+    recognize_parser = subparsers.add_parser('recognize', help='角色识别（特征索引最近邻检索）')
+    recognize_parser.add_argument('--catalog', type=int, nargs='+', default=[10, 1000, 10000])
+    recognize_parser.add_argument('--megapixels', type=float, default=12)
+    recognize_parser.add_argument('--top-k', type=int, default=5)
+    recognize_parser.add_argument('--repeat', type=int, default=5)
+    recognize_parser.set_defaults(func=bench_recognize)
+
+    enhance_parser = subparsers.add_parser('enhance', help='前景增强与后处理（ImageEnhance链 vs 融合内核）')
+    enhance_parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12])
+    enhance_parser.add_argument('--repeat', type=int, default=3)
+    enhance_parser.set_defaults(func=bench_enhance)
+
+    roi_parser = subparsers.add_parser('roi', help='融合耗时随人物覆盖率的变化（ROI处理）')
+    roi_parser.add_argument('--coverage', type=float, nargs='+', default=[1.0, 0.5, 0.25, 0.1])
+    roi_parser.add_argument('--megapixels', type=float, default=12)
+    roi_parser.add_argument('--repeat', type=int, default=3)
+    roi_parser.set_defaults(func=bench_roi)
+
+    tiles_parser = subparsers.add_parser('tiles', help='分块融合（有界内存）vs 整块融合')
+    tiles_parser.add_argument('--megapixels', type=float, nargs='+', default=[6, 12, 24])
+    tiles_parser.add_argument('--budget', type=int, default=64, help='分块内存预算（MB）')
+    tiles_parser.add_argument('--repeat', type=int, default=3)
+    tiles_parser.set_defaults(func=bench_tiles)
+
+    ingest_parser = subparsers.add_parser('ingest', help='上传解码与缩放（整幅解码 vs 解码时缩小）')
+    ingest_parser.add_argument('--megapixels', type=float, nargs='+', default=[8, 12, 24, 48])
+    ingest_parser.add_argument('--max-size', type=int, default=2048)
+    ingest_parser.add_argument('--repeat', type=int, default=3)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    pool_parser = subparsers.add_parser('pool', help='进程池融合吞吐量扩展（1/2/4/8个工作进程）')
+    pool_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    pool_parser.add_argument('--megapixels', type=float, default=4)
+    pool_parser.add_argument('--frames', type=int, default=32)
+    pool_parser.set_defaults(func=bench_pool)
+
+    encode_parser = subparsers.add_parser('encode', help='结果编码（PNG / 渐进式JPEG / WebP）耗时与大小')
+    encode_parser.add_argument('--megapixels', type=float, nargs='+', default=[0.5, 2, 4, 12])
+    encode_parser.add_argument('--repeat', type=int, default=3)
+    encode_parser.set_defaults(func=bench_encode)
+
+    preview_parser = subparsers.add_parser('preview', help='预览优先模式的首图耗时 vs 完整流水线')
+    preview_parser.add_argument('--megapixels', type=float, nargs='+', default=[2, 4, 12])
+    preview_parser.add_argument('--preview-size', type=int, default=512)
+    preview_parser.add_argument('--format', default='png', choices=['png', 'jpeg', 'webp'])
+    preview_parser.add_argument('--repeat', type=int, default=3)
+    preview_parser.set_defaults(func=bench_preview)
+
+    pack_parser = subparsers.add_parser('pack', help='背景资源包（mipmap层级）vs 整图LANCZOS缩放')
+    pack_parser.add_argument('--source-megapixels', type=float, default=12)
+    pack_parser.add_argument('--sizes', type=_parse_size, nargs='+',
+                             default=[(512, 768), (1536, 2048), (2048, 1536)])
+    pack_parser.add_argument('--repeat', type=int, default=5)
+    pack_parser.set_defaults(func=bench_pack)
+
+    admission_parser = subparsers.add_parser('admission', help='突发流量下准入控制的内存峰值与503比例')
+    admission_parser.add_argument('--burst', type=int, default=16)
+    admission_parser.add_argument('--megapixels', type=float, default=4)
+    admission_parser.add_argument('--budget-megapixels', type=float, nargs='+', default=[8, 0])
+    admission_parser.add_argument('--queue', type=int, default=4)
+    admission_parser.add_argument('--wait', type=float, default=2)
+    admission_parser.set_defaults(func=bench_admission)
+
+    suite_parser = subparsers.add_parser('suite', help='全部服务的基准套件（JSON输出 + 基线回归检查）')
+    suite_parser.add_argument('--quick', action='store_true', help='去掉最大尺寸，每个用例计时3次')
+    suite_parser.add_argument('--cases', nargs='+', help='只运行名称包含这些片段的用例，如 blend recognize')
+    suite_parser.add_argument('--repeat', type=int, help='每个用例的计时次数（默认10，quick模式3）')
+    suite_parser.add_argument('--no-memory', dest='memory', action='store_false',
+                              help='不测量内存高水位（每个用例需启动一个子进程）')
+    suite_parser.add_argument('--output', help='结果JSON的输出路径')
+    suite_parser.add_argument('--baseline', default=SUITE_BASELINE, help='基线JSON路径')
+    suite_parser.add_argument('--update-baseline', action='store_true', help='用本次结果覆盖基线')
+    suite_parser.add_argument('--latency-threshold', type=float, default=0.25,
+                              help='p50延迟相对基线的回归阈值（0.25即慢25%%）')
+    suite_parser.add_argument('--memory-threshold', type=float, default=0.2, help='内存高水位相对基线的回归阈值')
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
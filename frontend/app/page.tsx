@@ -20,6 +20,8 @@ export default function Home() {
     try {
       const formData = new FormData()
       formData.append('image', imageFile)
+      // 预览优先：先返回小尺寸预览，高清结果通过SSE推送
+      formData.append('preview', '1')
       
       // 使用环境变量，如果没有则根据运行环境自动选择
       const apiUrl = process.env.NEXT_PUBLIC_API_URL || 
@@ -40,8 +42,35 @@ export default function Home() {
       }
       
       const result = await response.json()
-      setResultImage(result.resultImage)
+      // 结果图片以二进制地址返回（旧版后端或 inline 模式仍为 data URL）
+      const imageUrl = (item: { resultUrl?: string, resultImage?: string }) =>
+        item.resultUrl ? `${apiUrl}${item.resultUrl}` : item.resultImage ?? null
       setRecognizedCharacter(result.character)
+
+      if (result.preview && result.eventsUrl) {
+        setResultImage(imageUrl(result.preview))
+        setProcessingStatus('预览已生成，正在生成高清结果...')
+        const events = new EventSource(`${apiUrl}${result.eventsUrl}`)
+        events.addEventListener('done', (event) => {
+          setResultImage(imageUrl(JSON.parse((event as MessageEvent).data)))
+          setProcessingStatus('处理完成！')
+          events.close()
+        })
+        events.addEventListener('failed', () => {
+          setProcessingStatus('高清结果生成失败，当前为预览图')
+          events.close()
+        })
+        // 短暂断线由浏览器自动重连（任务过期时服务端会发送 failed 事件）；
+        // 只有浏览器放弃重连（如响应不是SSE）时才停止等待，保留预览图
+        events.onerror = () => {
+          if (events.readyState === EventSource.CLOSED) {
+            setProcessingStatus('高清结果暂不可用，当前为预览图')
+          }
+        }
+        return
+      }
+
+      setResultImage(imageUrl(result))
       setProcessingStatus('处理完成！')
     } catch (error) {
       console.error('处理错误:', error)
@@ -5,16 +5,23 @@ AI角色扮演场景融合器测试脚本
 
 import os
 import sys
+import io
+import time
 import logging
 from PIL import Image, ImageDraw
 import numpy as np
 
 # 添加backend目录到Python路径
 sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+# 测试导入的app不写磁盘结果缓存（需要磁盘层的测试使用tmp_path下的缓存）
+os.environ.setdefault('RESULT_CACHE_DIR', '')
 
 from services.character_recognizer import CharacterRecognizer
 from services.background_generator import BackgroundGenerator
 from services.image_blender import ImageBlender
+from services.background_cache import BackgroundCache
+from services.gradient import render_vertical_gradient
+from services.job_manager import JobManager, JobQueueFullError
 
 def create_test_image():
     """创建一个测试用的角色扮演图片"""
@@ -101,6 +108,1211 @@ def test_services():
         traceback.print_exc()
         return False
 
+def _legacy_blend_pixels(fg_pixels, bg_pixels):
+    """原逐像素融合实现（作为正确性参考）"""
+    result_pixels = np.zeros_like(bg_pixels, dtype=np.float32)
+    for y in range(fg_pixels.shape[0]):
+        for x in range(fg_pixels.shape[1]):
+            fg_pixel = fg_pixels[y, x]
+            bg_pixel = bg_pixels[y, x]
+            alpha = fg_pixel[3] / 255.0
+            if alpha > 0:
+                for c in range(3):
+                    result_pixels[y, x, c] = fg_pixel[c] * alpha + bg_pixel[c] * (1 - alpha)
+            else:
+                result_pixels[y, x] = bg_pixel
+    return np.clip(result_pixels, 0, 255).astype(np.uint8)
+
+def test_blend_with_lighting_matches_legacy():
+    """向量化融合与原逐像素实现结果一致"""
+    rng = np.random.default_rng(0)
+    fg_pixels = rng.integers(0, 256, (48, 64, 4), dtype=np.uint8)
+    fg_pixels[:8, :, 3] = 0
+    fg_pixels[8:16, :, 3] = 255
+    bg_pixels = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+    blender = ImageBlender()
+    result = blender._blend_with_lighting(Image.fromarray(fg_pixels, 'RGBA'), Image.fromarray(bg_pixels, 'RGB'))
+    expected = _legacy_blend_pixels(fg_pixels, bg_pixels)
+
+    diff = np.abs(np.asarray(result).astype(np.int16) - expected.astype(np.int16))
+    assert diff.max() <= 1
+    assert np.array_equal(np.asarray(result)[:16], expected[:16])
+
+def test_blend_with_lighting_falls_back_on_size_mismatch():
+    """尺寸不一致时回退到简单融合"""
+    blender = ImageBlender()
+    foreground = Image.new('RGBA', (32, 32), (255, 0, 0, 128))
+    background = Image.new('RGB', (64, 48), (0, 0, 255))
+    result = blender._blend_with_lighting(foreground, background)
+    expected = blender._simple_blend(foreground, background)
+    assert result.size == (64, 48)
+    assert np.array_equal(np.asarray(result), np.asarray(expected))
+
+def _legacy_enhance_chain(blender, foreground, background):
+    """原ImageEnhance链：前景亮度/对比度/饱和度/锐化，合成后再饱和度/锐化"""
+    from PIL import ImageEnhance, ImageFilter
+
+    def brightness(image):
+        return np.mean(np.array(image.convert('L'))) / 255.0
+
+    current = brightness(foreground)
+    factor = max(0.7, min(1.3, brightness(background) / current)) if current > 0 else 1.0
+    enhanced = ImageEnhance.Brightness(foreground).enhance(factor)
+    enhanced = ImageEnhance.Contrast(enhanced).enhance(1.1)
+    enhanced = ImageEnhance.Color(enhanced).enhance(1.05)
+    enhanced = enhanced.filter(ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3))
+
+    blended = blender._blend_with_lighting(enhanced, background)
+    blended = ImageEnhance.Color(blended).enhance(1.05)
+    return blended.filter(ImageFilter.UnsharpMask(radius=1, percent=120, threshold=3))
+
+def test_fused_enhancement_matches_legacy_chain():
+    """融合增强内核与原ImageEnhance链在人物区域内容差一致，背景不变，条带处理无接缝"""
+    from PIL import ImageDraw, ImageFilter
+    from services.enhance import color_matrix, enhance_pixels
+
+    foreground = create_test_image().convert('RGBA')
+    alpha = Image.new('L', foreground.size, 0)
+    ImageDraw.Draw(alpha).ellipse([100, 30, 300, 560], fill=255)
+    foreground.putalpha(alpha.filter(ImageFilter.GaussianBlur(4)))
+    rng = np.random.default_rng(0)
+    noise = rng.random((150, 100, 3)) * 60 + np.linspace(40, 180, 100)[None, :, None]
+    background = Image.fromarray(noise.astype(np.uint8)).resize(foreground.size)
+
+    blender = ImageBlender()
+    result = np.asarray(blender.blend_images(foreground, background)).astype(int)
+    expected = np.asarray(_legacy_enhance_chain(blender, foreground, background)).astype(int)
+    diff = np.abs(result - expected)
+    opaque = np.asarray(foreground)[..., 3] == 255
+    assert diff[opaque].mean() < 1.5
+    assert np.percentile(diff[opaque], 99) <= 8
+
+    # 只处理人物区域：透明像素保持背景原样
+    transparent = np.asarray(foreground)[..., 3] == 0
+    assert np.array_equal(result[transparent], np.asarray(background)[transparent])
+    assert np.array_equal(np.asarray(blender.blend_images(Image.new('RGBA', (40, 30)), background.resize((40, 30)))),
+                          np.asarray(background.resize((40, 30))))
+
+    # 条带大小不影响结果
+    pixels = np.asarray(foreground)
+    matrix = color_matrix(1.2, 1.1, 1.05, contrast_mean=100, channels=4)
+    whole = enhance_pixels(pixels, matrix, 150, 3, strip_rows=pixels.shape[0])
+    assert np.array_equal(enhance_pixels(pixels, matrix, 150, 3, strip_rows=7), whole)
+
+def test_tiled_blend_is_seam_free():
+    """分块融合（重叠锐化半径）与整块处理逐像素相同，分块边界无接缝"""
+    from PIL import ImageFilter
+    from services.image_processor import ImageProcessor
+    from services.tiling import plan_tiles
+
+    rng = np.random.default_rng(1)
+    foreground = Image.fromarray(rng.integers(0, 256, (300, 420, 3), dtype=np.uint8)).convert('RGBA')
+    alpha = Image.new('L', foreground.size, 0)
+    ImageDraw.Draw(alpha).ellipse([30, 20, 400, 290], fill=255)
+    foreground.putalpha(alpha.filter(ImageFilter.GaussianBlur(3)))
+    background = Image.fromarray(rng.integers(0, 256, (300, 420, 3), dtype=np.uint8))
+
+    whole = np.asarray(ImageBlender(tile_budget=0).blend_images(foreground, background))
+    # 预算只够约40x40的分块，人物区域被切成上百块
+    tiled_blender = ImageBlender(tile_budget=64 * 64 * 32)
+    tiled = np.asarray(tiled_blender.blend_images(foreground, background))
+    assert np.array_equal(tiled, whole)
+
+    # 分块输出区域不重叠且恰好覆盖整个区域
+    coverage = np.zeros((300, 420), dtype=int)
+    for tile in plan_tiles(300, 420, 37, 6, bounds=(slice(10, 290), slice(5, 400))):
+        coverage[tile.core] += 1
+    assert coverage[10:290, 5:400].min() == 1 and coverage.sum() == 280 * 395
+
+    # ImageProcessor 的锐化与亮度调整分块后与整图处理结果相同
+    import cv2
+    from unittest import mock
+
+    processor = ImageProcessor.__new__(ImageProcessor)
+    pixels = np.asarray(background)
+    kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    sharpened = np.stack([cv2.filter2D(pixels[:, :, i], -1, kernel) for i in range(3)], axis=2)
+    adjusted = np.clip(pixels.astype(np.float32) * 1.1 + 0.2 * 128, 0, 255).astype(np.uint8)
+    with mock.patch.dict(os.environ, {'TILE_MEMORY_BUDGET': '8192'}):
+        assert np.array_equal(np.asarray(processor.enhance_image(background)), sharpened)
+        assert np.array_equal(np.asarray(processor.adjust_lighting(background, brightness=1.2, contrast=1.1)),
+                              adjusted)
+
+def test_frame_pool_blends_through_shared_memory(tmp_path):
+    """进程池融合结果与本进程一致；任务参数只有共享内存描述（资源包背景只有路径与键），结束后共享内存全部释放"""
+    import pickle
+    from unittest import mock
+    from services.background_pack import BackgroundPack
+    from services.frame_pool import FramePool, SharedFrame, parse_affinity
+
+    rng = np.random.default_rng(2)
+    foreground = Image.fromarray(rng.integers(0, 256, (240, 160, 4), dtype=np.uint8))
+    background = Image.fromarray(rng.integers(0, 256, (200, 200, 3), dtype=np.uint8))
+    expected = np.asarray(ImageBlender().blend_images(foreground, background))
+    BackgroundPack.from_images({'bg': background}).save(str(tmp_path / 'packs'))
+    asset = BackgroundPack.load(str(tmp_path / 'packs')).get('bg')
+    expected_asset = np.asarray(ImageBlender().blend_images(foreground, asset))
+
+    assert parse_affinity('0-2, 5,1') == [0, 1, 2, 5]
+    shm_before = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+    # 工作进程使用服务进程传入的融合器参数
+    pool = FramePool(max_workers=2, blender_config=ImageBlender(tile_budget=12345).config())
+    submitted = []
+    returned = []
+    submit = pool._executor.submit
+    run = pool._run
+
+    def record(func, *args):
+        submitted.append(len(pickle.dumps(args)))
+        return submit(func, *args)
+
+    def record_result(*args, **kwargs):
+        returned.append(run(*args, **kwargs))
+        return returned[-1]
+
+    try:
+        with mock.patch.object(pool._executor, 'submit', side_effect=record), \
+                mock.patch.object(pool, '_run', side_effect=record_result):
+            results = [pool.blend(foreground, background) for _ in range(2)]
+            packed = pool.blend(foreground, asset)
+
+        # 工作进程被杀（如OOM）后进程池重建，后续融合不受影响
+        for process in list(pool._executor._processes.values()):
+            process.kill()
+            process.join()
+        recovered = pool.blend(foreground, background)
+    finally:
+        pool.shutdown()
+
+    for result in results + [recovered]:
+        assert np.array_equal(np.asarray(result), expected)
+    assert np.array_equal(np.asarray(packed), expected_asset)
+    assert max(submitted) < 1024
+    assert {item['tile_budget'] for item in returned} == {12345}
+    stats = pool.stats()
+    assert (stats['completed'], stats['restarts'], stats['failed']) == (4, 1, 0)
+    if shm_before:
+        assert set(os.listdir('/dev/shm')) <= shm_before
+
+    with SharedFrame.create((4, 5, 3)) as frame:
+        attached = SharedFrame.attach(frame.descriptor)
+        attached.array[:] = 7
+        attached.close()
+        assert frame.array.sum() == 7 * 60
+
+def test_background_cache_hits_and_immutability(tmp_path):
+    """背景缓存命中计数，且返回的图片不会被调用方破坏"""
+    generator = BackgroundGenerator(cache=BackgroundCache(cache_dir=str(tmp_path)))
+    first = generator.generate_background('皮卡丘', 64, 48)
+    original = np.asarray(first).copy()
+
+    first.paste((255, 0, 0), (0, 0, 64, 48))
+    second = generator.generate_background('皮卡丘', 64, 48)
+
+    assert np.array_equal(np.asarray(second), original)
+    stats = generator.cache.stats()
+    assert stats['misses'] == 1 and stats['memory_hits'] == 1
+
+    # 新进程（新的缓存实例）从磁盘层命中
+    restarted = BackgroundGenerator(cache=BackgroundCache(cache_dir=str(tmp_path)))
+    third = restarted.generate_background('皮卡丘', 64, 48)
+    assert np.array_equal(np.asarray(third), original)
+    assert restarted.cache.stats()['disk_hits'] == 1
+
+def test_background_cache_evicts_by_byte_budget():
+    """超过字节预算时按LRU淘汰"""
+    cache = BackgroundCache(max_bytes=2 * 10 * 10 * 3)
+    for name in ['a', 'b', 'c']:
+        cache.put(cache.make_key(name, '', 10, 10, 'local'), Image.new('RGB', (10, 10)))
+
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert cache.get(cache.make_key('a', '', 10, 10, 'local')) is None
+
+def test_background_pack_serves_mipmap_levels(tmp_path):
+    """资源包按目标尺寸取最近层级，结果与整图LANCZOS缩放裁剪接近，统计量预计算，跨进程只传路径与键"""
+    import pickle
+    from PIL import ImageFilter
+    from services.background_pack import BackgroundAsset, BackgroundPack, main as build_pack
+    from services.enhance import mean_luminance
+
+    rng = np.random.default_rng(5)
+    ramp = np.linspace(0, 255, 900)[None, :, None] + rng.normal(0, 10, (600, 900, 3))
+    source = Image.fromarray(np.clip(ramp, 0, 255).astype(np.uint8)).filter(ImageFilter.GaussianBlur(2))
+    BackgroundPack.from_images({'皮卡丘': source}).save(str(tmp_path / 'packs'))
+
+    pack = BackgroundPack.load(str(tmp_path / 'packs'))
+    asset = pack.get('皮卡丘')
+    assert isinstance(pack.data, np.memmap)
+    assert [level.shape[:2] for level in asset.levels] == [(600, 900), (300, 450), (150, 225), (75, 113), (38, 57)]
+    assert abs(asset.brightness - mean_luminance(np.asarray(source)) / 255.0) < 1e-3
+
+    blender = ImageBlender()
+    for size in [(200, 300), (640, 480), (1200, 800)]:
+        rendered = asset.render(size)
+        expected = np.asarray(blender._resize_background(source, size))
+        assert rendered.shape == expected.shape and rendered.flags.writeable
+        assert np.abs(rendered.astype(np.int16) - expected).mean() < 1
+        assert abs(asset.crop_brightness(size) - mean_luminance(expected) / 255.0) < 0.005
+    assert asset.select_level((200, 300)) == 1 and asset.select_level((1200, 800)) == 0
+
+    restored = pickle.loads(pickle.dumps(asset))
+    assert restored.key == '皮卡丘' and restored.pack.path == str(tmp_path / 'packs')
+
+    # 流水线优先取资源包背景，融合器直接在渲染结果上融合；generate_background 仍返回PIL图片
+    generator = BackgroundGenerator(cache=BackgroundCache(max_bytes=0), packs=pack)
+    background = generator.packed_background('皮卡丘')
+    assert isinstance(background, BackgroundAsset)
+    rendered = generator.generate_background('皮卡丘', 300, 200)
+    assert isinstance(rendered, Image.Image) and rendered.size == (300, 200)
+    assert np.array_equal(np.asarray(rendered), background.render((300, 200)))
+    foreground = source.resize((300, 200)).convert('RGBA')
+    alpha = Image.new('L', (300, 200), 0)
+    ImageDraw.Draw(alpha).ellipse([75, 20, 225, 200], fill=255)
+    foreground.putalpha(alpha)
+    blended = blender.blend_images(foreground, background)
+    reference = blender.blend_images(foreground, blender._resize_background(source, (300, 200)))
+    assert blended.size == (300, 200)
+    assert np.abs(np.asarray(blended).astype(np.int16) - np.asarray(reference)).mean() < 1
+
+    # 构建命令：本地主题表渲染为资源包，本地模式按角色主题命中
+    build_pack([str(tmp_path / 'themes'), '--size', '256'])
+    themes = BackgroundPack.load(str(tmp_path / 'themes'))
+    generator = BackgroundGenerator(cache=BackgroundCache(max_bytes=0), packs=themes)
+    generator.use_local_fallback = True
+    assert generator.packed_background('鸣人') is themes.get('naruto')
+    assert generator.packed_background('未知角色') is themes.get('default')
+
+def _legacy_line_background(theme, width, height):
+    """原逐行draw.line渐变实现（作为正确性参考）"""
+    row_colors = {
+        'pokemon': lambda v: (int(135 + v * 100), 206, 235),
+        'naruto': lambda v: (int(255 - v * 50), 248, 220),
+        'spiderman': lambda v: (int(25 + v * 100), int(25 + v * 100), 112),
+        'batman': lambda v: (int(47 + v * 80),) * 3,
+        'default': lambda v: (int(240 - v * 50), 248, 255),
+    }[theme]
+    image = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        draw.line([(0, y), (width, y)], fill=row_colors(y / height))
+    return image
+
+def test_gradient_themes_match_line_renderer():
+    """主题表渐变与原逐行渲染结果一致"""
+    generator = BackgroundGenerator(cache=BackgroundCache(max_bytes=0))
+    for theme in ['pokemon', 'naruto', 'spiderman', 'batman', 'default']:
+        for width, height in [(1, 1), (37, 101), (640, 480)]:
+            expected = _legacy_line_background(theme, width, height)
+            result = generator._render_theme(theme, width, height)
+            assert np.array_equal(np.asarray(result), np.asarray(expected)), (theme, width, height)
+
+    # 多色标渐变
+    pixels = render_vertical_gradient([(0.0, (0, 0, 0)), (0.5, (200, 100, 0)), (1.0, (0, 0, 0))], 3, 4)
+    assert pixels.shape == (4, 3, 4)
+    assert pixels[:, 0, :3].tolist() == [[0, 0, 0], [100, 50, 0], [200, 100, 0], [100, 50, 0]]
+
+def _upload(image, **fields):
+    """构造上传表单"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    buffer.seek(0)
+    return {'image': (buffer, 'cosplay.png'), **fields}
+
+def test_decode_image_downscales_and_rejects_on_ingest():
+    """上传在解码时直接缩小到目标尺寸并校正EXIF方向；非图片与超限图片在解码前被拒绝"""
+    from unittest import mock
+    import app as app_module
+    from services.image_io import ImageTooLargeError, InvalidImageError, decode_image, probe_image
+    from services.image_processor import ImageProcessor
+
+    # 存储为横向2400x1600、EXIF方向6（显示时顺时针旋转90°）的JPEG
+    photo = create_test_image().resize((1600, 2400)).transpose(Image.Transpose.ROTATE_90)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG', quality=95, exif=exif)
+    upload = buffer.getvalue()
+
+    assert probe_image(upload) == {'format': 'JPEG', 'width': 2400, 'height': 1600, 'orientation': 6}
+
+    from PIL import JpegImagePlugin
+
+    # JPEG在DCT域缩小解码
+    jpeg_draft = JpegImagePlugin.JpegImageFile.draft
+    with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True, side_effect=jpeg_draft) as draft:
+        image = ImageProcessor.__new__(ImageProcessor).resize_image(upload, max_size=600)
+    assert draft.call_args.args[2] is not None and image.size == (400, 600)
+    reference = np.asarray(create_test_image().resize((400, 600))).astype(int)
+    assert np.abs(np.asarray(image.convert('RGB')).astype(int) - reference).mean() < 6
+
+    try:
+        decode_image(b'not an image')
+        assert False, '非图片应被拒绝'
+    except InvalidImageError:
+        pass
+    try:
+        probe_image(upload, max_pixels=1000)
+        assert False, '超限图片应被拒绝'
+    except ImageTooLargeError:
+        pass
+
+    client = app_module.app.test_client()
+    response = client.post('/api/process-image', data={'image': (io.BytesIO(b'%PDF-1.4'), 'a.pdf')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    with mock.patch.dict(os.environ, {'MAX_IMAGE_PIXELS': '1000'}):
+        response = client.post('/api/process-image', data=_upload(create_test_image()),
+                               content_type='multipart/form-data')
+    assert response.status_code == 413
+
+def test_process_image_job_mode():
+    """任务提交模式立即返回任务ID，并可查询分阶段进度与结果"""
+    from app import app
+
+    client = app.test_client()
+    response = client.post('/api/process-image?async=1', data=_upload(create_test_image()),
+                           content_type='multipart/form-data')
+    assert response.status_code == 202
+    job_id = response.get_json()['jobId']
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        job = client.get(f'/api/jobs/{job_id}').get_json()
+        if job['status'] in ('done', 'failed'):
+            break
+        time.sleep(0.05)
+
+    assert job['status'] == 'done'
+    assert job['progress'] == 1.0
+    assert set(job['stages'].values()) == {'done'}
+    assert client.get(job['resultUrl']).data.startswith(b'\x89PNG')
+    assert client.get('/api/jobs/unknown').status_code == 404
+
+def test_gunicorn_config_single_worker():
+    """任务、结果与准入预算保存在进程内存中：部署配置只允许单工作进程"""
+    import runpy
+    from types import SimpleNamespace
+
+    config = runpy.run_path(os.path.join(os.path.dirname(__file__), 'backend', 'gunicorn.conf.py'))
+    assert config['workers'] == 1
+    config['on_starting'](SimpleNamespace(cfg=SimpleNamespace(workers=1)))
+    try:
+        config['on_starting'](SimpleNamespace(cfg=SimpleNamespace(workers=4)))
+        assert False, '多工作进程应拒绝启动'
+    except RuntimeError:
+        pass
+
+def test_result_delivery_binary_and_inline():
+    """结果默认以URL返回二进制图片（ETag/Range），inline=1 保留base64兼容模式"""
+    from app import app
+
+    client = app.test_client()
+    response = client.post('/api/process-image', data=_upload(create_test_image()),
+                           content_type='multipart/form-data')
+    body = response.get_json()
+    assert 'resultImage' not in body
+    assert body['resultType'] == 'image/png' and (body['width'], body['height']) == (400, 600)
+
+    full = client.get(body['resultUrl'])
+    assert full.status_code == 200
+    assert full.mimetype == 'image/png'
+    assert int(full.headers['Content-Length']) == body['resultSize'] == len(full.data)
+    assert 'max-age' in full.headers['Cache-Control']
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    Image.open(io.BytesIO(full.data)).verify()
+
+    etag = full.headers['ETag']
+    assert client.get(body['resultUrl'], headers={'If-None-Match': etag}).status_code == 304
+
+    partial = client.get(body['resultUrl'], headers={'Range': 'bytes=0-99'})
+    assert partial.status_code == 206
+    assert partial.data == full.data[:100]
+    assert partial.headers['Content-Range'] == f"bytes 0-99/{len(full.data)}"
+
+    assert client.get('/api/results/unknown').status_code == 404
+
+    inline = client.post('/api/process-image', data=_upload(create_test_image(), inline='1'),
+                         content_type='multipart/form-data').get_json()
+    assert inline['resultImage'].startswith('data:image/png;base64,')
+    assert 'resultUrl' not in inline
+
+def test_output_format_negotiation_and_encoding():
+    """结果格式按 format 参数或Accept头协商（WebP / 渐进式JPEG / PNG），不同格式分别缓存"""
+    from app import app
+    from services.output_encoder import OutputEncoder, UnsupportedFormatError
+
+    encoder = OutputEncoder(default_format='png')
+    assert encoder.negotiate() == 'png'
+    assert encoder.negotiate(accept='*/*') == 'png'
+    assert encoder.negotiate(accept='image/avif,image/webp,image/apng,*/*;q=0.8') == 'webp'
+    assert encoder.negotiate(accept='image/png;q=0.9, image/jpeg') == 'jpeg'
+    assert encoder.negotiate(accept='image/jpeg, image/webp') == 'webp'
+    assert encoder.negotiate(accept='image/webp;q=0') == 'png'
+    assert encoder.negotiate('JPG', accept='image/webp') == 'jpeg'
+    try:
+        encoder.negotiate('gif')
+        assert False, '不支持的格式应报错'
+    except UnsupportedFormatError:
+        pass
+
+    client = app.test_client()
+    image = create_test_image()
+    responses = {
+        'png': client.post('/api/process-image', data=_upload(image), content_type='multipart/form-data'),
+        'webp': client.post('/api/process-image', data=_upload(image, format='webp'),
+                            content_type='multipart/form-data'),
+        'jpeg': client.post('/api/process-image', data=_upload(image), content_type='multipart/form-data',
+                            headers={'Accept': 'image/jpeg'}),
+    }
+    bodies = {name: response.get_json() for name, response in responses.items()}
+    assert {name: body['resultType'] for name, body in bodies.items()} == {
+        'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+    assert len({body['resultId'] for body in bodies.values()}) == 3
+
+    for name, body in bodies.items():
+        result = client.get(body['resultUrl'])
+        assert result.mimetype == body['resultType']
+        decoded = Image.open(io.BytesIO(result.data))
+        assert decoded.format == {'png': 'PNG', 'webp': 'WEBP', 'jpeg': 'JPEG'}[name]
+        assert decoded.size == (400, 600)
+        if name == 'jpeg':
+            assert decoded.info.get('progressive')
+
+    rejected = client.post('/api/process-image', data=_upload(image, format='bmp'), content_type='multipart/form-data')
+    assert rejected.status_code == 400
+
+def test_metrics_endpoint_reports_stage_latency_and_memory(tmp_path):
+    """/api/metrics 以Prometheus文本格式输出各阶段耗时直方图、进行中请求数、缓存占用与请求内存峰值"""
+    from unittest import mock
+    import app as app_module
+    from services.metrics import Histogram, MemorySampler
+    from services.result_cache import ResultCache
+
+    client = app_module.app.test_client()
+    with mock.patch.object(app_module, 'result_cache', ResultCache(cache_dir=str(tmp_path))):
+        assert client.post('/api/process-image', data=_upload(create_test_image()),
+                           content_type='multipart/form-data').status_code == 200
+        response = client.get('/api/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+
+    for stage in ('decode', 'recognize', 'generate', 'extract', 'blend', 'encode'):
+        assert samples[f'cosplay_stage_duration_seconds_count{{stage="{stage}"}}'] >= 1
+    for step in ('resize', 'analyze', 'enhance', 'composite', 'post_process'):
+        assert samples[f'cosplay_blend_step_duration_seconds_count{{step="{step}"}}'] >= 1
+    assert any(name.startswith('cosplay_background_duration_seconds_count{source=') for name in samples)
+    assert samples['cosplay_request_duration_seconds_count{cache="miss"}'] >= 1
+    assert samples['cosplay_requests_in_flight'] == 0
+    assert samples['cosplay_cache_entries{cache="result_cache"}'] >= 1
+    assert samples['cosplay_cache_bytes{cache="result_store"}'] > 0
+    assert samples['process_resident_memory_bytes'] > 0
+
+    # 桶计数为累计值，+Inf桶等于总数
+    buckets = [value for name, value in samples.items()
+               if name.startswith('cosplay_stage_duration_seconds_bucket{stage="decode"')]
+    assert buckets == sorted(buckets)
+    assert buckets[-1] == samples['cosplay_stage_duration_seconds_count{stage="decode"}']
+
+    # 内存采样：代码块内分配并写入的内存计入峰值增量
+    histogram = Histogram('test_peak_bytes', '测试', buckets=[2**20, 2**30])
+    sampler = MemorySampler(histogram, interval=0.001)
+    if sampler.enabled:
+        with sampler.track():
+            block = np.ones(64 * 2**20, dtype=np.uint8)
+            time.sleep(0.02)
+            del block
+        assert histogram.count() == 1
+        assert 'test_peak_bytes_sum ' in histogram.render()
+        assert histogram._series[()][1] >= 32 * 2**20
+
+def test_preview_first_mode_reuses_preview_and_streams_result(tmp_path):
+    """预览优先模式：先返回小尺寸预览，全分辨率结果沿用预览的角色与粗遮罩，经SSE推送"""
+    import json
+    from unittest import mock
+    import app as app_module
+    from services.pipeline import FusionPipeline
+    from services.result_cache import ResultCache
+
+    class CountingProcessor:
+        def __init__(self):
+            self.sizes = []
+
+        def extract_person(self, image):
+            self.sizes.append(image.size)
+            alpha = Image.new('L', image.size, 0)
+            ImageDraw.Draw(alpha).ellipse([image.width // 4, image.height // 8, image.width * 3 // 4, image.height])
+            person = image.convert('RGBA')
+            person.putalpha(alpha)
+            return person
+
+    processor = CountingProcessor()
+    pipeline = FusionPipeline(processor=processor)
+    pipeline.preview_size = 128
+    upload = _upload(create_test_image())['image'][0].getvalue()
+
+    preview = pipeline.preview(upload)
+    assert preview['image'].size == (85, 128) and preview['source'].size == (400, 600)
+    full = pipeline.refine(preview)
+    assert full['image'].size == (400, 600)
+    assert full['character'] == preview['character']
+    # 全分辨率阶段不再分割，遮罩由预览的粗遮罩放大
+    assert processor.sizes == [(85, 128)]
+    assert set(full['timings']['stages']) == {'generate', 'extract', 'blend'}
+
+    client = app_module.app.test_client()
+    image = create_test_image()
+    with mock.patch.object(app_module, 'result_cache', ResultCache(cache_dir=str(tmp_path))):
+        response = client.post('/api/process-image?preview=1', data=_upload(image),
+                               content_type='multipart/form-data')
+        assert response.status_code == 202
+        body = response.get_json()
+        assert max(body['preview']['width'], body['preview']['height']) == 512
+        assert client.get(body['preview']['resultUrl']).status_code == 200
+
+        stream = client.get(body['eventsUrl'])
+        assert stream.mimetype == 'text/event-stream'
+        events = [block.split('\n', 1) for block in stream.get_data(as_text=True).strip().split('\n\n')
+                  if block.startswith('event:')]
+        assert events[-1][0] == 'event: done'
+        final = json.loads(events[-1][1][len('data: '):])
+        assert (final['width'], final['height']) == (400, 600)
+        assert final['progress'] == 1.0
+        assert client.get(final['resultUrl']).status_code == 200
+
+        # 全分辨率结果已缓存时直接返回最终结果
+        repeat = client.post('/api/process-image?preview=1', data=_upload(image),
+                             content_type='multipart/form-data')
+        assert repeat.status_code == 200 and repeat.get_json()['cache'] == 'hit'
+    assert client.get('/api/jobs/unknown/events').status_code == 404
+
+def test_job_manager_queue_limit_and_ttl():
+    """队列上限与任务过期"""
+    import threading
+    release = threading.Event()
+    manager = JobManager(['work'], max_workers=1, max_queue=1, ttl_seconds=0.05)
+
+    def work(on_stage):
+        on_stage('work', 'running')
+        release.wait(5)
+        on_stage('work', 'done')
+        return 'ok'
+
+    first = manager.submit(work)
+    deadline = time.time() + 5
+    while manager.get(first)['status'] != 'running' and time.time() < deadline:
+        time.sleep(0.01)
+    manager.submit(work)
+    try:
+        manager.submit(work)
+        assert False, '队列已满时应拒绝提交'
+    except JobQueueFullError:
+        pass
+    assert manager.stats()['queued'] == 1
+
+    release.set()
+    manager.shutdown()
+    assert manager.get(first)['result'] == 'ok'
+    time.sleep(0.1)
+    assert manager.get(first) is None
+
+def test_admission_control_sheds_load_with_retry_after():
+    """准入控制：预算内放行、先进先出排队、队列满与超时快速拒绝；接口返回503与Retry-After，健康检查报告负载"""
+    import threading
+    from unittest import mock
+    import app as app_module
+    from services.admission import AdmissionController, AdmissionRejectedError
+    from services.result_cache import ResultCache
+
+    controller = AdmissionController(max_pixels=1000, max_memory=0, max_waiting=1, wait_timeout=0.05)
+    cost = controller.estimate(100, 40, 20, max_size=20)
+    assert cost == (200, 100 + 200 * controller.bytes_per_pixel)
+    big = controller.estimate(0, 30, 30)
+
+    # 预算空闲时超出预算的单个请求也放行
+    with controller.admit(controller.estimate(0, 100, 100)):
+        assert controller.stats()['saturated']
+    assert controller.stats()['in_flight'] == 0
+
+    order = []
+    with controller.admit(big):
+        # 剩余预算不足，等待超时
+        try:
+            controller.acquire(cost)
+            assert False, '预算不足时应超时拒绝'
+        except AdmissionRejectedError as e:
+            assert e.reason == 'timeout' and 1 <= e.retry_after <= 60
+
+        waiter = threading.Thread(target=lambda: (controller.acquire(cost, timeout=5), order.append('queued')))
+        waiter.start()
+        deadline = time.time() + 5
+        while controller.stats()['waiting'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        # 队首在等待时，即使预算足够的小请求也不能插队；队列已满时立即拒绝
+        try:
+            controller.acquire(controller.estimate(0, 1, 1))
+            assert False, '等待队列已满时应立即拒绝'
+        except AdmissionRejectedError as e:
+            assert e.reason == 'queue_full'
+        assert controller.stats()['saturated'] and not order
+    waiter.join(5)
+    assert order == ['queued']
+    controller.release(cost)
+    stats = controller.stats()
+    assert (stats['in_flight'], stats['pixels'], stats['waiting']) == (0, 0, 0)
+    assert (stats['rejected'], stats['timeouts']) == (2, 1)
+
+    # 排队的后台任务（不设截止时间）不阻挡同步请求，也不算作饱和
+    with controller.admit(big):
+        background = threading.Thread(target=controller.acquire, args=(cost, None))
+        background.start()
+        deadline = time.time() + 5
+        while controller.stats()['background_waiting'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        with controller.admit(controller.estimate(0, 5, 5)):
+            stats = controller.stats()
+            assert (stats['waiting'], stats['background_waiting'], stats['saturated']) == (0, 1, False)
+    background.join(5)
+    assert controller.stats()['in_flight'] == 1
+    controller.release(cost)
+
+    # 接口：预算被占满且不允许排队时快速返回503
+    busy = AdmissionController(max_pixels=1, max_memory=0, max_waiting=0)
+    client = app_module.app.test_client()
+    with mock.patch.object(app_module, 'admission', busy), \
+            mock.patch.object(app_module, 'result_cache', ResultCache(cache_dir=None)), \
+            busy.admit(busy.estimate(0, 1, 1)):
+        response = client.post('/api/process-image', data=_upload(create_test_image()),
+                               content_type='multipart/form-data')
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.get_json()['load']['in_flight'] == 1
+
+        health = client.get('/api/health').get_json()
+        assert health['status'] == 'saturated' and health['load']['utilization'] >= 1
+        assert client.get('/api/health?strict=1').status_code == 503
+
+    with mock.patch.object(app_module, 'admission', busy):
+        assert client.get('/api/health?strict=1').status_code == 200
+        assert 'cosplay_admission_load{resource="pixels"} 0' in client.get('/api/metrics').get_data(as_text=True)
+
+def test_process_image_in_memory_reports_bytes_copied():
+    """同步模式全程在内存中处理，并报告拷贝字节数"""
+    import tempfile
+    from unittest import mock
+    import app as app_module
+    from services.result_cache import ResultCache
+
+    client = app_module.app.test_client()
+    with mock.patch.object(tempfile, 'mkstemp', side_effect=AssertionError('不应写临时文件')), \
+            mock.patch.object(app_module, 'result_cache', ResultCache(cache_dir=None)):
+        response = client.post('/api/process-image', data=_upload(create_test_image()),
+                               content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    metrics = response.get_json()['metrics']
+    assert metrics['bytesCopied'] == sum(metrics['copies'].values())
+    assert {'upload', 'decode', 'encode'} <= set(metrics['copies'])
+    assert metrics['frameCopies'] == sum(metrics['frames'].values()) > 0
+
+def test_frame_views_and_per_request_copy_count():
+    """帧的PIL视图与区域不拷贝，服务间传递帧时整帧拷贝只在解码、抠图、融合画布与编码边界发生"""
+    from services.frame import Frame, metering
+    from services.image_io import CopyMeter
+    from services.output_encoder import OutputEncoder
+    from services.pipeline import FusionPipeline
+
+    pixels = np.random.default_rng(3).integers(0, 256, (60, 40, 4), dtype=np.uint8)
+    frame = Frame(pixels)
+    meter = CopyMeter()
+    with metering(meter):
+        view = frame.image
+        region = frame.region((5, 10, 25, 30))
+        rgb = frame.convert('RGB')
+    assert view.mode == 'RGBA' and np.array_equal(np.asarray(view), pixels)
+    assert np.shares_memory(region, pixels)
+    assert rgb.mode == 'RGB' and meter.frames == {'frame_convert': 1}
+
+    # 融合器对帧与PIL图片的结果一致，帧输入时返回帧
+    blender = ImageBlender()
+    background = Image.fromarray(np.random.default_rng(4).integers(0, 256, (60, 40, 3), dtype=np.uint8))
+    blended = blender.blend_images(Frame(pixels), background)
+    assert isinstance(blended, Frame)
+    assert np.array_equal(blended.array, np.asarray(blender.blend_images(Image.fromarray(pixels), background)))
+
+    pipeline = FusionPipeline(frame_pool=None)
+    meter = CopyMeter()
+    result = pipeline.process(_upload(create_test_image())['image'][0].getvalue(), meter=meter)
+    with metering(meter):
+        OutputEncoder().encode(result['image'], 'png')
+    assert meter.frames == {'decode': 1, 'extract': 1, 'blend_canvas': 1, 'frame_to_image': 1}
+    assert meter.frame_copies == 4
+
+def test_result_cache_serves_repeats_without_pipeline_work(tmp_path):
+    """相同上传与参数直接返回缓存结果；并发的相同请求只计算一次；重启后从磁盘命中"""
+    import threading
+    from unittest import mock
+    import app as app_module
+    from services.result_cache import ResultCache
+
+    cache = ResultCache(cache_dir=str(tmp_path))
+    process = app_module.pipeline.process
+    calls = []
+
+    def slow_process(*args, **kwargs):
+        calls.append(1)
+        time.sleep(0.2)
+        return process(*args, **kwargs)
+
+    buffer = io.BytesIO()
+    create_test_image().save(buffer, format='PNG')
+    upload = buffer.getvalue()
+
+    with mock.patch.object(app_module, 'result_cache', cache), \
+            mock.patch.object(app_module.pipeline, 'process', side_effect=slow_process):
+        responses = [None, None]
+
+        def submit(index):
+            responses[index] = app_module.run_pipeline(upload)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert sorted(r['cache'] for r in responses) == ['coalesced', 'miss']
+        assert responses[0]['resultUrl'] == responses[1]['resultUrl']
+
+        repeat = app_module.run_pipeline(upload, inline=True)
+        assert repeat['cache'] == 'hit' and len(calls) == 1
+        assert repeat['resultImage'].startswith('data:image/png;base64,')
+
+        # 参数变化时不复用
+        with mock.patch.object(app_module.pipeline, 'cache_params', return_value={'model': 'other'}):
+            assert app_module.run_pipeline(upload)['cache'] == 'miss'
+
+    stats = cache.stats()
+    assert stats['hit_ratio'] == 0.5
+    assert stats['bytes_saved'] == 2 * repeat['resultSize']
+
+    restarted = ResultCache(cache_dir=str(tmp_path))
+    entry = restarted.get(app_module.result_key(upload))
+    assert entry['data'].startswith(b'\x89PNG') and entry['character'] == repeat['character']
+    assert restarted.stats()['disk_hits'] == 1
+
+    # 磁盘层按字节预算淘汰最久未访问的条目（读取会刷新访问时间）
+    bounded = ResultCache(max_bytes=0, cache_dir=str(tmp_path / 'bounded'), max_disk_bytes=3000)
+    for index in range(3):
+        bounded.put(f'key{index}', {'data': bytes(900), 'mimetype': 'image/png'})
+        os.utime(bounded._disk_paths(f'key{index}')[1], (index, index))
+    assert bounded.get('key0') is not None
+    bounded.put('key3', {'data': bytes(900), 'mimetype': 'image/png'})
+    stats = bounded.stats()
+    assert stats['disk_evictions'] >= 1 and stats['disk_bytes'] <= 3000
+    assert bounded.get('key1') is None and bounded.get('key0') is not None and bounded.get('key3') is not None
+    assert ResultCache(cache_dir=str(tmp_path / 'bounded')).stats()['disk_bytes'] == stats['disk_bytes']
+
+    # 第一个请求卡住时，相同请求的等待有上限
+    stuck = ResultCache(cache_dir=None, wait_timeout=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=stuck.get_or_compute,
+                              args=('key', lambda: release.wait(5) and {'data': b'x'}))
+    leader.start()
+    while not stuck._flights:
+        time.sleep(0.01)
+    try:
+        stuck.get_or_compute('key', lambda: {'data': b'y'})
+        assert False, '等待超时应报错'
+    except TimeoutError:
+        pass
+    release.set()
+    leader.join()
+
+    # 第一个请求失败时，等待者抛出各自的副本（类型与属性相同，原异常作为 __cause__）
+    from concurrent.futures import ThreadPoolExecutor
+    from services.admission import AdmissionRejectedError
+
+    failing = ResultCache(cache_dir=None)
+    original = AdmissionRejectedError('预算已满', 3, 'timeout')
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise original
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        calls = [executor.submit(failing.get_or_compute, 'key', fail) for _ in range(3)]
+        while failing.stats()['coalesced'] < 2:
+            time.sleep(0.01)
+        release.set()
+        errors = [call.exception() for call in calls]
+    assert sum(error is original for error in errors) == 1
+    copies = [error for error in errors if error is not original]
+    assert len({id(error) for error in copies}) == 2
+    for error in copies:
+        assert isinstance(error, AdmissionRejectedError) and error.__cause__ is original
+        assert (str(error), error.retry_after, error.reason) == ('预算已满', 3, 'timeout')
+
+def test_character_recognizer_uses_feature_index(tmp_path):
+    """按颜色特征识别角色，索引可保存并以内存映射方式加载"""
+    from services.character_index import CharacterIndex, color_histogram
+
+    recognizer = CharacterRecognizer()
+    candidates = recognizer.recognize(create_test_image(), k=3)
+    assert recognizer.recognize_character(create_test_image()) == '皮卡丘'
+    assert [c['score'] for c in candidates] == sorted((c['score'] for c in candidates), reverse=True)
+    assert 0 < sum(c['confidence'] for c in candidates) <= 1.0 + 1e-6
+    assert recognizer.recognize(Image.new('RGB', (300, 300), '#141414'))[0]['key'] == 'batman'
+
+    features = recognizer.analyze_image_features(create_test_image())
+    assert 'yellow' in [color['color'] for color in features['dominant_colors']]
+
+    # 保存后内存映射加载，检索结果不变；索引外的角色以键作为名称
+    index = CharacterIndex.from_histograms({
+        'custom_hero': color_histogram(Image.new('RGB', (64, 64), '#20C040')),
+        **{key: recognizer.index.features[i] ** 2 for i, key in enumerate(recognizer.index.keys)},
+    })
+    index.save(str(tmp_path / 'index'))
+    loaded = CharacterIndex.load(str(tmp_path / 'index'))
+    assert isinstance(loaded.features, np.memmap)
+    mapped = CharacterRecognizer(index=loaded)
+    assert mapped.recognize_character(create_test_image()) == '皮卡丘'
+    assert mapped.recognize_character(Image.new('RGB', (300, 300), '#20C040')) == 'custom_hero'
+
+    # 显式传入的空索引不会被默认路径的索引替换
+    empty = CharacterIndex.from_histograms({})
+    assert CharacterRecognizer(index=empty).index is empty
+
+def test_session_manager_loads_lazily_once():
+    """模型延迟加载、进程内只加载一次，并记录加载统计"""
+    import types
+    from unittest import mock
+    from services.image_processor import ImageProcessor
+    from services.session_manager import SessionManager
+
+    loaded = []
+    fake_rembg = types.ModuleType('rembg')
+    fake_rembg.new_session = lambda model: loaded.append(model) or object()
+    fake_rembg.remove = lambda image, session=None: image.convert('RGBA')
+
+    with mock.patch.dict(sys.modules, {'rembg': fake_rembg}):
+        manager = SessionManager(default_model='u2netp')
+        processor = ImageProcessor(session_manager=manager)
+        assert loaded == [] and not manager.is_loaded()
+
+        processor.extract_person(create_test_image())
+        processor.extract_person(create_test_image())
+        processor.warm_up()
+
+    assert loaded == ['u2netp']
+    stats = manager.stats()['u2netp']
+    assert stats['load_seconds'] >= 0 and stats['warm_up_seconds'] is not None
+
+    try:
+        SessionManager(default_model='unknown')
+        assert False, '不支持的模型应报错'
+    except ValueError:
+        pass
+
+class _FakeOnnxSession:
+    """模拟rembg会话中的ONNX推理会话：预测值为输入第一个通道"""
+
+    def __init__(self, batch_dim):
+        self.batch_dim = batch_dim
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        import types
+        return [types.SimpleNamespace(name='input.1', shape=[self.batch_dim, 3, 320, 320])]
+
+    def run(self, outputs, feed):
+        batch = feed['input.1']
+        self.batch_sizes.append(batch.shape[0])
+        return [batch[:, :1]]
+
+def test_extract_persons_runs_one_stacked_batch():
+    """批量抠图一次推理整批图片，返回与原图同尺寸的RGBA"""
+    import types
+    from services.image_processor import ImageProcessor
+    from services.session_manager import SessionManager
+
+    for batch_dim, expected_runs in [('batch_size', [3]), (1, [1, 1, 1])]:
+        inner_session = _FakeOnnxSession(batch_dim)
+        manager = SessionManager()
+        manager._sessions['u2net'] = types.SimpleNamespace(inner_session=inner_session)
+        processor = ImageProcessor(session_manager=manager)
+
+        images = [create_test_image(), Image.new('RGB', (200, 100), 'black'), np.zeros((50, 80, 3), np.uint8)]
+        results = processor.extract_persons(images)
+
+        assert inner_session.batch_sizes == expected_runs
+        assert [result.size for result in results] == [(400, 600), (200, 100), (80, 50)]
+        assert all(result.mode == 'RGBA' for result in results)
+        assert np.array_equal(np.asarray(results[0])[..., :3], np.asarray(images[0]))
+
+def test_micro_batcher_groups_concurrent_requests():
+    """微批处理把并发请求合并为一批"""
+    from concurrent.futures import ThreadPoolExecutor
+    from services.micro_batcher import MicroBatcher
+
+    batches = []
+    batcher = MicroBatcher(lambda items: batches.append(len(items)) or [item * 2 for item in items],
+                           max_batch_size=4, max_wait_ms=50)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(batcher, range(4)))
+
+    assert results == [0, 2, 4, 6]
+    assert sum(batches) == 4 and len(batches) < 4
+    assert batcher.stats()['max_batch'] > 1
+
+    # 整批失败时逐个重新处理：只有出错的请求收到异常
+    def fragile(items):
+        if -1 in items:
+            raise ValueError('bad item')
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(fragile, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(item) for item in (1, -1, 3)]
+    assert futures[0].result() == 2 and futures[2].result() == 6
+    try:
+        futures[1].result()
+        assert False, "出错的请求应收到异常"
+    except ValueError:
+        pass
+    assert batcher.stats()['fallbacks'] == 1
+
+def _fake_rembg_module():
+    """模拟rembg：彩色或深色像素视为人物"""
+    import types
+
+    def remove(image, session=None):
+        pixels = np.asarray(image.convert('RGB'), dtype=np.int16)
+        person = ((pixels.max(axis=2) - pixels.min(axis=2)) > 60) | (pixels.max(axis=2) < 100)
+        result = image.convert('RGBA')
+        result.putalpha(Image.fromarray((person * 255).astype(np.uint8)))
+        return result
+
+    module = types.ModuleType('rembg')
+    module.new_session = lambda model: object()
+    module.remove = remove
+    return module
+
+def test_low_res_segmentation_matches_full_res_mask():
+    """低分辨率分割 + 引导放大的遮罩与原尺寸分割的IoU足够高"""
+    from unittest import mock
+    from services.image_processor import ImageProcessor
+    from services.session_manager import SessionManager
+
+    image = create_test_image().resize((800, 1200), Image.Resampling.LANCZOS)
+    with mock.patch.dict(sys.modules, {'rembg': _fake_rembg_module()}):
+        manager = SessionManager()
+        full = ImageProcessor(session_manager=manager, working_size=0).extract_person(image)
+        low = ImageProcessor(session_manager=manager, working_size=256).extract_person(image)
+
+    assert low.size == full.size
+    assert np.array_equal(np.asarray(low)[..., :3], np.asarray(image))
+
+    full_mask = np.asarray(full)[..., 3] >= 128
+    low_mask = np.asarray(low)[..., 3] >= 128
+    iou = (full_mask & low_mask).sum() / (full_mask | low_mask).sum()
+    assert iou > 0.98, iou
+
+class _StubInferenceServer:
+    """本地推理API替身：按路径模拟慢响应、失败和模型加载中"""
+
+    def __init__(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.hits = {}
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(buffer, format='PNG')
+        png = buffer.getvalue()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                hits = server.hits[self.path] = server.hits.get(self.path, 0) + 1
+
+                if self.path == '/slow':
+                    time.sleep(0.3)
+                if self.path == '/failing' and hits <= 2:
+                    return self._reply(500, b'error')
+                if self.path == '/loading' and hits == 1:
+                    return self._reply(503, json.dumps({'error': 'loading', 'estimated_time': 0.05}).encode())
+                if self.path == '/never-loads':
+                    return self._reply(503, json.dumps({'error': 'loading', 'estimated_time': 0}).encode())
+                if self.path == '/bad-request':
+                    return self._reply(400, b'bad')
+                self._reply(200, png)
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}{path}'
+
+    def close(self):
+        self.httpd.shutdown()
+
+def test_inference_client_retries_timeouts_and_coalescing():
+    """推理客户端：失败重试、模型加载等待、读取超时、相同请求合并（合并等待有上限）"""
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    from services.inference_client import InferenceClient, InferenceError
+
+    server = _StubInferenceServer()
+    try:
+        def client(path, **kwargs):
+            return InferenceClient(server.url(path), 'token', backoff_base=0.01, **kwargs)
+
+        assert client('/failing').post({}).startswith(b'\x89PNG')
+        assert server.hits['/failing'] == 3
+
+        loading = client('/loading', max_retries=0)
+        assert loading.post({}).startswith(b'\x89PNG')
+        assert loading.stats()['loading_waits'] == 1
+
+        for path, kwargs in [('/bad-request', {}), ('/slow', {'read_timeout': 0.05, 'max_retries': 1})]:
+            try:
+                client(path, **kwargs).post({})
+                assert False, f'{path} 应抛出InferenceError'
+            except InferenceError:
+                pass
+        assert server.hits['/bad-request'] == 1
+
+        server.hits['/slow'] = 0
+        coalescing = client('/slow')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: coalescing.post({}, key='same'), range(4)))
+        assert len(set(results)) == 1
+        assert server.hits['/slow'] == 1
+        assert coalescing.stats()['coalesced'] == 3
+
+        # 第一个请求卡住时，合并的请求等待有上限
+        stuck = client('/slow')
+        assert stuck.coalesce_timeout == 4 * (5 + 60) + 3 * 8 + 120
+        with mock.patch.object(InferenceClient, 'coalesce_timeout', 0.05), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(stuck.post, {}, key='stuck')
+            while not stuck._flights:
+                time.sleep(0.01)
+            try:
+                stuck.post({}, key='stuck')
+                assert False, '等待超时应抛出InferenceError'
+            except InferenceError:
+                pass
+            assert leader.result().startswith(b'\x89PNG')
+    finally:
+        server.close()
+
+def test_inference_client_bounds_model_loading_wait():
+    """上游一直返回预计时间为0的503时不空转：按实际时间在 max_loading_wait 内放弃"""
+    from services.inference_client import InferenceClient, InferenceError
+
+    server = _StubInferenceServer()
+    try:
+        client = InferenceClient(server.url('/never-loads'), 'token', backoff_base=0.05,
+                                 max_loading_wait=0.5, max_retries=1)
+        start = time.monotonic()
+        try:
+            client.post({})
+            assert False, '模型一直加载中应抛出InferenceError'
+        except InferenceError:
+            pass
+        assert time.monotonic() - start < 0.5 + 0.5
+        # 每次等待至少约 backoff_base：0.5s内最多十余次请求，而不是上千次
+        assert server.hits['/never-loads'] < 20
+        assert client.stats()['retries'] == 1
+    finally:
+        server.close()
+
+def test_api_background_uses_client_and_falls_back(monkeypatch):
+    """API模式通过客户端生成背景，上游失败时回退到本地背景"""
+    from services.inference_client import InferenceClient
+
+    server = _StubInferenceServer()
+    try:
+        monkeypatch.setenv('HUGGINGFACE_API_TOKEN', 'token')
+        for path, expected in [('/ok', (255, 0, 0)), ('/bad-request', None)]:
+            client = InferenceClient(server.url(path), 'token')
+            generator = BackgroundGenerator(cache=BackgroundCache(max_bytes=0), client=client)
+            background = generator.generate_background('皮卡丘', 8, 8)
+            if expected is None:
+                expected = generator._generate_local_background('皮卡丘', 8, 8).getpixel((0, 0))
+            assert background.getpixel((0, 0)) == expected
+    finally:
+        server.close()
+
+def test_stage_scheduler_overlaps_independent_stages():
+    """互不依赖的阶段并发执行，依赖链在调用方线程上执行（线程池只执行并行分支），并报告关键路径"""
+    import threading
+    from services.stage_scheduler import Stage, StageScheduler
+
+    threads = {}
+
+    def sleeper(seconds, value):
+        def run(results):
+            threads[value] = threading.current_thread()
+            time.sleep(seconds)
+            return value
+        return run
+
+    scheduler = StageScheduler([
+        Stage('recognize', sleeper(0.1, 'pikachu')),
+        Stage('generate', sleeper(0.1, 'background'), deps=['recognize']),
+        Stage('extract', sleeper(0.15, 'person')),
+        Stage('blend', lambda results: (results['generate'], results['extract']), deps=['generate', 'extract']),
+    ])
+    start = time.perf_counter()
+    run = scheduler.run({})
+    elapsed = time.perf_counter() - start
+
+    assert run['results']['blend'] == ('background', 'person')
+    assert elapsed < 0.3
+    timings = run['timings']
+    assert timings['critical_path'] == ['recognize', 'generate', 'blend']
+    assert timings['stages']['extract']['start_ms'] < timings['stages']['recognize']['end_ms']
+    caller = threading.current_thread()
+    assert threads['pikachu'] is caller and threads['background'] is caller and threads['person'] is not caller
+
+    # 单线程的共享池也不会限制并发请求：每个请求只向线程池提交并行分支
+    shared = StageScheduler(list(scheduler.stages.values()), max_workers=1)
+    start = time.perf_counter()
+    requests = [threading.Thread(target=shared.run, args=({},)) for _ in range(3)]
+    for request in requests:
+        request.start()
+    for request in requests:
+        request.join()
+    assert time.perf_counter() - start < 0.65
+    shared.shutdown()
+
+    try:
+        StageScheduler([Stage('a', sleeper(0, 1), deps=['b']), Stage('b', sleeper(0, 1), deps=['a'])])
+        assert False, '依赖成环应报错'
+    except ValueError:
+        pass
+
 if __name__ == "__main__":
     success = test_services()
     sys.exit(0 if success else 1)